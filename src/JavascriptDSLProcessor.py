@@ -1,9 +1,9 @@
 from dslProcessor import PreprocessedDSL
-from programs import ProgramOutput, ProgramDirectory, TracerNode
+from programs import NamedProgram, ProgramOutput, ProgramDirectory, TracerNode
 from typing import List, Dict, Any, Optional
 import time
 import re
-from playwright.sync_api import sync_playwright
+from renderPool import renderHtmlToPng
 import pythonmonkey as pm
 from typing import List, Any
 import base64
@@ -17,6 +17,13 @@ class JavascriptDSLProcessor(PreprocessedDSL):
     def getVisualReturnTypes(self) -> List[str]:
         return ["html", "png"]
 
+    def getIncludedProgramNames(self, program: NamedProgram) -> Optional[List[str]]:
+        # The script may use Math.random or Date, so it is only result cached when the
+        # itom says it is deterministic with resultCache: true
+        if program.config.get("resultCache") is True:
+            return super().getIncludedProgramNames(program)
+        return None
+
     def getIncludableTypes(self) -> List[str]:
         return ["javascript"]
 
@@ -74,13 +81,7 @@ class JavascriptDSLProcessor(PreprocessedDSL):
         html = "<body>" + str(outputval) + "</body>"
 
         # Convert HTML to PNG
-        with sync_playwright() as p:
-            browser = p.chromium.launch()
-            page = browser.new_page()
-            page.set_content(html)
-            png_bytes = page.screenshot(full_page=True, type="png")
-            browser.close()
-            return png_bytes
+        return renderHtmlToPng(html)
 
 
 
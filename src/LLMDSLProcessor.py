@@ -1,14 +1,14 @@
-from openai import OpenAI
-import hashlib
-import os
 from dslProcessor import BasicDSLProcessor
-from programs import ProgramOutput, ProgramDirectory, TracerNode
+from programs import NamedProgram, ProgramOutput, ProgramDirectory, TracerNode
 from typing import List, Any, Optional
-from dotenv import dotenv_values
-from playwright.sync_api import sync_playwright
+from renderPool import renderHtmlToPng
+from llmGateway import getLLMGateway
+from streamSink import currentStreamSink, currentStreamSource
 import json
 import time
 
+SAMPLING_PARAMETERS = ["temperature", "top_p", "max_tokens", "seed", "presence_penalty", "frequency_penalty"]
+
 class LLMDSLProcessor(BasicDSLProcessor):
     def __init__(self, programDirectory: ProgramDirectory):
         super().__init__(programDirectory)
@@ -19,6 +19,11 @@ class LLMDSLProcessor(BasicDSLProcessor):
     
     def getIncludableTypes(self) -> List[str]:
         return ["html", "png", "md"]
+
+    def getIncludedProgramNames(self, program: NamedProgram) -> Optional[List[str]]:
+        # Responses are cached by the LLM cache, which llmCache: false bypasses, and sampled
+        # responses differ between runs, so LLM results are never result cached
+        return None
     
     def postprocess(self, processedCode: str, processedOutputState: dict, input: dict, outputNames: List[str], preferredVisualReturnType: str, config:dict,tracer: Optional[TracerNode] = None) -> ProgramOutput:
         result = super().postprocess(processedCode, processedOutputState, input, outputNames, "md",config,tracer)
@@ -32,43 +37,22 @@ class LLMDSLProcessor(BasicDSLProcessor):
 
         prompt = result.viz()
 
-        client = None
-        # if .env exists, load it
-        if os.path.exists(".env"):
-            env = dotenv_values(".env")
-            client = OpenAI(api_key=env["OPENAI_API_KEY"])
-        else:
-            client = OpenAI()
+        messages = [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": prompt}
+        ]
+        # sampling parameters set in the config are sent along and are part of the cache key
+        params = dict((name, config[name]) for name in SAMPLING_PARAMETERS if name in config)
 
-        llm_cache = ".llm_cache"
-        # create a speech_cache folder if it doesn't exist
-        if not os.path.exists(llm_cache):
-            os.makedirs(llm_cache)
-        
-        # create a hash of the prompt
-        prompt_hash = hashlib.sha256(prompt.encode()).hexdigest()
-        # create a file name for the prompt
-        prompt_file = os.path.join(llm_cache, f"{prompt_hash}.txt")
-        
-        # if the prompt file exists, read it
-        response = None
-        if os.path.exists(prompt_file):
-            with open(prompt_file, "r") as file:
-                response = file.read()
-        else:
-            # generate the prompt
+        # stream the response to whoever is watching this render, e.g. /stream/<program_name>
+        onChunk = None
+        sink = currentStreamSink.get()
+        if sink is not None:
+            source = currentStreamSource.get() or "llm"
+            onChunk = lambda text: sink.write(source, text)
 
-            serv_resp = client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant."},
-                    {"role": "user", "content": prompt}
-                ]
-            )
-            response = serv_resp.choices[0].message.content
-            # save the prompt to the file
-            with open(prompt_file, "w") as file:
-                file.write(response)
+        # reuse the response if the same model was asked the same thing before, or is being asked right now
+        response = getLLMGateway().chat(model, messages, params, useCache=config.get("llmCache", True), onChunk=onChunk, processor="llm", config=config)
 
         # split at ```json
         result = json.loads(response.split("```json")[1].split("```")[0])
@@ -91,12 +75,7 @@ class LLMDSLProcessor(BasicDSLProcessor):
         elif preferredVisualReturnType == "md":
             return ProgramOutput(time.time(), "md", f"{markdown_table}", outputData)
         elif preferredVisualReturnType == "png":
-            with sync_playwright() as p:
-                browser = p.chromium.launch()
-                page = browser.new_page()
-                page.set_content(table)
-                png_bytes = page.screenshot(full_page=True, type="png")
-                browser.close()
-                return ProgramOutput(time.time(), "png", png_bytes, outputData)
+            png_bytes = renderHtmlToPng(table)
+            return ProgramOutput(time.time(), "png", png_bytes, outputData)
         else:
             raise ValueError(f"Invalid visual return type: {preferredVisualReturnType}")
@@ -1,8 +1,5 @@
-from openai import OpenAI
-import cv2
 import hashlib
 import os
-from pydub import AudioSegment
 import uuid
 from dslProcessor import DSLProcessor, BasicDSLProcessor
 from programs import ProgramOutput, ProgramDirectory, ProgramInput, TracerNode
@@ -10,9 +7,9 @@ from typing import List, Any, Optional
 import os
 import time
 import shutil
-from dotenv import dotenv_values
 import pkg_resources
 from ItomHeader import ItomHeader
+from llmGateway import getLLMGateway
 
 class PlaceHolderDSLProcessor(DSLProcessor):
     def __init__(self, programDirectory: ProgramDirectory):
@@ -28,17 +25,16 @@ class PlaceHolderDSLProcessor(DSLProcessor):
         for i in installed_packages:
             installed.append(f"{i.key}")
         return installed
-    
+
+    def getIncludedProgramNames(self, program) -> Optional[List[str]]:
+        # The generated itom is only known at run time, and _forceRefresh
+        # must always regenerate it, so placeholder results are never cached
+        return None
+
     def process(self, code: str, input: dict, outputNames: List[str], preferredVisualReturnType: str,config:dict,tracer: Optional[TracerNode] = None) -> ProgramOutput:
         if preferredVisualReturnType not in self.getVisualReturnTypes():
             raise ValueError(f"Invalid visual return type: {preferredVisualReturnType}")
         
-        if os.path.exists(".env"):
-            env = dotenv_values(".env")
-            client = OpenAI(api_key=env["OPENAI_API_KEY"])
-        else:
-            client = OpenAI()
-
         itomidstring = ""
         innerInput = {}
         forceRefresh = False
@@ -153,11 +149,8 @@ Make a plan for the program and then write the rest of the program to complete t
                 {"role": "user", "content": prompt}
             ]
 
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages
-        )
-        response_text = response.choices[0].message.content
+        # generated code is not cached, but identical requests in flight are only sent once
+        response_text = getLLMGateway().chat("gpt-4o-mini", messages, useCache=False, processor="placeholder", config=config)
 
 
         response_text = response_text.split("```python")[1].split("```")[0]
@@ -181,11 +174,7 @@ Remember, all imports and sub-functions should be *inside* the function.
 Reason about the error and return the corrected code.
 """
             messages.append({"role": "user", "content": newprompt})
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=messages
-            )
-            response_text = response.choices[0].message.content
+            response_text = getLLMGateway().chat("gpt-4o-mini", messages, useCache=False, processor="placeholder", config=config)
             response_text = response_text.split("```python")[1].split("```")[0]
             #print(response_text)
 
@@ -1,9 +1,9 @@
 from dslProcessor import DSLProcessor
-from programs import ProgramOutput, ProgramDirectory, TracerNode
+from programs import NamedProgram, ProgramOutput, ProgramDirectory, TracerNode
 from typing import List, Any, Optional
 import os
 import time
-from playwright.sync_api import sync_playwright
+from renderPool import renderHtmlToPng
 import base64
 import requests
 
@@ -15,6 +15,13 @@ class PythonDSLProcessor(DSLProcessor):
     def getVisualReturnTypes(self) -> List[str]:
         return ["html","png","md"]
 
+    def getIncludedProgramNames(self, program: NamedProgram) -> Optional[List[str]]:
+        # The code may use random numbers, the clock or files, so it is only result cached
+        # when the itom says it is deterministic with resultCache: true
+        if program.config.get("resultCache") is True:
+            return []
+        return None
+
     def process(self, code: str, input: dict, outputNames: List[str], preferredVisualReturnType: str,config:dict,tracer: Optional[TracerNode] = None) -> ProgramOutput:
         main_function_name = config['mainfunc']
         scope = {}
@@ -66,12 +73,7 @@ class PythonDSLProcessor(DSLProcessor):
         elif preferredVisualReturnType == "md":
             return ProgramOutput(time.time(), "md", f"{markdown_table}", outputData)
         elif preferredVisualReturnType == "png":
-            with sync_playwright() as p:
-                browser = p.chromium.launch()
-                page = browser.new_page()
-                page.set_content(table)
-                png_bytes = page.screenshot(full_page=True, type="png")
-                browser.close()
-                return ProgramOutput(time.time(), "png", png_bytes, outputData)
+            png_bytes = renderHtmlToPng(table)
+            return ProgramOutput(time.time(), "png", png_bytes, outputData)
         else:
             raise ValueError(f"Invalid visual return type: {preferredVisualReturnType}")
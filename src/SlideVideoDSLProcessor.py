@@ -1,17 +1,38 @@
-from openai import OpenAI
-import cv2
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
 import os
 from pydub import AudioSegment
 import uuid
 from dslProcessor import DSLProcessor, BasicDSLProcessor
 from SlideDSLProcessor import SlideDSLProcessor
+from marpService import COMMENT_PATTERN, DIRECTIVE_PATTERN, getMarpService, splitSlides
+from llmGateway import getLLMGateway
 from programs import ProgramOutput, ProgramDirectory, TracerNode
-from typing import List, Any, Optional
+from typing import List, Any, Optional, Tuple
 import os
+import random
 import time
 import shutil
-from dotenv import dotenv_values
+import subprocess
+import tempfile
+import json
+import wave
+
+# Speech is assembled as 16 bit mono PCM at the rate the TTS model produces
+SAMPLE_RATE = 24000
+SAMPLE_WIDTH = 2
+
+# Built slides (image, padded audio and video segment) by a hash of their markdown and settings
+SLIDE_CACHE = ".slide_cache"
+# Changes whenever the layout of the slide cache changes
+SLIDE_CACHE_VERSION = "2"
+# Size of the slide cache, unless the config sets slideCacheMaxBytes
+DEFAULT_SLIDE_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+# Staging directories older than this were left behind by a build that died
+STALE_STAGING_SECONDS = 3600
+# Slide segments encoded at a time, unless the config sets encodeConcurrency
+DEFAULT_ENCODE_CONCURRENCY = max(1, min(4, (os.cpu_count() or 2) // 2))
+
 class SlideVideoDSLProcessor(SlideDSLProcessor):
     def __init__(self, programDirectory: ProgramDirectory):
         super().__init__(programDirectory)
@@ -41,55 +62,60 @@ class SlideVideoDSLProcessor(SlideDSLProcessor):
 
         print(f"model: {model}, instructions: {instructions}, voice: {voice}")
  
-        client = None
-        # if .env exists, load it
-        if os.path.exists(".env"):
-            env = dotenv_values(".env")
-            client = OpenAI(api_key=env["OPENAI_API_KEY"])
-        else:
-            client = OpenAI()
-
         speech_cache = ".speech_cache"
         # create a speech_cache folder if it doesn't exist
         if not os.path.exists(speech_cache):
             os.makedirs(speech_cache)
 
-        # create a random id for the temp directory
-        tempdir = str(uuid.uuid4())
-        # if the tempdir doesn't exist, create it
-        if not os.path.exists(tempdir):
-            os.makedirs(tempdir)
-
-        #prepend = "---\nmarp: true\ntheme: custom-default\n---\n"
-
-        # save the code to a temporary file
-        filename = f"{tempdir}/slides.itom"
-        with open(filename, "w") as file:
-            file.write(code)
-
-        # run the marp command to crate the images
-        os.system(f"marp --images png {filename} -o {tempdir}/temp");
-        os.system(f"marp --notes {filename} -o {tempdir}/notes.md");
+        # a private temp directory for the files of this build
+        tempdir = tempfile.mkdtemp(prefix="slidevideo-")
 
-        slides = []
-        # read the file
-        with open(f"{tempdir}/notes.md", 'r') as file:
-            # read each chunk (seperated by ---) and add to slides
-            for chunk in file.read().split('---'):
-                slides.append(chunk)
+        # Each video has a frame per second which is number of frames in every second
+        frame_per_second = int(config.get("fps", 15))
+        preset = config.get("videoPreset", "veryfast")
+
+        # every slide is cached by its markdown (with its notes) and the settings it is built with,
+        # so only slides that changed since an earlier build are rendered, voiced and encoded.
+        # Directives set anywhere in the deck can change how a slide looks, so they are part of
+        # every key, and so is the position of the slide when pages are numbered.
+        front_matter, slide_sources = splitSlides(code)
+        directives = self.deckDirectives(slide_sources)
+        paginated = "paginate" in code
+        context = front_matter + "\n".join(directives)
+        keys = [self.slideKey(context, source, index if paginated else None, model, voice, instructions, frame_per_second, preset)
+                for index, source in enumerate(slide_sources)]
+        missing = [index for index, key in enumerate(keys) if not os.path.exists(self.slideCachePath(key, "segment.mp4"))]
+        # touch the cached slides so that they are the most recently used
+        for index, key in enumerate(keys):
+            if index not in missing:
+                try:
+                    os.utime(self.slideCachePath(key))
+                except OSError:
+                    pass
+        print(f"{len(slide_sources) - len(missing)} of {len(slide_sources)} slides cached")
 
         images = []
-        # look in the temp folder for all files that start with temp, sort lexicographically
-        for file in sorted(os.listdir(f"{tempdir}")):
-            if file.startswith("temp"):
-                # if the file doesn't end with png, rename it to png
-                if not file.endswith(".png"):
-                    os.rename(f"{tempdir}/{file}", f"{tempdir}/{file}.png")
-                    images.append(f"{tempdir}/{file}.png")
-                else:
-                    images.append(f"{tempdir}/{file}")
+        slides = []
+        if len(missing) > 0:
+            # page numbers and directives depend on the rest of the deck, so such decks are always rendered in full
+            if paginated or len(directives) > 0:
+                images, slides = getMarpService().renderSlides(code)
+                if len(images) == len(slide_sources):
+                    images = [images[index] for index in missing]
+                    slides = [slides[index] for index in missing]
+            else:
+                deck = front_matter + "\n\n---\n\n".join(slide_sources[index] for index in missing)
+                images, slides = getMarpService().renderSlides(deck)
+
+            if len(images) != len(missing) or len(slides) != len(missing):
+                # marp split the deck differently than splitSlides did, so build every slide without the cache
+                print("Slides could not be matched up with the cache, building all of them")
+                images, slides = getMarpService().renderSlides(code)
+                keys = [None] * len(images)
+                missing = list(range(len(images)))
 
         speech_files = []
+        misses = []
         for c in slides:
             # calculate the md5 of the string
 
@@ -107,75 +133,42 @@ class SlideVideoDSLProcessor(SlideDSLProcessor):
                 audio = AudioSegment.silent(duration=2000)
                 audio.export(speech_file_path, format="mp3")
                 continue
-            with client.audio.speech.with_streaming_response.create(
-                model=model,
-                voice=voice,
-                input=c,
-                instructions=instructions,
-            ) as response:
-                response.stream_to_file(speech_file_path)
-
-
-        files_and_duration = []
-
-        # for each speech file, read the file and get the duration
-        index = 0
-        for speech_file in speech_files:
-            audio = AudioSegment.from_mp3(speech_file)
-
-            # determine length in milliseconds
-            duration = len(audio)
-            orig_duration = (duration / 1000)
-
-            # round up duration to nearest second
-            duration = int(duration / 1000) + 1
-
-            print(f"{speech_file} duration: {duration}")
-            
-            # add the duration to the files_and_duration list
-            files_and_duration.append((images[index], duration))
-            
-            # padding in milliseconds
-            padding = (duration - orig_duration)
-            print(f"Duration we want: {duration}, Duration we got: {orig_duration}, Padding: {padding}")
-            
-            padding_duration = padding * 1000
-            audio += AudioSegment.silent(duration=padding_duration)
-            # grab just the filename, ignore directory
-            filename = os.path.basename(speech_file)
-            audio.export(f"{tempdir}/padded_"+filename, format="mp3")
-            speech_files[index] = f"{tempdir}/padded_"+filename
-            index += 1
-
-        # concatenate the audio files into a single file
-        audio = AudioSegment.empty()
-        for speech_file in speech_files:
-            audio += AudioSegment.from_mp3(speech_file)
-        audio.export(f"{tempdir}/output.mp3", format="mp3")
-
-        # Each video has a frame per second which is number of frames in every second
-        frame_per_second = 15
-
-        w, h = None, None
-        for file, duration in files_and_duration:
-            frame = cv2.imread(file)
-
-            if w is None:
-                # Setting up the video writer
-                h, w, _ = frame.shape
-                fourcc = cv2.VideoWriter_fourcc('m', 'p', '4', 'v')
-                writer = cv2.VideoWriter(f"{tempdir}/output.mp4", fourcc, frame_per_second, (w, h))
-
-            # Repating the frame to fill the duration
-            for repeat in range(duration * frame_per_second):
-                writer.write(frame)
-
-        writer.release()
-
-        # combine the audio and video, overwrite the output file if it exists
-        if (os.path.exists(f"{tempdir}/combined.mp4")):
-            os.remove(f"{tempdir}/combined.mp4")
-        os.system(f"ffmpeg -i {tempdir}/output.mp4 -i {tempdir}/output.mp3 -c:v copy -c:a aac -strict experimental {tempdir}/combined.mp4")
+            misses.append((c, speech_file_path))
+
+        # fetch the slides that are not cached yet, several at a time
+        self.synthesizeSpeech(misses, model, voice, instructions, config)
+
+        # build the image, padded audio and video segment of each slide that was not cached.
+        # x264 already uses several threads per encode, so only a few encodes run at a time.
+        slide_dirs = [self.slideCachePath(key) if key is not None else None for key in keys]
+        encode_concurrency = max(1, int(config.get("encodeConcurrency", DEFAULT_ENCODE_CONCURRENCY)))
+        with ThreadPoolExecutor(max_workers=max(1, min(len(missing), encode_concurrency))) as pool:
+            futures = []
+            for position, index in enumerate(missing):
+                build_dir = f"{tempdir}/slide_{index:04d}"
+                futures.append(pool.submit(self.buildSlide, images[position], speech_files[position], build_dir, frame_per_second, preset))
+                if slide_dirs[index] is None:
+                    slide_dirs[index] = build_dir
+            for position, future in enumerate(futures):
+                future.result()
+                index = missing[position]
+                if keys[index] is not None:
+                    self.storeSlide(f"{tempdir}/slide_{index:04d}", slide_dirs[index])
+        if any(key is not None for key in keys) and len(missing) > 0:
+            self.evictSlideCache(int(config.get("slideCacheMaxBytes", DEFAULT_SLIDE_CACHE_MAX_BYTES)),
+                                 set(key for key in keys if key is not None))
+
+        # assemble the whole soundtrack from the padded PCM of every slide
+        pcm = bytearray()
+        for slide_dir in slide_dirs:
+            with open(f"{slide_dir}/audio.pcm", "rb") as file:
+                pcm += file.read()
+
+        # the soundtrack is only encoded once, when it is muxed into the video
+        self.writeWav(f"{tempdir}/output.wav", pcm)
+
+        # join the segments and mux in the audio in one pass
+        self.concatenateSegments([f"{slide_dir}/segment.mp4" for slide_dir in slide_dirs], f"{tempdir}/output.wav", f"{tempdir}/combined.mp4", tempdir)
 
         outputData = {}
 
@@ -192,6 +185,158 @@ class SlideVideoDSLProcessor(SlideDSLProcessor):
             raise ValueError(f"Invalid visual return type: {preferredVisualReturnType}")
         
 
-
-
-
+    # The comments that set a directive for the whole deck or for the slides after them
+    def deckDirectives(self, slide_sources: List[str]) -> List[str]:
+        return [comment for source in slide_sources for comment in COMMENT_PATTERN.findall(source) if DIRECTIVE_PATTERN.search(comment)]
+
+    def slideKey(self, context: str, source: str, position: Optional[int], model: str, voice: str, instructions: str, fps: int, preset: str) -> str:
+        parts = [SLIDE_CACHE_VERSION, context, source, position, model, voice, instructions, str(fps), preset, str(SAMPLE_RATE)]
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def slideCachePath(self, key: str, name: Optional[str] = None) -> str:
+        path = f"{SLIDE_CACHE}/{key[:2]}/{key}"
+        return path if name is None else f"{path}/{name}"
+
+    # Builds the image, padded audio and video segment of one slide in build_dir
+    def buildSlide(self, image: bytes, speech_file: str, build_dir: str, fps: int, preset: str) -> None:
+        os.makedirs(build_dir, exist_ok=True)
+        with open(f"{build_dir}/image.png", "wb") as file:
+            file.write(image)
+
+        # decode the speech once as PCM samples
+        audio = AudioSegment.from_mp3(speech_file).set_frame_rate(SAMPLE_RATE).set_channels(1).set_sample_width(SAMPLE_WIDTH)
+
+        # determine the length from the number of samples
+        samples = int(audio.frame_count())
+        orig_duration = samples / SAMPLE_RATE
+
+        # round up duration to the next second, which is also a whole number of video frames
+        duration = int(orig_duration) + 1
+
+        # pad with silence up to exactly that many samples
+        padding_samples = duration * SAMPLE_RATE - samples
+        print(f"{speech_file} duration: {duration}, Duration we got: {orig_duration}, Padding: {padding_samples / SAMPLE_RATE}")
+        with open(f"{build_dir}/audio.pcm", "wb") as file:
+            file.write(audio.raw_data)
+            file.write(bytes(padding_samples * SAMPLE_WIDTH))
+
+        # encode the slide as a still image segment as long as its audio
+        self.encodeStillSegment(f"{build_dir}/image.png", duration, f"{build_dir}/segment.mp4", fps, preset)
+
+    # Moves a built slide into the cache in one rename, so the cache never holds half a slide
+    def storeSlide(self, build_dir: str, slide_dir: str) -> None:
+        os.makedirs(os.path.dirname(slide_dir), exist_ok=True)
+        # copy next to the cache entry first, since the build directory may be on another device
+        staging_dir = f"{slide_dir}.{uuid.uuid4().hex}.tmp"
+        shutil.copytree(build_dir, staging_dir)
+        try:
+            os.replace(staging_dir, slide_dir)
+        except OSError:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            # another build stored the same slide first
+            if not os.path.exists(f"{slide_dir}/segment.mp4"):
+                raise
+
+    # Removes the least recently used slides until the cache is back under max_bytes. The
+    # directory mtime marks when a slide was last used, so several processes can share the
+    # cache; slides of the deck being built are kept. Slides of older cache versions are
+    # never touched again, so they age out like any other unused slide.
+    def evictSlideCache(self, max_bytes: int, keep: set) -> None:
+        entries = []
+        now = time.time()
+        for shard in os.scandir(SLIDE_CACHE):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    mtime = entry.stat().st_mtime
+                    size = sum(file.stat().st_size for file in os.scandir(entry.path))
+                except OSError:
+                    continue
+                if entry.name.endswith(".tmp"):
+                    if now - mtime > STALE_STAGING_SECONDS:
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                    continue
+                entries.append((mtime, size, entry.name, entry.path))
+        entries.sort()
+
+        total = sum(size for _, size, _, _ in entries)
+        for _, size, key, path in entries:
+            if total <= max_bytes:
+                break
+            if key in keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    # Synthesizes (text, path) pairs concurrently, at most ttsConcurrency at a time, and
+    # waits for all of them. The requests go through the LLM gateway, which also caps the
+    # requests of all decks together and writes each file atomically.
+    def synthesizeSpeech(self, requests: List[Tuple[str, str]], model: str, voice: str, instructions: str, config: dict) -> None:
+        # the same text on two slides only needs fetching once
+        pending = dict((path, text) for text, path in requests)
+        if len(pending) == 0:
+            return
+
+        concurrency = max(1, int(config.get("ttsConcurrency", 4)))
+        retries = int(config.get("ttsRetries", 3))
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(pending))) as pool:
+            futures = [pool.submit(self.synthesizeSlide, text, path, model, voice, instructions, retries, config)
+                       for path, text in pending.items()]
+            for future in futures:
+                future.result()
+
+    def synthesizeSlide(self, text: str, path: str, model: str, voice: str, instructions: str, retries: int, config: dict) -> None:
+        attempt = 0
+        while True:
+            try:
+                getLLMGateway().speech(model, voice, text, instructions, path, processor="tts", config=config)
+                return
+            except Exception as e:
+                if attempt >= retries:
+                    raise
+                # exponential backoff with jitter, so concurrent retries spread out
+                delay = (2 ** attempt) + random.uniform(0, 1)
+                print(f"Speech request for {path} failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+
+    # Encodes an image as a video of the given length. Only one frame really changes, so
+    # with the stillimage tuning this costs little more than encoding the image once.
+    def encodeStillSegment(self, image: str, duration: float, path: str, fps: int, preset: str) -> None:
+        self.runFfmpeg([
+            "-loop", "1", "-framerate", str(fps), "-i", image,
+            "-t", f"{duration:.3f}",
+            "-c:v", "libx264", "-preset", preset, "-tune", "stillimage",
+            # x264 needs even dimensions
+            "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2",
+            "-pix_fmt", "yuv420p", "-r", str(fps),
+            path,
+        ])
+
+    # Joins segments encoded with the same settings without re-encoding them, and adds the audio
+    def concatenateSegments(self, segments: List[str], audio: str, path: str, tempdir: str) -> None:
+        list_path = f"{tempdir}/segments.txt"
+        with open(list_path, "w") as file:
+            for segment in segments:
+                file.write(f"file '{os.path.abspath(segment)}'\n")
+        self.runFfmpeg([
+            "-f", "concat", "-safe", "0", "-i", list_path,
+            "-i", audio,
+            "-map", "0:v", "-map", "1:a",
+            "-c:v", "copy", "-c:a", "aac",
+            "-movflags", "+faststart",
+            path,
+        ])
+
+    def writeWav(self, path: str, pcm: bytes) -> None:
+        with wave.open(path, "wb") as file:
+            file.setnchannels(1)
+            file.setsampwidth(SAMPLE_WIDTH)
+            file.setframerate(SAMPLE_RATE)
+            file.writeframes(pcm)
+
+    def runFfmpeg(self, arguments: List[str]) -> None:
+        result = subprocess.run(["ffmpeg", "-y", "-loglevel", "error"] + arguments, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed: {result.stderr.strip()}")
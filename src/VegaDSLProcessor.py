@@ -1,12 +1,17 @@
 from dslProcessor import BasicDSLProcessor, PreprocessedDSL
 from programs import ProgramOutput, ProgramDirectory, TracerNode
-from typing import List, Any, Optional
+from lruCache import LRUCache
+from vegaPreaggregation import preaggregateSpec
+from typing import List, Any, Optional, Union
 import time
 import base64
+import hashlib
 import altair as alt
 import json
-import uuid
-import os
+import vl_convert as vlc
+
+# Rendered charts by (spec hash, format), bounded by their size
+renderedCharts = LRUCache(maxEntries=512, maxBytes=256 * 1024 * 1024, sizeOf=len)
 
 # VegaDSLProcessor is a DSL processor for the Vega DSL
 class VegaDSLProcessor(PreprocessedDSL):
@@ -15,75 +20,73 @@ class VegaDSLProcessor(PreprocessedDSL):
 
     def getVisualReturnTypes(self) -> List[str]:
         return ["png", "html","svg","pdf","json","md"]
-    
+
     def getIncludableTypes(self) -> List[str]:
         return ["html", "png"]
-    
+
     def postprocess(self, processedCode: str, processedOutputState: dict, input: dict, outputNames: List[str], preferredVisualReturnType: str, config: dict,tracer: Optional[TracerNode] = None) -> ProgramOutput:
         code = processedCode
         chart_json = json.loads(str(code))
-        
+
         # just want json, so we can be done
         if preferredVisualReturnType == "json":
             return ProgramOutput(time.time(), "json", chart_json, {})
-        
-        # make the chart
-        chart = alt.Chart.from_json(json.dumps(chart_json))
-
-        # create a guid 
-        guid = str(uuid.uuid4())
-        binary_data = None
 
-        if preferredVisualReturnType == "html":
-            chart.save(f"{guid}.out",format="html")
-        elif preferredVisualReturnType == "png":
-            chart.save(f"{guid}.out",format="png")
-        elif preferredVisualReturnType == "svg":
-            chart.save(f"{guid}.out",format="svg")
-        elif preferredVisualReturnType == "pdf":
-            chart.save(f"{guid}.out",format="pdf")
-        elif preferredVisualReturnType == "md":
-            chart.save(f"{guid}.out",format="png")
-        else:
+        if preferredVisualReturnType not in self.getVisualReturnTypes():
             raise ValueError(f"Invalid visual return type: {preferredVisualReturnType}")
 
-        # load the binary data from the file {guid}.out
-        with open(f"{guid}.out", "rb") as file:
-            binary_data = file.read()
-
-        
+        if self.shouldPreaggregate(chart_json, config):
+            reduced = preaggregateSpec(chart_json)
+            if reduced is not None:
+                chart_json = reduced
 
-        # remove the guid file {guid}.out if it exists
-        if os.path.exists(f"{guid}.out"):
-            #os.remove(f"{guid}.out")
-            pass
+        # md embeds the png rendering
+        format = "png" if preferredVisualReturnType == "md" else preferredVisualReturnType
+        data = self.renderChart(chart_json, format)
 
         outputData = {}
 
-        if preferredVisualReturnType == "html":
-            # create a text_data version
-            text_data = binary_data.decode('utf-8')
-            return ProgramOutput(time.time(), "html", text_data, {})
-        elif preferredVisualReturnType == "png":
-            return ProgramOutput(time.time(), "png", binary_data, {})
-        elif preferredVisualReturnType == "svg":
-            text_data = binary_data.decode('utf-8')
-            return ProgramOutput(time.time(), "svg", text_data, {})
-        elif preferredVisualReturnType == "pdf":
-            return ProgramOutput(time.time(), "pdf", binary_data, {})
-        elif preferredVisualReturnType == "md":
-            image_data = base64.b64encode(binary_data).decode('utf-8')
+        if preferredVisualReturnType == "md":
+            image_data = base64.b64encode(data).decode('utf-8')
             return ProgramOutput(time.time(), "md", f"![Image](data:image/png;base64,{image_data})", outputData)
+        return ProgramOutput(time.time(), preferredVisualReturnType, data, outputData)
+
+    # Inline datasets are aggregated here rather than in the browser when the config asks
+    # for it with preaggregate: true, or by default once they reach preaggregateRows rows
+    def shouldPreaggregate(self, chart_json: dict, config: dict) -> bool:
+        config = config if config is not None else {}
+        preaggregate = config.get("preaggregate", "auto")
+        if preaggregate != "auto":
+            return bool(preaggregate)
+        data = chart_json.get("data") if isinstance(chart_json, dict) else None
+        values = data.get("values") if isinstance(data, dict) else None
+        return isinstance(values, list) and len(values) >= int(config.get("preaggregateRows", 5000))
+
+    # Renders a chart in memory, reusing an earlier rendering of the same spec and format.
+    # Returns text for html and svg and bytes for png and pdf.
+    def renderChart(self, chart_json: dict, format: str) -> Union[str, bytes]:
+        # Canonical JSON, so key order and whitespace in the source do not matter
+        canonical = json.dumps(chart_json, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        key = (hashlib.sha256(canonical.encode("utf-8")).hexdigest(), format)
+        cached = renderedCharts.get(key)
+        if cached is not None:
+            return cached
+
+        # altair validates the spec and fills in its defaults
+        chart = alt.Chart.from_json(canonical)
+        if format == "html":
+            data = chart.to_html()
         else:
-            raise ValueError(f"Invalid visual return type: {preferredVisualReturnType}")
-        
-
-
-
-
-        
-
-
-
-
-
+            spec = chart.to_dict()
+            vl_version = "_".join(alt.SCHEMA_VERSION.split(".")[:2])
+            if format == "png":
+                data = vlc.vegalite_to_png(spec, vl_version=vl_version)
+            elif format == "svg":
+                data = vlc.vegalite_to_svg(spec, vl_version=vl_version)
+            elif format == "pdf":
+                data = vlc.vegalite_to_pdf(spec, vl_version=vl_version)
+            else:
+                raise ValueError(f"Invalid visual return type: {format}")
+
+        renderedCharts.put(key, data)
+        return data
@@ -1,11 +1,10 @@
+from clientProvider import ClientProvider, getClientProvider
 from dslProcessor import PreprocessedDSL
-from programs import ProgramOutput, ProgramDirectory, TracerNode
+from programs import NamedProgram, ProgramOutput, ProgramDirectory, TracerNode
 from typing import List, Any, Optional
 import os
 import time
 import base64
-import requests
-from dotenv import dotenv_values
 
 class AIImageProcessor(PreprocessedDSL):
     def __init__(self, programDirectory: ProgramDirectory):
@@ -18,6 +17,10 @@ class AIImageProcessor(PreprocessedDSL):
     def getIncludableTypes(self) -> List[str]:
         return ["html"]
 
+    def getIncludedProgramNames(self, program: NamedProgram) -> Optional[List[str]]:
+        # Every run generates a new image, so results are never result cached
+        return None
+
     def postprocess(self, processedCode: str, processedOutputState: dict, input: dict, outputNames: List[str], preferredVisualReturnType: str, config:dict,tracer: Optional[TracerNode] = None) -> ProgramOutput:
         size = input["size"] if "size" in input else "large"
         if size == "small":
@@ -35,15 +38,8 @@ class AIImageProcessor(PreprocessedDSL):
         # trim whitespace from the code
         code = processedCode.strip()
         print(f"Generating a {horizontalSize}x{verticalSize} image for prompt: {code}")
-        import requests
-
-        api_key = None
-        if os.path.exists(".env"):
-            env = dotenv_values(".env")
-            api_key = env["OPENAI_API_KEY"]
-        else:
-            api_key = os.getenv("OPENAI_API_KEY")
-
+        provider = getClientProvider()
+        api_key = provider.getApiKey()
         if not api_key:
             raise ValueError("OPENAI_API_KEY environment variable not set")
 
@@ -60,10 +56,12 @@ class AIImageProcessor(PreprocessedDSL):
             "response_format": "b64_json"
         }
 
-        response = requests.post(
+        # the shared session keeps the connection to the API open between images
+        response = provider.getSession("aiImage", config).post(
             "https://api.openai.com/v1/images/generations",
             headers=headers,
-            json=data
+            json=data,
+            timeout=ClientProvider.getSettings("aiImage", config)["timeout"]
         )
 
         if response.status_code != 200:
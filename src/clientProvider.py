@@ -0,0 +1,125 @@
+from typing import Any, Optional
+import os
+import threading
+
+# HTTP/2 needs the h2 package; without it the pools speak HTTP/1.1 with keep-alive
+try:
+    import h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Timeouts (seconds) and retries of each kind of caller. An itom can override them with
+# requestTimeout and requestRetries in its config.
+PROCESSOR_SETTINGS = {
+    "llm": {"timeout": 120, "maxRetries": 2},
+    "placeholder": {"timeout": 180, "maxRetries": 2},
+    # SlideVideoDSLProcessor retries speech itself, with backoff (ttsRetries)
+    "tts": {"timeout": 300, "maxRetries": 0},
+    "aiImage": {"timeout": 180, "maxRetries": 2},
+    "inferInputs": {"timeout": 60, "maxRetries": 2},
+}
+
+MAX_CONNECTIONS = 32
+KEEPALIVE_EXPIRY = 60
+
+
+# ClientProvider owns the process-wide HTTP connection pools used to talk to the OpenAI
+# API: one for the OpenAI client, one for the AsyncOpenAI client used by the LLM gateway
+# and a requests Session for plain HTTP calls. Credentials are read from .env (or the
+# environment) once. Callers get views of the shared clients with their own timeout and
+# retries, so every request reuses warm keep-alive connections.
+class ClientProvider:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.apiKey = None
+        self.credentialsLoaded = False
+        self.openai = None
+        self.asyncOpenai = None
+        self.sessions = {}
+
+    def getApiKey(self) -> Optional[str]:
+        with self.lock:
+            if not self.credentialsLoaded:
+                self.apiKey = self.__loadApiKey__()
+                self.credentialsLoaded = True
+            return self.apiKey
+
+    @classmethod
+    def getSettings(cls, processor: str, config: Optional[dict] = None) -> dict:
+        settings = dict(PROCESSOR_SETTINGS.get(processor, {"timeout": 120, "maxRetries": 2}))
+        if config is not None:
+            if "requestTimeout" in config:
+                settings["timeout"] = float(config["requestTimeout"])
+            if "requestRetries" in config:
+                settings["maxRetries"] = int(config["requestRetries"])
+        return settings
+
+    def getOpenAI(self, processor: str, config: Optional[dict] = None) -> Any:
+        apiKey = self.getApiKey()
+        with self.lock:
+            if self.openai is None:
+                import httpx
+                from openai import OpenAI
+                self.openai = OpenAI(api_key=apiKey, http_client=httpx.Client(http2=HTTP2_AVAILABLE, limits=self.__limits__()))
+            client = self.openai
+        settings = self.getSettings(processor, config)
+        return client.with_options(timeout=settings["timeout"], max_retries=settings["maxRetries"])
+
+    # The AsyncOpenAI client is bound to the event loop it is first used on, which is the
+    # loop of the LLM gateway
+    def getAsyncOpenAI(self, processor: Optional[str] = None, config: Optional[dict] = None) -> Any:
+        apiKey = self.getApiKey()
+        with self.lock:
+            if self.asyncOpenai is None:
+                import httpx
+                from openai import AsyncOpenAI
+                self.asyncOpenai = AsyncOpenAI(api_key=apiKey, http_client=httpx.AsyncClient(http2=HTTP2_AVAILABLE, limits=self.__limits__()))
+            client = self.asyncOpenai
+        if processor is None:
+            return client
+        settings = self.getSettings(processor, config)
+        return client.with_options(timeout=settings["timeout"], max_retries=settings["maxRetries"])
+
+    # A pooled requests Session that retries failed requests with backoff. requests has no
+    # timeout on the session, so pass getSettings(processor)["timeout"] with each call.
+    def getSession(self, processor: str, config: Optional[dict] = None) -> Any:
+        retries = self.getSettings(processor, config)["maxRetries"]
+        with self.lock:
+            session = self.sessions.get(retries)
+            if session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+                retry = Retry(total=retries, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+                              allowed_methods=None, respect_retry_after_header=True, raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_CONNECTIONS, max_retries=retry)
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self.sessions[retries] = session
+            return session
+
+    def __limits__(self) -> Any:
+        import httpx
+        return httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS, keepalive_expiry=KEEPALIVE_EXPIRY)
+
+    def __loadApiKey__(self) -> Optional[str]:
+        # if .env exists, load it
+        if os.path.exists(".env"):
+            from dotenv import dotenv_values
+            env = dotenv_values(".env")
+            if env.get("OPENAI_API_KEY"):
+                return env["OPENAI_API_KEY"]
+        return os.getenv("OPENAI_API_KEY")
+
+
+clientProvider = None
+clientProviderLock = threading.Lock()
+
+def getClientProvider() -> ClientProvider:
+    global clientProvider
+    with clientProviderLock:
+        if clientProvider is None:
+            clientProvider = ClientProvider()
+        return clientProvider
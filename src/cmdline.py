@@ -47,7 +47,7 @@ def runProgram(programDirectory: ProgramDirectory, programExecutor: ProgramExecu
     return(root)
 
 def status(programDirectory: ProgramDirectory):
-    programs = programDirectory.getPrograms()
+    programs = programDirectory.getProgramSummaries()
     print(f"Number of available programs: {len(programs)}")
     for i, program in enumerate(programs):
         print(f"{i+1}. {program.name}: {program.description}")
@@ -3,9 +3,15 @@ import time, os, base64
 import re
 from typing import Optional, List, Tuple, Any
 import markdown as mdlib
+import contextvars
 import copy
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from lruCache import LRUCache
 from bs4 import BeautifulSoup
-from playwright.sync_api import sync_playwright
+from renderPool import renderHtmlToPng
 
 # DSLProcessor is a generic superclass for all DSL processors
 class DSLProcessor:
@@ -20,29 +26,80 @@ class DSLProcessor:
 
     def getIncludes(self, program:NamedProgram, kwargs:list[str]=[]) -> ItomIncludeTree:
         raise NotImplementedError("DSLProcessor is an abstract class and cannot be instantiated directly")
-    
+
+    # Returns the names of the programs directly included by the program, or None
+    # if they cannot be determined statically (in which case results are not cached)
+    def getIncludedProgramNames(self, program: NamedProgram) -> Optional[List[str]]:
+        return []
+
     def runProgram(self, program: NamedProgram, input: ProgramInput, preferredVisualReturnType, config:dict,tracer: Optional[TracerNode] = None) -> ProgramOutput:
         # Create pair of input and empty output
         if tracer is not None:
             tracer.start(input)
         latestCode = program.codeVersions[-1]
-        latestExecutionHistory = program.executions[-1]
         programOutput = self.process(latestCode, input["inputs"], program.outputs, preferredVisualReturnType, config,tracer)
         if tracer is not None:
             tracer.end(programOutput)
-        latestExecutionHistory.append((input, programOutput))
         return programOutput
 
 class PreprocessedDSL(DSLProcessor):
+    # Macros available to every itom through the macros global
+    MACRO_TEXT = """
+        {% macro render_grid(spans) %}
+        {% set columnCount = spans | sum %}
+        {% set cell_list = caller().split('::cell') %}
+        <div class="grid" style="display: grid; grid-template-columns: repeat({{columnCount}}, 1fr); gap: 0.25em;">    
+            {% for cell in cell_list %}
+        <div class="cell" style="grid-column: span {{spans[loop.index0 % spans|length]}}; display: flex; align-items: center; justify-content: center; text-align: center">
+        {{ cell | trim }}
+        </div>
+            {% endfor %}
+        </div>
+        {% endmacro %}
+
+        {% macro panel() %}
+        <div class="panel">    
+        {{ caller() }}
+        </div>
+        {% endmacro %}
+        """
+
     def __init__(self, programDirectory: ProgramDirectory):
         super().__init__()
         self.programDirectory = programDirectory
+        # One long-lived Jinja environment per processor, and compiled templates by code hash
+        self.jinjaEnvironment = None
+        self.jinjaLock = threading.Lock()
+        self.templateCache = LRUCache(maxEntries=256)
+
+    def getJinjaEnvironment(self):
+        from jinja2 import Environment, BaseLoader
+
+        with self.jinjaLock:
+            if self.jinjaEnvironment is None:
+                env = Environment(loader=BaseLoader)
+                env.globals["macros"] = env.from_string(self.MACRO_TEXT).module
+                self.jinjaEnvironment = env
+            return self.jinjaEnvironment
+
+    # Returns the compiled template for the code along with its prefetchable includes.
+    # Per-render state (inputs, include, return) is passed as render context, never
+    # stored on the environment, so compiled templates can be shared between threads.
+    def getCompiledTemplate(self, code: str) -> Tuple[Any, List[Tuple[str, dict]]]:
+        key = hashlib.sha256(code.encode()).hexdigest()
+        entry = self.templateCache.get(key)
+        if entry is None:
+            env = self.getJinjaEnvironment()
+            tree = env.parse(code)
+            includes = self.findPrefetchableIncludes(tree)
+            entry = (env.from_string(tree), includes)
+            self.templateCache.put(key, entry)
+        return entry
 
     def getIncludableTypes(self) -> List[str]:
         raise NotImplementedError("PreprocessedDSL is an abstract class and cannot be instantiated directly")
 
     def process(self, code: str, input: dict, outputNames: List[str], preferredVisualReturnType: str, config:dict,tracer: Optional[TracerNode] = None) -> ProgramOutput:
-        self.tracer = tracer
         processedCode, processedOutput = self.preprocess(code, input, outputNames, preferredVisualReturnType, config,tracer)
         output = self.postprocess(processedCode, processedOutput, input, outputNames, preferredVisualReturnType, config,tracer)
         return output
@@ -51,11 +108,9 @@ class PreprocessedDSL(DSLProcessor):
         raise NotImplementedError("PreprocessedDSL is an abstract class and cannot be instantiated directly")
 
     def getIncludes(self, program:NamedProgram, kwargs:list[str]=[]) -> ItomIncludeTree:
-        from jinja2 import Environment, BaseLoader
         from jinja2.nodes import Call, Name,Const
 
-        env = Environment(loader=BaseLoader)
-        tree = env.parse(program.codeVersions[-1])
+        tree = self.getJinjaEnvironment().parse(program.codeVersions[-1])
 
         # find all call nodes
         
@@ -87,35 +142,134 @@ class PreprocessedDSL(DSLProcessor):
                     continue
         return itomIncludeTree
 
+    def getIncludedProgramNames(self, program: NamedProgram) -> Optional[List[str]]:
+        from jinja2.nodes import Call, Name, Const
+
+        tree = self.getJinjaEnvironment().parse(program.codeVersions[-1])
+
+        includedNames = []
+        for node in tree.find_all(Call):
+            if isinstance(node.node, Name) and node.node.name == "include":
+                if len(node.args) == 0 or not isinstance(node.args[0], Const):
+                    # The included program is computed at render time
+                    return None
+                includedNames.append(node.args[0].value)
+        return includedNames
+
+    # Matches the provided include arguments against the inputs of the included program.
+    # Returns the module inputs, or an error message if a required input is missing.
+    def resolveModuleInputs(self, program: NamedProgram, providedInputs: dict, warn: bool = True) -> Tuple[Optional[dict], Optional[str]]:
+        moduleInputs = {}
+        for inputName in program.inputs.keys():
+            if inputName not in providedInputs:
+                return None, "ERROR: includeFn could not find input: " + inputName
+            moduleInputs[inputName] = providedInputs[inputName]
+        for inputName in providedInputs:
+            # add any extra inputs to the module inputs
+            if inputName not in moduleInputs:
+                # print a warning that an input was used that was
+                # not provided
+                if warn:
+                    print(f"WARNING: input {inputName} in include but not in {program.name} itom")
+                moduleInputs[inputName] = providedInputs[inputName]
+        return moduleInputs, None
+
+    # Executes an included program, returning the visual type that was requested and the output
+    def executeInclude(self, program: NamedProgram, moduleInputs: dict, tracer: Optional[TracerNode] = None) -> Tuple[str, ProgramOutput]:
+        # Reuse the executor (and its already constructed processors) for includes
+        executor = self.programDirectory.getProgramExecutor()
+        if executor is None:
+            from programExecutor import ProgramExecutor
+            executor = ProgramExecutor(self.programDirectory)
+
+        #
+        # IN THIS LOCATION, FIGURE OUT WHAT DATA TYPE TO ASK FOR
+        #
+        includedModuleReturnTypes = executor.getVisualReturnTypesForProgram(program)
+        if len(includedModuleReturnTypes) == 0:
+            raise ValueError(f"ERROR: included program {program.name} cannot return any of the includable types: {self.getIncludableTypes()}")
+
+        targetReturnType = includedModuleReturnTypes[0]
+
+        programOutput = executor.executeProgram(program.name, 
+                                                {"startTimestamp": time.time(), 
+                                                "inputs": moduleInputs}, 
+                                                targetReturnType,
+                                                config=program.config,
+                                                parentTracer=tracer)
+        return targetReturnType, programOutput
+
+    @classmethod
+    def includeKey(cls, programName: str, moduleInputs: dict) -> str:
+        return programName + ":" + json.dumps(moduleInputs, sort_keys=True, default=str)
+
+    # Finds include calls whose program name and arguments are all constants, and that are
+    # guaranteed to run when the template is rendered (i.e. not inside a conditional, loop
+    # or macro definition). Returns a list of (programName, kwargs) pairs in source order.
+    @classmethod
+    def findPrefetchableIncludes(cls, tree) -> List[Tuple[str, dict]]:
+        from jinja2 import nodes
+
+        conditionalNodes = (nodes.If, nodes.CondExpr, nodes.For, nodes.Macro, nodes.And, nodes.Or)
+        includes = []
+
+        def visit(node):
+            if isinstance(node, conditionalNodes):
+                return
+            if isinstance(node, nodes.Call) and isinstance(node.node, nodes.Name) and node.node.name == "include":
+                if len(node.args) > 0 and isinstance(node.args[0], nodes.Const) and node.dyn_args is None and node.dyn_kwargs is None:
+                    try:
+                        kwargs = {kwarg.key: kwarg.value.as_const() for kwarg in node.kwargs}
+                        includes.append((node.args[0].value, kwargs))
+                    except Exception:
+                        # At least one argument is computed at render time
+                        pass
+            for child in node.iter_child_nodes():
+                visit(child)
+
+        visit(tree)
+        return includes
+
+    # Starts executing the statically known includes on a thread pool before the template
+    # is rendered, so that independent includes run concurrently. Returns the thread pool
+    # (or None) and a map from include key to future.
+    def prefetchIncludes(self, includes: List[Tuple[str, dict]], config: dict, tracer: Optional[TracerNode] = None) -> Tuple[Optional[ThreadPoolExecutor], dict]:
+        prefetched = {}
+        if not config.get("prefetchIncludes", True):
+            return None, prefetched
+
+        toRun = []
+        for programName, kwargs in includes:
+            try:
+                program = self.programDirectory.getProgram(programName)
+            except ValueError:
+                continue
+            moduleInputs, error = self.resolveModuleInputs(program, kwargs, warn=False)
+            if error is not None:
+                continue
+            key = self.includeKey(programName, moduleInputs)
+            if key not in prefetched:
+                prefetched[key] = None
+                toRun.append((key, program, moduleInputs))
+
+        # Nothing to gain from a thread pool for a single include
+        if len(toRun) < 2:
+            return None, {}
+
+        pool = ThreadPoolExecutor(max_workers=min(len(toRun), config.get("prefetchWorkers", 8)))
+        for key, program, moduleInputs in toRun:
+            # Copy the context so that includes see the same stream sink as the render
+            prefetched[key] = pool.submit(contextvars.copy_context().run, self.executeInclude, program, moduleInputs, tracer)
+        return pool, prefetched
+
 
     def preprocess(self, code: str, input: dict, outputNames: List[str], preferredVisualReturnType: str, config:dict,tracer: Optional[TracerNode] = None) -> Tuple[str, dict]:
         # Use Jinja to process the document
-        from jinja2 import Environment, BaseLoader, pass_context
+        from jinja2 import pass_context
 
-        self.tracer = tracer
         outputState = {}
         inputState = copy.deepcopy(input)
-        env = Environment(loader=BaseLoader)
-
-        macroText = """
-        {% macro render_grid(spans) %}
-        {% set columnCount = spans | sum %}
-        {% set cell_list = caller().split('::cell') %}
-        <div class="grid" style="display: grid; grid-template-columns: repeat({{columnCount}}, 1fr); gap: 0.25em;">    
-            {% for cell in cell_list %}
-        <div class="cell" style="grid-column: span {{spans[loop.index0 % spans|length]}}; display: flex; align-items: center; justify-content: center; text-align: center">
-        {{ cell | trim }}
-        </div>
-            {% endfor %}
-        </div>
-        {% endmacro %}
-
-        {% macro panel() %}
-        <div class="panel">    
-        {{ caller() }}
-        </div>
-        {% endmacro %}
-        """
+        template, includes = self.getCompiledTemplate(code)
 
         # The return_variable function is used to return results from a module invocation
         @pass_context
@@ -138,41 +292,18 @@ class PreprocessedDSL(DSLProcessor):
                 return dict(error="ERROR: includeFn could not find program: " + programName,
                             succeeded=False)
 
-            moduleInputs = {}
-            providedInputs = dict(kwargs)
-            for inputName in program.inputs.keys():
-                if inputName not in providedInputs:
-                    return dict(error="ERROR: includeFn could not find input: " + inputName,
-                                succeeded=False)
-                moduleInputs[inputName] = providedInputs[inputName]
-            for inputName in providedInputs:
-                # add any extra inputs to the module inputs
-                if inputName not in moduleInputs:
-                    # print a warning that an input was used that was
-                    # not provided
-                    print(f"WARNING: input {inputName} in include but not in {programName} itom")
-                    moduleInputs[inputName] = providedInputs[inputName]
-                    
+            moduleInputs, error = self.resolveModuleInputs(program, dict(kwargs))
+            if error is not None:
+                return dict(error=error,
+                            succeeded=False)
 
-            from programExecutor import ProgramExecutor
+            # Wait for the include if it was prefetched, otherwise run it now
+            future = prefetched.get(self.includeKey(programName, moduleInputs))
+            if future is not None:
+                targetReturnType, programOutput = future.result()
+            else:
+                targetReturnType, programOutput = self.executeInclude(program, moduleInputs, tracer)
 
-            #
-            # IN THIS LOCATION, FIGURE OUT WHAT DATA TYPE TO ASK FOR
-            #
-            executor = ProgramExecutor(self.programDirectory)
-            includedModuleReturnTypes = executor.getVisualReturnTypesForProgram(program)
-            if len(includedModuleReturnTypes) == 0:
-                raise ValueError(f"ERROR: included program {programName} cannot return any of the includable types: {self.getIncludableTypes()}")
-            
-
-            targetReturnType = includedModuleReturnTypes[0]
-
-            programOutput = executor.executeProgram(programName, 
-                                                    {"startTimestamp": time.time(), 
-                                                    "inputs": moduleInputs}, 
-                                                    targetReturnType,
-                                                    config=program.config,
-                                                    parentTracer=self.tracer)
             if not programOutput.succeeded():
                 return dict(error="ERROR: program " + programName + " failed with message: " + programOutput.errorMessage(),
                             succeeded=False)
@@ -209,21 +340,21 @@ class PreprocessedDSL(DSLProcessor):
                             visual=visualStringRepr,
                             succeeded=True)
 
-        # Register the new functions
-        env.globals["include"] = includeFn
-        env.globals["return"] = return_variable
-        env.globals["macros"] = env.from_string(macroText).module
-
-        # Register the input variables
+        # Build the render context: the new functions, then the input variables
+        context = {"include": includeFn, "return": return_variable}
         for inputName, v in inputState.items():
-            env.globals[inputName] = v
+            context[inputName] = v
+        context["__outputs"] = outputNames
+
+        # Start the independent includes before rendering
+        pool, prefetched = self.prefetchIncludes(includes, config, tracer)
 
-        env.globals["__outputs"] = outputNames
-        
         # Render the template
-        template = env.from_string(code)
-        
-        outputText = template.render()
+        try:
+            outputText = template.render(context)
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=False)
         return outputText, outputState
 
 
@@ -291,13 +422,8 @@ class BasicDSLProcessor(PreprocessedDSL):
         elif preferredVisualReturnType == "md":
             return ProgramOutput(time.time(), "md", processedCode, processedOutputState)
         elif preferredVisualReturnType == "png":
-            with sync_playwright() as p:
-                browser = p.chromium.launch()
-                page = browser.new_page()
-                page.set_content(html)
-                png_bytes = page.screenshot(full_page=True, type="png")
-                browser.close()
-                return ProgramOutput(time.time(), "png", png_bytes, processedOutputState)
+            png_bytes = renderHtmlToPng(html)
+            return ProgramOutput(time.time(), "png", png_bytes, processedOutputState)
         else:
             raise ValueError(f"Invalid visual return type: {preferredVisualReturnType}")
 
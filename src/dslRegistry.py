@@ -0,0 +1,98 @@
+from programs import ProgramDirectory
+from dslProcessor import DSLProcessor
+from importlib import import_module
+from typing import Callable, List, Union
+import threading
+
+
+# The built-in DSL processors, as dslId -> (module, class name). A module is only
+# imported the first time a program with that dsl is executed, so that e.g. a basic
+# itom does not pay for importing the video and JavaScript engines.
+BUILTIN_DSL_PROCESSORS = {
+    "aiimage": ("aiImageDslProcessor", "AIImageProcessor"),
+    "spreadsheet": ("spreadsheetDslProcessor", "SpreadsheetDSLProcessor"),
+    "vega-lite": ("VegaDSLProcessor", "VegaDSLProcessor"),
+    "javascript": ("JavascriptDSLProcessor", "JavascriptDSLProcessor"),
+    "basic": ("dslProcessor", "BasicDSLProcessor"),
+    "slidevideo": ("SlideVideoDSLProcessor", "SlideVideoDSLProcessor"),
+    "slides": ("SlideDSLProcessor", "SlideDSLProcessor"),
+    "placeholder": ("PlaceHolderDSLProcessor", "PlaceHolderDSLProcessor"),
+    "python": ("PythonDSLProcessor", "PythonDSLProcessor"),
+    "llm": ("LLMDSLProcessor", "LLMDSLProcessor")
+}
+
+# Third-party processors register under this entry point group, e.g. in pyproject.toml:
+#   [project.entry-points."itomsmasher.dsl_processors"]
+#   mydsl = "mypackage.mymodule:MyDSLProcessor"
+# The entry point name is the dsl id, and the object must be a DSLProcessor subclass
+# whose constructor takes the ProgramDirectory.
+ENTRY_POINT_GROUP = "itomsmasher.dsl_processors"
+
+
+# DSLRegistry maps dsl ids to processors, importing and constructing each processor
+# only when it is first needed
+class DSLRegistry:
+    def __init__(self, programDirectory: ProgramDirectory):
+        self.programDirectory = programDirectory
+        self.loaders = {}
+        self.processors = {}
+        self.entryPointsLoaded = False
+        self.lock = threading.RLock()
+
+        for dslId, (moduleName, className) in BUILTIN_DSL_PROCESSORS.items():
+            self.register(dslId, f"{moduleName}:{className}")
+
+    # Registers a processor class, or a "module:ClassName" string to import on first use
+    def register(self, dslId: str, processor: Union[str, type]) -> None:
+        with self.lock:
+            if isinstance(processor, str):
+                moduleName, className = processor.split(":")
+                self.loaders[dslId] = lambda: getattr(import_module(moduleName), className)
+            else:
+                self.loaders[dslId] = lambda: processor
+            self.processors.pop(dslId, None)
+
+    def getDSLIds(self) -> List[str]:
+        with self.lock:
+            self.__loadEntryPoints__()
+            return list(self.loaders.keys())
+
+    def hasDSL(self, dslId: str) -> bool:
+        with self.lock:
+            if dslId not in self.loaders:
+                self.__loadEntryPoints__()
+            return dslId in self.loaders
+
+    def get(self, dslId: str) -> DSLProcessor:
+        with self.lock:
+            if dslId in self.processors:
+                return self.processors[dslId]
+            if not self.hasDSL(dslId):
+                raise ValueError(f"DSL processor {dslId} not found")
+            processorClass = self.loaders[dslId]()
+            processor = processorClass(self.programDirectory)
+            self.processors[dslId] = processor
+            return processor
+
+    def __loadEntryPoints__(self) -> None:
+        # Entry points are only scanned when an unknown dsl id is requested
+        if self.entryPointsLoaded:
+            return
+        self.entryPointsLoaded = True
+
+        from importlib.metadata import entry_points
+        try:
+            discovered = entry_points(group=ENTRY_POINT_GROUP)
+        except Exception as e:
+            print(f"WARNING: could not load DSL processor entry points: {e}")
+            return
+
+        for entryPoint in discovered:
+            if entryPoint.name in self.loaders:
+                print(f"WARNING: DSL processor {entryPoint.name} from {entryPoint.value} is already registered")
+                continue
+            self.loaders[entryPoint.name] = self.__entryPointLoader__(entryPoint)
+
+    @classmethod
+    def __entryPointLoader__(cls, entryPoint) -> Callable[[], type]:
+        return lambda: entryPoint.load()
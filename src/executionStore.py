@@ -0,0 +1,256 @@
+from collections import Counter, defaultdict
+from typing import Optional, List, Tuple, Any
+import atexit
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+
+# ExecutionStore keeps the execution history of every program outside of program.json.
+# Each execution is one row of metadata in an append-only SQLite table; the visual
+# output is stored once per distinct content in a content-addressed blob directory.
+# Old records are pruned by count and by age, per program, every pruneEvery records of
+# that program, so a program may briefly hold a few more records than the limit.
+# Executions are usually handed to submit, which records them on a background thread so
+# renders never wait for the disk; reads wait for the submitted records first.
+class ExecutionStore:
+    def __init__(self, storeDir: str, maxRecordsPerProgram: Optional[int] = 100, maxAgeDays: Optional[float] = 30, pruneEvery: int = 20):
+        self.dbPath = os.path.join(storeDir, ".executions.sqlite")
+        self.blobDir = os.path.join(storeDir, ".blobs")
+        self.maxRecordsPerProgram = maxRecordsPerProgram
+        self.maxAgeDays = maxAgeDays
+        self.pruneEvery = max(1, pruneEvery)
+        self.lock = threading.Lock()
+        # Blobs being written whose rows are not inserted yet; pruning leaves them alone
+        self.pendingHashes = Counter()
+        # program -> records since it was last pruned
+        self.unpruned = defaultdict(int)
+        self.queue = queue.Queue()
+        self.writer = None
+        self.writerLock = threading.Lock()
+
+        self.connection = sqlite3.connect(self.dbPath, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS executions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                program TEXT NOT NULL,
+                codeVersion INTEGER,
+                started REAL,
+                ended REAL,
+                duration REAL,
+                succeeded INTEGER,
+                errorMessage TEXT,
+                inputHash TEXT,
+                inputs TEXT,
+                outputHash TEXT,
+                visualReturnType TEXT,
+                vizEncoding TEXT,
+                data TEXT,
+                cached INTEGER DEFAULT 0
+            )""")
+        # Stores created before cache hits were recorded lack the cached column
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(executions)")]
+        if "cached" not in columns:
+            self.connection.execute("ALTER TABLE executions ADD COLUMN cached INTEGER DEFAULT 0")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS executionsByProgram ON executions (program, started)")
+        self.connection.commit()
+
+    @classmethod
+    def hashInputs(cls, inputs: dict) -> str:
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+    @classmethod
+    def encodeViz(cls, viz: Any) -> Tuple[bytes, str]:
+        if isinstance(viz, bytes):
+            return viz, "bytes"
+        elif isinstance(viz, str):
+            return viz.encode("utf-8"), "text"
+        else:
+            return json.dumps(viz, default=str).encode("utf-8"), "json"
+
+    @classmethod
+    def decodeViz(cls, payload: bytes, vizEncoding: str) -> Any:
+        if vizEncoding == "bytes":
+            return payload
+        elif vizEncoding == "text":
+            return payload.decode("utf-8")
+        else:
+            return json.loads(payload)
+
+    def __blobPath__(self, outputHash: str) -> str:
+        return os.path.join(self.blobDir, outputHash[:2], outputHash)
+
+    def __writeBlob__(self, payload: bytes, outputHash: str) -> None:
+        path = self.__blobPath__(outputHash)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tempPath = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tempPath, "wb") as f:
+                f.write(payload)
+            os.replace(tempPath, path)
+
+    # Queues an execution (same arguments as record) for the background writer
+    def submit(self, *args, **kwargs) -> None:
+        with self.writerLock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.__writeSubmitted__, name="execution-store", daemon=True)
+                self.writer.start()
+                atexit.register(self.flush)
+        self.queue.put((args, kwargs))
+
+    # Waits until every submitted execution is recorded
+    def flush(self) -> None:
+        self.queue.join()
+
+    def __writeSubmitted__(self) -> None:
+        while True:
+            args, kwargs = self.queue.get()
+            try:
+                self.record(*args, **kwargs)
+            except Exception as e:
+                print(f"WARNING: could not record execution of {args[0] if args else kwargs.get('programName')}: {e}")
+            finally:
+                self.queue.task_done()
+
+    # Appends one execution. Pass output=None and an errorMessage for a run that raised,
+    # and cached=True for an output that was served from the result cache.
+    def record(self, programName: str, codeVersion: int, input: dict, output: Optional["ProgramOutput"], started: float, ended: float, errorMessage: str = "", cached: bool = False) -> int:
+        # Everything is encoded and hashed before the lock is taken
+        inputs = json.dumps(input["inputs"], default=str)
+        inputHash = self.hashInputs(input["inputs"])
+        outputHash = None
+        visualReturnType = None
+        vizEncoding = None
+        data = None
+        succeeded = False
+        payload = None
+        if output is not None:
+            payload, vizEncoding = self.encodeViz(output.viz())
+            outputHash = hashlib.sha256(payload).hexdigest()
+            visualReturnType = output.visualReturnType()
+            data = json.dumps(output.data(), default=str)
+            succeeded = output.succeeded()
+            errorMessage = output.errorMessage()
+
+        # The blob is written outside the lock, but marked pending until its row is inserted
+        # so that a concurrent prune does not remove it
+        if outputHash is not None:
+            with self.lock:
+                self.pendingHashes[outputHash] += 1
+        try:
+            if payload is not None:
+                self.__writeBlob__(payload, outputHash)
+            with self.lock:
+                executionId = self.__insert__(programName, codeVersion, inputs, inputHash, started, ended, succeeded, errorMessage,
+                                              outputHash, visualReturnType, vizEncoding, data, cached)
+        finally:
+            if outputHash is not None:
+                with self.lock:
+                    self.pendingHashes[outputHash] -= 1
+                    if self.pendingHashes[outputHash] <= 0:
+                        del self.pendingHashes[outputHash]
+        return executionId
+
+    def __insert__(self, programName: str, codeVersion: int, inputs: str, inputHash: str, started: float, ended: float, succeeded: bool, errorMessage: str,
+                   outputHash: Optional[str], visualReturnType: Optional[str], vizEncoding: Optional[str], data: Optional[str], cached: bool) -> int:
+        # Called with the lock held
+        cursor = self.connection.execute("""
+            INSERT INTO executions
+                (program, codeVersion, started, ended, duration, succeeded, errorMessage, inputHash, inputs, outputHash, visualReturnType, vizEncoding, data, cached)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (programName, codeVersion, started, ended, ended - started, int(succeeded), errorMessage,
+             inputHash, inputs, outputHash, visualReturnType, vizEncoding, data, int(cached)))
+        self.connection.commit()
+        self.unpruned[programName] += 1
+        if self.unpruned[programName] >= self.pruneEvery:
+            self.__prune__(programName)
+        return cursor.lastrowid
+
+    # Applies the retention policy to one program and removes blobs nobody references
+    def prune(self, programName: str) -> None:
+        with self.lock:
+            self.__prune__(programName)
+
+    def __prune__(self, programName: str) -> None:
+        # Called with the lock held
+        self.unpruned.pop(programName, None)
+        removedHashes = set()
+        if self.maxRecordsPerProgram is not None:
+            rows = self.connection.execute("""
+                SELECT id, outputHash FROM executions WHERE program = ?
+                ORDER BY id DESC LIMIT -1 OFFSET ?""", (programName, self.maxRecordsPerProgram)).fetchall()
+            self.connection.executemany("DELETE FROM executions WHERE id = ?", [(row[0],) for row in rows])
+            removedHashes.update(row[1] for row in rows)
+        if self.maxAgeDays is not None:
+            cutoff = time.time() - self.maxAgeDays * 24 * 3600
+            rows = self.connection.execute("SELECT id, outputHash FROM executions WHERE program = ? AND started < ?", (programName, cutoff)).fetchall()
+            self.connection.executemany("DELETE FROM executions WHERE id = ?", [(row[0],) for row in rows])
+            removedHashes.update(row[1] for row in rows)
+        self.connection.commit()
+
+        for outputHash in removedHashes:
+            if outputHash is None or outputHash in self.pendingHashes:
+                continue
+            stillUsed = self.connection.execute("SELECT 1 FROM executions WHERE outputHash = ? LIMIT 1", (outputHash,)).fetchone()
+            if stillUsed is None:
+                try:
+                    os.remove(self.__blobPath__(outputHash))
+                except FileNotFoundError:
+                    pass
+
+    # Returns the most recent executions of a program as dicts, newest first
+    def query(self, programName: str, limit: int = 50, offset: int = 0, since: Optional[float] = None, succeeded: Optional[bool] = None) -> List[dict]:
+        self.flush()
+        sql = "SELECT * FROM executions WHERE program = ?"
+        params = [programName]
+        if since is not None:
+            sql += " AND started >= ?"
+            params.append(since)
+        if succeeded is not None:
+            sql += " AND succeeded = ?"
+            params.append(int(succeeded))
+        sql += " ORDER BY id DESC LIMIT ? OFFSET ?"
+        params.extend([limit, offset])
+
+        with self.lock:
+            cursor = self.connection.execute(sql, params)
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+        return [self.__rowToRecord__(dict(zip(columns, row))) for row in rows]
+
+    def getRecord(self, executionId: int) -> Optional[dict]:
+        self.flush()
+        with self.lock:
+            cursor = self.connection.execute("SELECT * FROM executions WHERE id = ?", (executionId,))
+            columns = [column[0] for column in cursor.description]
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return self.__rowToRecord__(dict(zip(columns, row)))
+
+    # Loads the full ProgramOutput of an execution, or None if it had no output
+    def loadOutput(self, executionId: int) -> Optional["ProgramOutput"]:
+        # Imported here since programs imports this module
+        from programs import ProgramOutput
+
+        record = self.getRecord(executionId)
+        if record is None or record["outputHash"] is None:
+            return None
+        with open(self.__blobPath__(record["outputHash"]), "rb") as f:
+            viz = self.decodeViz(f.read(), record["vizEncoding"])
+        return ProgramOutput(record["ended"], record["visualReturnType"], viz, record["data"], record["succeeded"], record["errorMessage"])
+
+    @classmethod
+    def __rowToRecord__(cls, row: dict) -> dict:
+        row["succeeded"] = bool(row["succeeded"])
+        row["cached"] = bool(row["cached"])
+        row["inputs"] = json.loads(row["inputs"]) if row["inputs"] is not None else None
+        row["data"] = json.loads(row["data"]) if row["data"] is not None else None
+        return row
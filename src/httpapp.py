@@ -1,12 +1,18 @@
 #! /usr/bin/env python3
 # Implement a basic http app that can be used to serve the itom viewer
 
-from flask import Flask, request, send_file
+from flask import Flask, Response, request, send_file, jsonify
 from programs import ProgramDirectory, ProgramInput
 from programExecutor import ProgramExecutor
+from programWatcher import ProgramWatcher
+from llmCache import getLLMCache
+from streamSink import StreamSink, currentStreamSink
 from jinja2 import Environment, BaseLoader, pass_context
 import io
+import json
+import mimetypes
 import os
+import threading
 import time
 from datetime import datetime
 
@@ -21,7 +27,19 @@ if not os.path.exists(localProgramDir):
 programDirectory = ProgramDirectory(localProgramDir)
 programExecutor = ProgramExecutor(programDirectory)
 
-defaultProgramDict = dict([(p.name, {"name": p.name, "description": p.description, "inputDescription": ",".join(p.inputs)}) for p in programDirectory.getPrograms()])
+def buildDefaultProgramDict() -> dict:
+    return dict([(p.name, {"name": p.name, "description": p.description, "inputDescription": ",".join(p.inputs)}) for p in programDirectory.getProgramSummaries()])
+
+defaultProgramDict = buildDefaultProgramDict()
+
+def onProgramsChanged(programNames):
+    global defaultProgramDict
+    print(f"Programs changed on disk: {', '.join(programNames)}")
+    defaultProgramDict = buildDefaultProgramDict()
+
+# Pick up edits to .programs (e.g. from the command line) without restarting the server
+programDirectory.addChangeListener(onProgramsChanged)
+programWatcher = ProgramWatcher(programDirectory).start()
 
 css = """
     body {
@@ -39,7 +57,7 @@ css = """
 @app.route('/')
 def index():
     # List all available programs
-    programs = programDirectory.getPrograms()
+    programs = programDirectory.getProgramSummaries()
     # Add some CSS style to make the font bigger
     from jinja2 import Environment, BaseLoader, pass_context
 
@@ -112,6 +130,38 @@ def index():
     html = template.render(programs=programs, css=css, cssAppend=cssAppend)
     return html
 
+# MIME types of visual return types that mimetypes does not know (or guesses differently)
+VISUAL_MIME_TYPES = {"html": "text/html", "md": "text/markdown", "json": "application/json", "svg": "image/svg+xml"}
+
+def mime_type_for(visual_return_type):
+    if visual_return_type in VISUAL_MIME_TYPES:
+        return VISUAL_MIME_TYPES[visual_return_type]
+    return mimetypes.guess_type(f"output.{visual_return_type}")[0] or "application/octet-stream"
+
+# Convert string inputs and config to Python types
+# Handle common YAML-style type conversions
+def convert_value(v):
+    if not isinstance(v, str):
+        return v
+    v = v.strip()
+    # Handle booleans
+    if v.lower() == 'true':
+        return True
+    if v.lower() == 'false': 
+        return False
+    # Handle null/None
+    if v.lower() in ('null', 'none', ''):
+        return None
+    # Handle numbers
+    try:
+        if '.' in v:
+            return float(v)
+        return int(v)
+    except ValueError:
+        pass
+    # Keep as string if no other type matches
+    return v
+
 @app.route('/rendered/<program_name>', methods=['POST', 'GET'])
 def rendered(program_name):
     if request.method == 'GET':
@@ -121,30 +171,6 @@ def rendered(program_name):
         inputs = request.json.get('inputs', {})
         config = request.json.get('config', {})
 
-    # Convert string inputs and config to Python types
-    # Handle common YAML-style type conversions
-    def convert_value(v):
-        if not isinstance(v, str):
-            return v
-        v = v.strip()
-        # Handle booleans
-        if v.lower() == 'true':
-            return True
-        if v.lower() == 'false': 
-            return False
-        # Handle null/None
-        if v.lower() in ('null', 'none', ''):
-            return None
-        # Handle numbers
-        try:
-            if '.' in v:
-                return float(v)
-            return int(v)
-        except ValueError:
-            pass
-        # Keep as string if no other type matches
-        return v
-
     inputs = {k: convert_value(v) for k,v in inputs.items()}
     config = {k: convert_value(v) for k,v in config.items()}
 
@@ -153,6 +179,35 @@ def rendered(program_name):
     viz = programOutput.viz()
     return viz
 
+@app.route('/stream/<program_name>')
+def stream_rendered(program_name):
+    """Server-sent events for rendering a program: chunk events with partial LLM output as it
+    arrives, then a done event with the rendered html (or an error event)"""
+    inputs = {k: convert_value(v) for k, v in json.loads(request.args.get('inputs', '{}')).items()}
+    config = {k: convert_value(v) for k, v in json.loads(request.args.get('config', '{}')).items()}
+    sink = StreamSink()
+
+    def render():
+        # The thread starts with an empty context, so the sink only applies to this render
+        currentStreamSink.set(sink)
+        try:
+            programOutput = programExecutor.executeProgram(program_name, ProgramInput(startTimestamp=0, inputs=inputs), preferredVisualReturnType="html", config=config)
+            sink.finish({"html": programOutput.viz()})
+        except Exception as e:
+            sink.fail(str(e))
+
+    threading.Thread(target=render, name=f"stream-{program_name}", daemon=True).start()
+
+    def events():
+        for event, data in sink.events():
+            if event is None:
+                # An SSE comment keeps proxies from closing an idle connection
+                yield ": keep-alive\n\n"
+            else:
+                yield f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/view/<program_name>')
 def view_program(program_name):
     program = programDirectory.getProgram(program_name)
@@ -263,6 +318,7 @@ def view_program(program_name):
     </div>
 
     <script>
+    let currentStream = null;
     document.addEventListener("DOMContentLoaded", function() {
         const codeButton = document.getElementById("codeButton");
         const documentButton = document.getElementById("documentButton");
@@ -287,21 +343,28 @@ def view_program(program_name):
         documentView.style.display = "block";
         codeView.style.display = "none";
 
-        fetch("/rendered/{{program.name}}", {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                inputs: getInputValues(),
-                config: getConfigValues()
-            })
-        })
-        .then(response => {
-            if (!response.ok) throw new Error("Failed to load document");
-            return response.text();
-        })
-        .then(html => {
+        // Stream the render, showing LLM output as it arrives until the document is done
+        if (currentStream) currentStream.close();
+        const params = new URLSearchParams({
+            inputs: JSON.stringify(getInputValues()),
+            config: JSON.stringify(getConfigValues())
+        });
+        const stream = new EventSource("/stream/{{program.name}}?" + params.toString());
+        currentStream = stream;
+        documentContent.innerHTML = "<em>Loading...</em>";
+        const partial = document.createElement('pre');
+        partial.style.whiteSpace = "pre-wrap";
+
+        stream.addEventListener("chunk", function(event) {
+            const chunk = JSON.parse(event.data);
+            if (!partial.parentNode) {
+                documentContent.innerHTML = "";
+                documentContent.appendChild(partial);
+            }
+            partial.textContent += chunk.text;
+        });
+        stream.addEventListener("done", function(event) {
+            stream.close();
             // Clear previous content (if any)
             documentContent.innerHTML = "";
 
@@ -310,14 +373,15 @@ def view_program(program_name):
             iframe.style.width = "100%";
             iframe.style.height = "500px";
             iframe.style.border = "none";
-            iframe.srcdoc = html;
+            iframe.srcdoc = JSON.parse(event.data).html;
 
             documentContent.appendChild(iframe);
             documentLoaded = true;
-        })
-        .catch(error => {
+        });
+        stream.addEventListener("error", function(event) {
+            stream.close();
             documentContent.innerHTML = "<p style='color: red;'>Error loading document.</p>";
-            console.error(error);
+            if (event.data) console.error(JSON.parse(event.data).message);
         });
         });
     });
@@ -385,6 +449,70 @@ def get_source_code(program_name):
     except Exception as e:
         return f"Error retrieving source code: {str(e)}", 500
 
+@app.route('/api/rows/<program_name>')
+def get_rows(program_name):
+    """API endpoint to render a window of rows of a spreadsheet, e.g. ?start=1001&count=500"""
+    try:
+        start = max(int(request.args.get('start', 1)), 1)
+        count = min(max(int(request.args.get('count', 500)), 1), 5000)
+        inputs = json.loads(request.args.get('inputs', '{}'))
+        config = json.loads(request.args.get('config', '{}'))
+        config.update({"rowStart": start, "rowCount": count})
+        program = programDirectory.getProgram(program_name)
+        if "html" not in programExecutor.getVisualReturnTypesForProgram(program):
+            return f"Program {program_name} does not render html", 400
+        programOutput = programExecutor.executeProgram(program_name, ProgramInput(startTimestamp=0, inputs=inputs), preferredVisualReturnType="html", config=config)
+        return programOutput.viz(), 200, {'Content-Type': 'text/html'}
+    except ValueError as e:
+        return f"Error rendering rows: {str(e)}", 400
+    except Exception as e:
+        return f"Error rendering rows: {str(e)}", 500
+
+@app.route('/api/executions/<program_name>')
+def get_executions(program_name):
+    """API endpoint to page through the execution history of a program"""
+    try:
+        limit = min(int(request.args.get('limit', 50)), 500)
+        offset = int(request.args.get('offset', 0))
+        succeeded = request.args.get('succeeded')
+        if succeeded is not None:
+            succeeded = succeeded.lower() == 'true'
+        records = programDirectory.getExecutionStore().query(program_name, limit=limit, offset=offset, succeeded=succeeded)
+        return jsonify(records)
+    except Exception as e:
+        return f"Error retrieving executions: {str(e)}", 500
+
+@app.route('/api/executions/<program_name>/<int:execution_id>/output')
+def get_execution_output(program_name, execution_id):
+    """API endpoint to get the stored visual output of one execution"""
+    try:
+        executionStore = programDirectory.getExecutionStore()
+        record = executionStore.getRecord(execution_id)
+        if record is None or record["program"] != program_name:
+            return f"Execution {execution_id} of {program_name} not found", 404
+        output = executionStore.loadOutput(execution_id)
+        if output is None:
+            return f"Execution {execution_id} of {program_name} has no output", 404
+        viz = output.viz()
+        mime_type = mime_type_for(output.visualReturnType())
+        if isinstance(viz, bytes):
+            return send_file(io.BytesIO(viz), mimetype=mime_type)
+        if isinstance(viz, str):
+            if not mime_type.startswith("text/") and mime_type not in ("application/json", "image/svg+xml"):
+                mime_type = "text/plain"
+            return viz, 200, {'Content-Type': f"{mime_type}; charset=utf-8"}
+        return jsonify(viz)
+    except Exception as e:
+        return f"Error retrieving execution output: {str(e)}", 500
+
+@app.route('/api/llm-cache/stats')
+def get_llm_cache_stats():
+    """API endpoint to get the hit and miss counters and size of the LLM response cache"""
+    try:
+        return jsonify(getLLMCache().stats())
+    except Exception as e:
+        return f"Error retrieving LLM cache stats: {str(e)}", 500
+
 @app.route('/<filename>.html')
 def serve_html_file(filename):
     """Serve generated HTML files"""
@@ -0,0 +1,184 @@
+from typing import List, Optional
+import atexit
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Where the cache lives unless LLM_CACHE_PATH says otherwise. Point several processes
+# (or hosts, through a shared volume) at the same file to share their responses.
+DEFAULT_CACHE_PATH = os.path.join(".llm_cache", "cache.sqlite")
+
+
+# LLMCache is a persistent cache of chat completion responses in a single SQLite file.
+# Entries are keyed by the model, the full list of messages and the sampling parameters.
+# They expire after ttlSeconds, and the least recently used entries are evicted once
+# the responses add up to more than maxBytes. Hits and misses are counted in the file,
+# so the counters cover every process that shares it.
+# Reads do not write: hit and miss counts and the last use of entries are kept in memory
+# and written in batches, and the total size is kept as a running sum.
+class LLMCache:
+    SCHEMA_VERSION = 1
+    # Batched counters and last uses are written after this many reads or seconds
+    FLUSH_READS = 100
+    FLUSH_SECONDS = 5
+    # Expired entries are deleted at most this often; get ignores them in the meantime
+    SWEEP_SECONDS = 3600
+    # Eviction frees space down to this fraction of maxBytes, so it does not run on every put
+    EVICTION_TARGET = 0.9
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, maxBytes: Optional[int] = 256 * 1024 * 1024, ttlSeconds: Optional[float] = 30 * 24 * 3600):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.ttlSeconds = ttlSeconds
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+        # Other processes may hold the write lock for a moment
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            self.connection.execute("DROP TABLE IF EXISTS responses")
+            self.connection.execute("DROP TABLE IF EXISTS counters")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                response TEXT,
+                size INTEGER,
+                created REAL,
+                lastUsed REAL
+            )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responsesByLastUsed ON responses (lastUsed)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responsesByCreated ON responses (created)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+        self.connection.execute("INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0)")
+        self.connection.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        self.connection.commit()
+
+        self.pendingHits = 0
+        self.pendingMisses = 0
+        # key -> time of the last hit that is not written yet
+        self.pendingUses = {}
+        self.lastFlush = time.time()
+        self.lastSweep = 0.0
+        self.totalBytes = self.__countBytes__()
+
+    @classmethod
+    def computeKey(cls, model: str, messages: List[dict], params: Optional[dict] = None) -> str:
+        # Canonicalize so that dict ordering and formatting do not change the key
+        keyMaterial = {"model": model, "messages": messages, "params": params if params is not None else {}}
+        canonical = json.dumps(keyMaterial, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def get(self, model: str, messages: List[dict], params: Optional[dict] = None) -> Optional[str]:
+        key = self.computeKey(model, messages, params)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttlSeconds is not None and row[1] < now - self.ttlSeconds:
+                row = None
+            if row is None:
+                self.pendingMisses += 1
+            else:
+                self.pendingHits += 1
+                self.pendingUses[key] = now
+            if self.pendingHits + self.pendingMisses >= self.FLUSH_READS or now - self.lastFlush >= self.FLUSH_SECONDS:
+                self.__flush__(now)
+                self.connection.commit()
+        return None if row is None else row[0]
+
+    def put(self, model: str, messages: List[dict], params: Optional[dict], response: str) -> None:
+        key = self.computeKey(model, messages, params)
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        with self.lock:
+            replaced = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                                    (key, model, response, size, now, now))
+            self.pendingUses.pop(key, None)
+            self.totalBytes += size - (replaced[0] if replaced is not None else 0)
+            self.__flush__(now)
+            self.__evict__(now)
+            self.connection.commit()
+
+    # Writes the batched counters and last uses
+    def flush(self) -> None:
+        with self.lock:
+            self.__flush__(time.time())
+            self.connection.commit()
+
+    def stats(self) -> dict:
+        with self.lock:
+            self.__flush__(time.time())
+            self.connection.commit()
+            counters = dict(self.connection.execute("SELECT name, value FROM counters").fetchall())
+            entries, size = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"hits": counters.get("hits", 0), "misses": counters.get("misses", 0), "entries": entries, "bytes": size}
+
+    def clear(self) -> None:
+        with self.lock:
+            self.connection.execute("DELETE FROM responses")
+            self.connection.execute("UPDATE counters SET value = 0")
+            self.connection.commit()
+            self.pendingHits = 0
+            self.pendingMisses = 0
+            self.pendingUses = {}
+            self.totalBytes = 0
+
+    def __countBytes__(self) -> int:
+        return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def __flush__(self, now: float) -> None:
+        if self.pendingHits > 0:
+            self.connection.execute("UPDATE counters SET value = value + ? WHERE name = 'hits'", (self.pendingHits,))
+        if self.pendingMisses > 0:
+            self.connection.execute("UPDATE counters SET value = value + ? WHERE name = 'misses'", (self.pendingMisses,))
+        if len(self.pendingUses) > 0:
+            self.connection.executemany("UPDATE responses SET lastUsed = MAX(lastUsed, ?) WHERE key = ?",
+                                        [(lastUsed, key) for key, lastUsed in self.pendingUses.items()])
+        self.pendingHits = 0
+        self.pendingMisses = 0
+        self.pendingUses = {}
+        self.lastFlush = now
+
+    def __evict__(self, now: float) -> None:
+        if self.ttlSeconds is not None and now - self.lastSweep >= self.SWEEP_SECONDS:
+            cutoff = now - self.ttlSeconds
+            expired = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses WHERE created < ?", (cutoff,)).fetchone()[0]
+            self.connection.execute("DELETE FROM responses WHERE created < ?", (cutoff,))
+            self.totalBytes -= expired
+            self.lastSweep = now
+        if self.maxBytes is None or self.totalBytes <= self.maxBytes:
+            return
+        # Other processes sharing the file change its size too, so recount before evicting
+        self.totalBytes = self.__countBytes__()
+        if self.totalBytes <= self.maxBytes:
+            return
+        # Drop the least recently used entries until the rest fit with some room to spare
+        target = self.maxBytes * self.EVICTION_TARGET
+        evicted = []
+        for key, size in self.connection.execute("SELECT key, size FROM responses ORDER BY lastUsed"):
+            if self.totalBytes <= target:
+                break
+            evicted.append((key,))
+            self.totalBytes -= size
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+
+llmCache = None
+llmCacheLock = threading.Lock()
+
+def getLLMCache() -> LLMCache:
+    global llmCache
+    with llmCacheLock:
+        if llmCache is None:
+            llmCache = LLMCache(os.environ.get("LLM_CACHE_PATH", DEFAULT_CACHE_PATH))
+            atexit.register(llmCache.flush)
+        return llmCache
+
@@ -0,0 +1,160 @@
+from clientProvider import ClientProvider, getClientProvider
+from concurrent.futures import Future
+from llmCache import LLMCache, getLLMCache
+from typing import Any, Callable, List, Optional, Tuple
+import asyncio
+import atexit
+import os
+import threading
+import uuid
+
+
+def _makeAsyncClient() -> Any:
+    return getClientProvider().getAsyncOpenAI()
+
+
+# LLMGateway is a process-wide service through which the DSL processors talk to the
+# OpenAI API. It runs an asyncio event loop on its own thread, so requests from any
+# number of threads are issued concurrently, at most maxConcurrency at a time.
+# Identical requests that are in flight at the same moment share one future, so a
+# prompt that several includes or web requests need at once is only sent once.
+# Every request goes through the one pooled client of the client provider, with the
+# timeout and retries of the processor that makes it.
+class LLMGateway:
+    def __init__(self, maxConcurrency: int = 8, clientFactory: Callable[[], Any] = _makeAsyncClient):
+        self.maxConcurrency = maxConcurrency
+        self.clientFactory = clientFactory
+        self.client = None
+        self.semaphore = None
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.loop = None
+        self.thread = None
+
+    # Returns the content of a chat completion. Responses come from (and go to) the LLM
+    # cache unless useCache is False. If onChunk is given, the completion is streamed and
+    # onChunk is called with each piece of text as it arrives; a response that comes from
+    # the cache or from a request that was already in flight arrives as one piece.
+    def chat(self, model: str, messages: List[dict], params: Optional[dict] = None, useCache: bool = True, onChunk: Optional[Callable[[str], None]] = None,
+             processor: str = "llm", config: Optional[dict] = None) -> str:
+        params = params if params is not None else {}
+        cache = getLLMCache() if useCache else None
+        if cache is not None:
+            cached = cache.get(model, messages, params)
+            if cached is not None:
+                if onChunk is not None:
+                    onChunk(cached)
+                return cached
+        key = ("chat", LLMCache.computeKey(model, messages, params))
+        future, started = self.__singleFlight__(key, lambda: self.__chat__(model, messages, params, cache, onChunk, ClientProvider.getSettings(processor, config)))
+        content = future.result()
+        if onChunk is not None and not started:
+            onChunk(content)
+        return content
+
+    # Synthesizes speech into path. The file is written under a temporary name and renamed
+    # when complete, so a failed request never leaves a truncated file behind.
+    def speech(self, model: str, voice: str, input: str, instructions: str, path: str, processor: str = "tts", config: Optional[dict] = None) -> None:
+        key = ("speech", path)
+        future, _ = self.__singleFlight__(key, lambda: self.__speech__(model, voice, input, instructions, path, ClientProvider.getSettings(processor, config)))
+        future.result()
+
+    def shutdown(self) -> None:
+        with self.lock:
+            if self.loop is None:
+                return
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout=10)
+            self.loop = None
+            self.thread = None
+
+    # Returns the future of the request and whether this call started it
+    def __singleFlight__(self, key: tuple, makeCoroutine: Callable[[], Any]) -> Tuple[Future, bool]:
+        with self.lock:
+            future = self.inflight.get(key)
+            if future is not None:
+                return future, False
+            self.__ensureLoop__()
+            future = asyncio.run_coroutine_threadsafe(makeCoroutine(), self.loop)
+            self.inflight[key] = future
+        future.add_done_callback(lambda _: self.__finished__(key, future))
+        return future, True
+
+    def __finished__(self, key: tuple, future: Future) -> None:
+        with self.lock:
+            if self.inflight.get(key) is future:
+                del self.inflight[key]
+
+    def __ensureLoop__(self) -> None:
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, name="llm-gateway", daemon=True)
+            self.thread.start()
+
+    async def __limit__(self) -> asyncio.Semaphore:
+        # Created on the loop thread, where it is used
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.maxConcurrency)
+        if self.client is None:
+            self.client = self.clientFactory()
+        return self.semaphore
+
+    # The shared client with the timeout and retries of one processor; it uses the same pool
+    def __client__(self, settings: dict) -> Any:
+        return self.client.with_options(timeout=settings["timeout"], max_retries=settings["maxRetries"])
+
+    async def __chat__(self, model: str, messages: List[dict], params: dict, cache: Optional[LLMCache], onChunk: Optional[Callable[[str], None]], settings: dict) -> str:
+        async with await self.__limit__():
+            client = self.__client__(settings)
+            if onChunk is None:
+                response = await client.chat.completions.create(model=model, messages=messages, **params)
+                content = response.choices[0].message.content
+            else:
+                content = await self.__streamChat__(client, model, messages, params, onChunk)
+        if cache is not None and content is not None:
+            # The cache is SQLite, so write it off the loop thread
+            await asyncio.get_running_loop().run_in_executor(None, cache.put, model, messages, params, content)
+        return content
+
+    async def __streamChat__(self, client: Any, model: str, messages: List[dict], params: dict, onChunk: Callable[[str], None]) -> str:
+        parts = []
+        stream = await client.chat.completions.create(model=model, messages=messages, stream=True, **params)
+        async for chunk in stream:
+            if len(chunk.choices) == 0 or not chunk.choices[0].delta.content:
+                continue
+            text = chunk.choices[0].delta.content
+            parts.append(text)
+            try:
+                onChunk(text)
+            except Exception as e:
+                # A listener that went away must not fail the request
+                print(f"WARNING: could not stream LLM output: {e}")
+        return "".join(parts)
+
+    async def __speech__(self, model: str, voice: str, input: str, instructions: str, path: str, settings: dict) -> None:
+        tempPath = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            async with await self.__limit__():
+                async with self.__client__(settings).audio.speech.with_streaming_response.create(
+                    model=model,
+                    voice=voice,
+                    input=input,
+                    instructions=instructions,
+                ) as response:
+                    await response.stream_to_file(tempPath)
+            os.replace(tempPath, path)
+        finally:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+
+
+llmGateway = None
+llmGatewayLock = threading.Lock()
+
+def getLLMGateway() -> LLMGateway:
+    global llmGateway
+    with llmGatewayLock:
+        if llmGateway is None:
+            llmGateway = LLMGateway(maxConcurrency=int(os.environ.get("LLM_MAX_CONCURRENCY", 8)))
+            atexit.register(llmGateway.shutdown)
+        return llmGateway
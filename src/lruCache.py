@@ -0,0 +1,58 @@
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+import threading
+
+
+# LRUCache is a small thread-safe in-memory least-recently-used cache, bounded
+# by number of entries and optionally by total size (as measured by sizeOf)
+class LRUCache:
+    def __init__(self, maxEntries: Optional[int] = 128, maxBytes: Optional[int] = None, sizeOf: Optional[Callable[[Any], int]] = None):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.sizeOf = sizeOf if sizeOf is not None else (lambda value: 0)
+        self.entries = OrderedDict()
+        self.currentBytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = self.sizeOf(value)
+        with self.lock:
+            # Entries larger than the whole cache are not worth keeping
+            if self.maxBytes is not None and size > self.maxBytes:
+                return
+            if key in self.entries:
+                self.currentBytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.currentBytes += size
+            while (self.maxEntries is not None and len(self.entries) > self.maxEntries) or \
+                  (self.maxBytes is not None and self.currentBytes > self.maxBytes):
+                _, (_, evictedSize) = self.entries.popitem(last=False)
+                self.currentBytes -= evictedSize
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self.lock:
+            if key not in self.entries:
+                return default
+            value, size = self.entries.pop(key)
+            self.currentBytes -= size
+            return value
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.currentBytes = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.entries)
@@ -0,0 +1,183 @@
+from concurrent.futures import ThreadPoolExecutor
+from programs import ProgramOutput
+from resultCache import ResultCache
+from typing import List, Optional, Tuple
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+# Marp separates slides with horizontal rulers
+SLIDE_SEPARATOR_PATTERN = re.compile(r'^\s{0,3}-{3,}\s*$')
+# Marp directives that apply to the whole deck or carry over to the slides after the one
+# that sets them. Spot directives (with a leading _) only style their own slide.
+MARP_DIRECTIVES = ["theme", "style", "headingDivider", "lang", "size", "math", "title", "author", "description",
+                   "image", "keywords", "url", "marp", "paginate", "header", "footer", "class", "backgroundColor",
+                   "backgroundImage", "backgroundPosition", "backgroundRepeat", "backgroundSize", "color"]
+DIRECTIVE_PATTERN = re.compile(r'^\s*(' + '|'.join(MARP_DIRECTIVES) + r')\s*:', re.MULTILINE)
+# A directive line, including spot directives
+DIRECTIVE_LINE_PATTERN = re.compile(r'^\s*_?(' + '|'.join(MARP_DIRECTIVES) + r')\s*:')
+COMMENT_PATTERN = re.compile(r'<!--(.*?)-->', re.DOTALL)
+FENCE_PATTERN = re.compile(r'^\s{0,3}(```|~~~).*?^\s{0,3}\1[^\n]*$', re.DOTALL | re.MULTILINE)
+
+
+# Splits a deck into its front matter and the markdown of each slide
+def splitSlides(markdown: str) -> Tuple[str, List[str]]:
+    lines = markdown.split("\n")
+    frontMatter = ""
+    if len(lines) > 0 and lines[0].strip() == "---":
+        for end in range(1, len(lines)):
+            if lines[end].strip() == "---":
+                frontMatter = "\n".join(lines[:end + 1]) + "\n\n"
+                lines = lines[end + 1:]
+                break
+
+    slideSources = []
+    current = []
+    fence = None
+    for line in lines:
+        stripped = line.strip()
+        # rulers inside fenced code blocks do not separate slides
+        if stripped.startswith("```") or stripped.startswith("~~~"):
+            if fence is None:
+                fence = stripped[:3]
+            elif stripped.startswith(fence):
+                fence = None
+        if fence is None and SLIDE_SEPARATOR_PATTERN.match(line):
+            slideSources.append("\n".join(current).strip("\n"))
+            current = []
+        else:
+            current.append(line)
+    slideSources.append("\n".join(current).strip("\n"))
+    return frontMatter, slideSources
+
+
+# The speaker notes of every slide, collected the way marp does: every HTML comment outside
+# code blocks that is not a directive, separated by blank lines. Returns None when marp
+# splits slides at headings (headingDivider), since then only marp knows where slides start.
+def slideNotes(markdown: str) -> Optional[List[str]]:
+    if "headingDivider" in markdown:
+        return None
+    notes = []
+    for source in splitSlides(markdown)[1]:
+        comments = [comment.strip() for comment in COMMENT_PATTERN.findall(FENCE_PATTERN.sub("", source))]
+        notes.append("\n\n".join(comment for comment in comments if comment != "" and not _isDirectiveComment(comment)))
+    return notes
+
+
+def _isDirectiveComment(comment: str) -> bool:
+    return all(DIRECTIVE_LINE_PATTERN.match(line) for line in comment.split("\n") if line.strip() != "")
+
+
+# MarpError is raised when marp fails; it carries what marp wrote to stderr
+class MarpError(RuntimeError):
+    def __init__(self, message: str, stderr: str = "", returncode: Optional[int] = None):
+        super().__init__(f"{message}: {stderr.strip()}" if stderr.strip() else message)
+        self.stderr = stderr
+        self.returncode = returncode
+
+
+# MarpService converts Marp markdown to HTML, per-slide PNGs and speaker notes.
+# Conversions are cached by a hash of the markdown, the kind of output and the theme
+# files, so rendering the same deck again does not start Node and Chromium. Each run
+# works in a private temporary directory that is removed afterwards.
+class MarpService:
+    def __init__(self, cacheDir: str = ".marp_cache", executable: str = "marp", themeSet: Optional[List[str]] = None, timeout: float = 300):
+        self.cache = ResultCache(cacheDir, maxBytes=256 * 1024 * 1024)
+        self.executable = executable
+        # Theme CSS files passed to marp with --theme-set
+        self.themeSet = themeSet if themeSet is not None else []
+        self.timeout = timeout
+
+    def renderHtml(self, markdown: str) -> str:
+        def convert(workdir: str) -> ProgramOutput:
+            self.__run__(workdir, markdown, ["--html", "--allow-local-files", "-o", "slides.html"])
+            with open(os.path.join(workdir, "slides.html"), "r") as f:
+                return ProgramOutput(time.time(), "html", f.read(), {})
+        return self.__cached__("html", markdown, convert).viz()
+
+    # The PNG of every slide, in order
+    def renderImages(self, markdown: str) -> List[bytes]:
+        def convert(workdir: str) -> ProgramOutput:
+            self.__run__(workdir, markdown, ["--images", "png", "--allow-local-files", "-o", "slide.png"])
+            # marp numbers the images slide.001.png, slide.002.png, ...
+            images = []
+            for name in sorted(os.listdir(workdir)):
+                if name.startswith("slide.") and name.endswith(".png"):
+                    with open(os.path.join(workdir, name), "rb") as f:
+                        images.append(f.read())
+            if len(images) == 0:
+                raise MarpError("marp did not produce any images")
+            return ProgramOutput(time.time(), "png", images, {})
+        return self.__cached__("images", markdown, convert).viz()
+
+    # The speaker notes of every slide, in order
+    def renderNotes(self, markdown: str) -> List[str]:
+        def convert(workdir: str) -> ProgramOutput:
+            self.__run__(workdir, markdown, ["--notes", "-o", "notes.md"])
+            with open(os.path.join(workdir, "notes.md"), "r") as f:
+                # notes of consecutive slides are separated by ---
+                return ProgramOutput(time.time(), "md", f.read().split("---"), {})
+        return self.__cached__("notes", markdown, convert).viz()
+
+    # The images and notes of every slide. marp converts to one kind of output per run, so
+    # the notes are read from the markdown and only the images start marp. Decks split at
+    # headings still get their notes from a second marp run, side by side with the first.
+    def renderSlides(self, markdown: str) -> Tuple[List[bytes], List[str]]:
+        notes = slideNotes(markdown)
+        if notes is not None:
+            return self.renderImages(markdown), notes
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            images = pool.submit(self.renderImages, markdown)
+            notes = pool.submit(self.renderNotes, markdown)
+            return images.result(), notes.result()
+
+    def __cached__(self, kind: str, markdown: str, convert) -> ProgramOutput:
+        key = ResultCache.computeKey({"kind": kind, "markdown": markdown, "themes": self.__themeHashes__()})
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        workdir = tempfile.mkdtemp(prefix="marp-")
+        try:
+            output = convert(workdir)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        self.cache.put(key, output)
+        return output
+
+    def __themeHashes__(self) -> List[str]:
+        hashes = []
+        for path in self.themeSet:
+            with open(path, "rb") as f:
+                hashes.append(hashlib.sha256(f.read()).hexdigest())
+        return hashes
+
+    def __run__(self, workdir: str, markdown: str, arguments: List[str]) -> None:
+        with open(os.path.join(workdir, "slides.md"), "w") as f:
+            f.write(markdown)
+        command = [self.executable, "slides.md"] + arguments
+        for path in self.themeSet:
+            command += ["--theme-set", os.path.abspath(path)]
+        try:
+            result = subprocess.run(command, cwd=workdir, capture_output=True, text=True, timeout=self.timeout)
+        except FileNotFoundError:
+            raise MarpError(f"{self.executable} was not found, see the README for how to install marp-cli")
+        except subprocess.TimeoutExpired as e:
+            raise MarpError(f"marp timed out after {self.timeout}s", e.stderr if isinstance(e.stderr, str) else "")
+        if result.returncode != 0:
+            raise MarpError(f"marp failed with exit code {result.returncode}", result.stderr, result.returncode)
+
+
+marpService = None
+marpServiceLock = threading.Lock()
+
+def getMarpService() -> MarpService:
+    global marpService
+    with marpServiceLock:
+        if marpService is None:
+            marpService = MarpService()
+        return marpService
@@ -1,47 +1,86 @@
+from clientProvider import ClientProvider, getClientProvider
 from programs import ProgramInput, ProgramOutput, ProgramDirectory, NamedProgram, TracerNode
-from dslProcessor import DSLProcessor, BasicDSLProcessor
-from aiImageDslProcessor import AIImageProcessor
-from spreadsheetDslProcessor import SpreadsheetDSLProcessor
-from VegaDSLProcessor import VegaDSLProcessor
-from JavascriptDSLProcessor import JavascriptDSLProcessor
-from PlaceHolderDSLProcessor import PlaceHolderDSLProcessor
-from SlideVideoDSLProcessor import SlideVideoDSLProcessor
-from SlideDSLProcessor import SlideDSLProcessor
-from PythonDSLProcessor import PythonDSLProcessor
-from LLMDSLProcessor import LLMDSLProcessor
+from dslProcessor import DSLProcessor
+from dslRegistry import DSLRegistry
+from resultCache import ResultCache
+from streamSink import currentStreamSource
 from typing import Optional
-import requests
+import hashlib
 import json
+import time
 import os
 
 
 # ProgramExecutor is a class that executes a program of any kind
 class ProgramExecutor:
-    def __init__(self, programDirectory: ProgramDirectory):
+    def __init__(self, programDirectory: ProgramDirectory, resultCache: Optional[ResultCache] = None):
         self.programDirectory = programDirectory
-        self.availableDSLProcessors = {
-            "aiimage": AIImageProcessor(programDirectory),
-            "spreadsheet": SpreadsheetDSLProcessor(programDirectory),
-            "vega-lite": VegaDSLProcessor(programDirectory),
-            "javascript": JavascriptDSLProcessor(programDirectory),
-            "basic": BasicDSLProcessor(programDirectory),
-            "slidevideo": SlideVideoDSLProcessor(programDirectory),
-            "slides": SlideDSLProcessor(programDirectory),
-            "placeholder": PlaceHolderDSLProcessor(programDirectory),
-            "python": PythonDSLProcessor(programDirectory),
-            "llm": LLMDSLProcessor(programDirectory)
-        }
+        self.resultCache = resultCache if resultCache is not None else ResultCache()
+        # Processors are imported and constructed on first use
+        self.dslRegistry = DSLRegistry(programDirectory)
         self.programDirectory.setProgramExecutor(self)
 
     def getDSLProcessor(self, dslId: str) -> DSLProcessor:
-        if dslId not in self.availableDSLProcessors:
-            raise ValueError(f"DSL processor {dslId} not found")
-        return self.availableDSLProcessors[dslId]
+        return self.dslRegistry.get(dslId)
     
     def getVisualReturnTypesForProgram(self, program: NamedProgram) -> list[str]:
-        dslProcessor = self.availableDSLProcessors[program.dslId]
+        dslProcessor = self.getDSLProcessor(program.dslId)
         return dslProcessor.getVisualReturnTypes()
 
+    # Appends an execution to the program's history, without ever failing the execution itself.
+    # It is written by the store's background writer, so the render does not wait for the disk.
+    def recordExecution(self, program: NamedProgram, input: ProgramInput, output: Optional[ProgramOutput], started: float, errorMessage: str = "", cached: bool = False) -> None:
+        if output is not None and not isinstance(output, ProgramOutput):
+            errorMessage = str(output.get("error", "")) if isinstance(output, dict) else "invalid program output"
+            output = None
+        try:
+            executionStore = self.programDirectory.getExecutionStore()
+            # the inputs are copied since the caller may still change them
+            executionStore.submit(program.name, len(program.codeVersions) - 1, dict(input, inputs=dict(input["inputs"])), output, started, time.time(), errorMessage, cached)
+        except Exception as e:
+            print(f"WARNING: could not record execution of {program.name}: {e}")
+
+    # Computes the result cache key for an execution, or None if the result should not be cached.
+    # The key covers the latest code, the inputs, the config, the requested visual type and
+    # the code of every transitively included program.
+    def getResultCacheKey(self, program: NamedProgram, input: ProgramInput, preferredVisualReturnType: Optional[str], config: Optional[dict]) -> Optional[str]:
+        # Per-program bypass, either in the itom header config or in the config passed in
+        if not program.config.get("resultCache", True):
+            return None
+        if config is not None and not config.get("resultCache", True):
+            return None
+
+        includedCode = {}
+        pending = [program]
+        while len(pending) > 0:
+            current = pending.pop()
+            if not self.dslRegistry.hasDSL(current.dslId):
+                return None
+            dslProcessor = self.getDSLProcessor(current.dslId)
+            includedNames = dslProcessor.getIncludedProgramNames(current)
+            if includedNames is None:
+                return None
+            for includedName in includedNames:
+                if includedName in includedCode:
+                    continue
+                try:
+                    includedProgram = self.programDirectory.getProgram(includedName)
+                except ValueError:
+                    # A missing include renders as an error, which is stable until it is added
+                    includedCode[includedName] = None
+                    continue
+                includedCode[includedName] = hashlib.sha256(includedProgram.getLatestRawCode().encode()).hexdigest()
+                pending.append(includedProgram)
+
+        return ResultCache.computeKey({
+            "program": program.name,
+            "code": hashlib.sha256(program.getLatestRawCode().encode()).hexdigest(),
+            "inputs": input["inputs"],
+            "config": config,
+            "visualReturnType": preferredVisualReturnType,
+            "includes": includedCode
+        })
+
     def executeProgram(self, programName: str, input: ProgramInput, preferredVisualReturnType: Optional[str] = None, inferInputs: bool = False, callingProgramContext: Optional[str] = None,config: Optional[dict] = None,parentTracer: Optional[TracerNode] = None) -> ProgramOutput:
         #print("executing program", programName)
         program = self.programDirectory.getProgram(programName)
@@ -50,7 +89,7 @@ class ProgramExecutor:
             childTracer = TracerNode(program)
             parentTracer.addChild(childTracer)
             childTracer.start(input)
-        if program.dslId not in self.availableDSLProcessors:
+        if not self.dslRegistry.hasDSL(program.dslId):
             raise ValueError(f"DSL processor {program.dslId} not found")
 
         aiInputs = False
@@ -77,10 +116,12 @@ class ProgramExecutor:
                 Return this in the form of a JSON object with the keys and values.
                 If you cannot infer a good value for an input, make as good as guess as possible. Do not leave any inputs blank.
                 """ 
-                response = requests.post(
+                provider = getClientProvider()
+                response = provider.getSession("inferInputs").post(
                     "https://api.openai.com/v1/chat/completions",
-                    headers={"Authorization": f"Bearer {os.getenv('OPENAI_API_KEY')}"},
-                    json={"model": "gpt-4o-mini", "messages": [{"role": "user", "content": prompt}], "temperature": 0.0, "max_tokens": 1000}
+                    headers={"Authorization": f"Bearer {provider.getApiKey()}"},
+                    json={"model": "gpt-4o-mini", "messages": [{"role": "user", "content": prompt}], "temperature": 0.0, "max_tokens": 1000},
+                    timeout=ClientProvider.getSettings("inferInputs")["timeout"]
                 )
                 extractedJsonStr = response.json()["choices"][0]["message"]["content"]
                 # If the json string starts with 'json' or 'JSON', remove it
@@ -103,8 +144,29 @@ class ProgramExecutor:
                     print("Error parsing JSON: ", e)
                     pass
 
-        dslProcessor = self.availableDSLProcessors[program.dslId]
-        output = dslProcessor.runProgram(program, input, preferredVisualReturnType, config,childTracer)
+        started = time.time()
+        cacheKey = self.getResultCacheKey(program, input, preferredVisualReturnType, config)
+        if cacheKey is not None:
+            output = self.resultCache.get(cacheKey)
+            if output is not None:
+                self.recordExecution(program, input, output, started, cached=True)
+                if childTracer is not None:
+                    childTracer.end(output)
+                return output
+
+        dslProcessor = self.getDSLProcessor(program.dslId)
+        # label streamed output with this program, and with the parent again once it is done
+        sourceToken = currentStreamSource.set(program.name)
+        try:
+            output = dslProcessor.runProgram(program, input, preferredVisualReturnType, config,childTracer)
+        except Exception as e:
+            self.recordExecution(program, input, None, started, str(e))
+            raise
+        finally:
+            currentStreamSource.reset(sourceToken)
+        self.recordExecution(program, input, output, started)
+        if cacheKey is not None and isinstance(output, ProgramOutput) and output.succeeded():
+            self.resultCache.put(cacheKey, output)
         if childTracer is not None:
             childTracer.end(output)
         return output
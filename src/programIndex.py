@@ -0,0 +1,155 @@
+from datetime import datetime
+from typing import Optional, List, Tuple
+from ItomHeader import ItomHeader
+import json
+import os
+import sqlite3
+import threading
+
+
+# ProgramSummary is the lightweight view of a program that is kept in the index.
+# It carries everything needed to list programs without loading program.json.
+class ProgramSummary:
+    def __init__(self, name: str, description: str, dslId: str, inputs: dict, outputs: dict, config: dict, created: datetime, modified: datetime, codeHash: Optional[str]):
+        self.name = name
+        self.description = description
+        self.dslId = dslId
+        self.inputs = inputs
+        self.outputs = outputs
+        self.config = config
+        self.created = created
+        self.modified = modified
+        self.codeHash = codeHash
+
+    def getHeader(self) -> ItomHeader:
+        hdr = ItomHeader()
+        hdr.setDescription(self.description)
+        hdr.setDslId(self.dslId)
+        hdr.setInputs(self.inputs)
+        hdr.setOutputs(self.outputs)
+        hdr.setConfig(self.config)
+        return hdr
+
+
+# ProgramIndex is a compact SQLite index of the program directory. Besides the header
+# summary it records the size and mtime of each program.json and code.itom, so that a
+# refresh only needs to reparse files that actually changed.
+class ProgramIndex:
+    SCHEMA_VERSION = 1
+
+    def __init__(self, indexPath: str):
+        self.indexPath = indexPath
+        self.lock = threading.Lock()
+        try:
+            self.connection = self.__connect__()
+        except sqlite3.DatabaseError as e:
+            # The index is only a cache of the directory, so rebuild it if it is unreadable
+            print(f"WARNING: rebuilding unreadable program index {indexPath}: {e}")
+            os.remove(indexPath)
+            self.connection = self.__connect__()
+
+    def __connect__(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.indexPath, check_same_thread=False)
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            connection.execute("DROP TABLE IF EXISTS programs")
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS programs (
+                name TEXT PRIMARY KEY,
+                description TEXT,
+                dslId TEXT,
+                header TEXT,
+                created TEXT,
+                modified TEXT,
+                jsonMtime INTEGER,
+                jsonSize INTEGER,
+                codeMtime INTEGER,
+                codeSize INTEGER,
+                codeHash TEXT
+            )""")
+        connection.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        connection.commit()
+        return connection
+
+    @classmethod
+    def statFile(cls, path: str) -> Optional[Tuple[int, int]]:
+        # Returns (mtime in ns, size) or None if the file does not exist
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def getStats(self) -> dict:
+        # Returns name -> (json stat, code stat) for every indexed program
+        with self.lock:
+            rows = self.connection.execute("SELECT name, jsonMtime, jsonSize, codeMtime, codeSize FROM programs").fetchall()
+        stats = {}
+        for name, jsonMtime, jsonSize, codeMtime, codeSize in rows:
+            jsonStat = (jsonMtime, jsonSize) if jsonMtime is not None else None
+            codeStat = (codeMtime, codeSize) if codeMtime is not None else None
+            stats[name] = (jsonStat, codeStat)
+        return stats
+
+    def hasProgram(self, name: str) -> bool:
+        with self.lock:
+            row = self.connection.execute("SELECT 1 FROM programs WHERE name = ?", (name,)).fetchone()
+        return row is not None
+
+    def getSummaries(self) -> List[ProgramSummary]:
+        with self.lock:
+            rows = self.connection.execute("SELECT name, description, dslId, header, created, modified, codeHash FROM programs ORDER BY name").fetchall()
+        summaries = []
+        for name, description, dslId, header, created, modified, codeHash in rows:
+            header = json.loads(header)
+            summaries.append(ProgramSummary(name, description, dslId,
+                                            header["inputs"], header["outputs"], header["config"],
+                                            datetime.fromisoformat(created), datetime.fromisoformat(modified),
+                                            codeHash))
+        return summaries
+
+    def getFileStats(self, name: str) -> Tuple[Optional[Tuple[int, int]], Optional[Tuple[int, int]]]:
+        # Returns (json stat, code stat) for one program
+        with self.lock:
+            row = self.connection.execute("SELECT jsonMtime, jsonSize, codeMtime, codeSize FROM programs WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None, None
+        jsonMtime, jsonSize, codeMtime, codeSize = row
+        jsonStat = (jsonMtime, jsonSize) if jsonMtime is not None else None
+        codeStat = (codeMtime, codeSize) if codeMtime is not None else None
+        return jsonStat, codeStat
+
+    # Records a program's header summary and the stat of its program.json.
+    # The code.itom stat is left alone (see updateCodeStat).
+    def update(self, program: "NamedProgram", jsonStat: Optional[Tuple[int, int]]) -> None:
+        header = json.dumps({"inputs": program.inputs, "outputs": program.outputs, "config": program.config}, default=str)
+        jsonMtime, jsonSize = jsonStat if jsonStat is not None else (None, None)
+        with self.lock:
+            self.connection.execute("""
+                INSERT INTO programs (name, description, dslId, header, created, modified, jsonMtime, jsonSize)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    description = excluded.description,
+                    dslId = excluded.dslId,
+                    header = excluded.header,
+                    created = excluded.created,
+                    modified = excluded.modified,
+                    jsonMtime = excluded.jsonMtime,
+                    jsonSize = excluded.jsonSize""",
+                (program.name, program.description, program.dslId, header,
+                 program.created.isoformat(), program.modified.isoformat(),
+                 jsonMtime, jsonSize))
+            self.connection.commit()
+
+    # Records the stat and hash of the code.itom that was last compared with program.json
+    def updateCodeStat(self, name: str, codeStat: Optional[Tuple[int, int]], codeHash: Optional[str]) -> None:
+        codeMtime, codeSize = codeStat if codeStat is not None else (None, None)
+        with self.lock:
+            self.connection.execute("UPDATE programs SET codeMtime = ?, codeSize = ?, codeHash = ? WHERE name = ?",
+                                    (codeMtime, codeSize, codeHash, name))
+            self.connection.commit()
+
+    def remove(self, name: str) -> None:
+        with self.lock:
+            self.connection.execute("DELETE FROM programs WHERE name = ?", (name,))
+            self.connection.commit()
@@ -0,0 +1,121 @@
+from programs import ProgramDirectory
+from typing import Optional
+import os
+import threading
+
+# watchdog uses inotify (or the platform equivalent) so edits are seen without
+# scanning. It is in requirements.txt; without it the directory is polled.
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+
+# ProgramWatcher keeps a ProgramDirectory in sync with edits made on disk, e.g. through
+# the command line while the web server is running. File events are collected per program
+# and applied after a short debounce, so an editor's burst of writes becomes one refresh.
+# Only the programs that were touched are rechecked; see ProgramDirectory.refreshPrograms.
+class ProgramWatcher:
+    WATCHED_FILES = ("code.itom", "program.json")
+
+    def __init__(self, programDirectory: ProgramDirectory, pollInterval: float = 2.0, debounce: float = 0.2, usePolling: bool = False):
+        self.programDirectory = programDirectory
+        self.pollInterval = pollInterval
+        self.debounce = debounce
+        self.usePolling = usePolling or Observer is None
+        self.pending = set()
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+        self.observer = None
+        self.thread = None
+
+    def start(self) -> "ProgramWatcher":
+        if self.thread is not None:
+            return self
+        if Observer is None:
+            print(f"WARNING: watchdog is not installed, polling {self.programDirectory.localProgramDir} every {self.pollInterval} seconds")
+        if not self.usePolling:
+            self.observer = Observer()
+            self.observer.schedule(_ProgramEventHandler(self), self.programDirectory.localProgramDir, recursive=True)
+            self.observer.daemon = True
+            self.observer.start()
+        self.thread = threading.Thread(target=self.__run__, name="program-watcher", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+            self.observer = None
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    # Called from the watchdog thread with the path of a created, modified, moved or deleted file
+    def notifyPath(self, path: str) -> None:
+        programName = self.programNameForPath(path)
+        if programName is None:
+            return
+        with self.condition:
+            self.pending.add(programName)
+            self.condition.notify_all()
+
+    # Maps <programDir>/<name>/code.itom (or program.json, or the directory itself) to <name>
+    def programNameForPath(self, path: str) -> Optional[str]:
+        relativePath = os.path.relpath(path, self.programDirectory.localProgramDir)
+        parts = relativePath.split(os.sep)
+        if parts[0] in (".", "..") or parts[0].startswith("."):
+            return None
+        if len(parts) == 1 or (len(parts) == 2 and parts[1] in self.WATCHED_FILES):
+            return parts[0]
+        return None
+
+    def __run__(self) -> None:
+        while not self.stopped.is_set():
+            if self.usePolling:
+                self.stopped.wait(self.pollInterval)
+                if self.stopped.is_set():
+                    break
+                self.__refresh__(None)
+                continue
+
+            with self.condition:
+                while len(self.pending) == 0 and not self.stopped.is_set():
+                    self.condition.wait()
+            # Let a burst of writes settle before rereading anything
+            self.stopped.wait(self.debounce)
+            with self.condition:
+                programNames = self.pending
+                self.pending = set()
+            if not self.stopped.is_set():
+                self.__refresh__(programNames)
+
+    def __refresh__(self, programNames: Optional[set]) -> None:
+        try:
+            if programNames is None:
+                self.programDirectory.refresh()
+            else:
+                self.programDirectory.refreshPrograms(programNames)
+        except Exception as e:
+            print(f"WARNING: program refresh failed: {e}")
+
+
+class _ProgramEventHandler(FileSystemEventHandler):
+    def __init__(self, watcher: ProgramWatcher):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_any_event(self, event) -> None:
+        if event.event_type in ("opened", "closed_no_write"):
+            return
+        self.watcher.notifyPath(os.fsdecode(event.src_path))
+        destPath = getattr(event, "dest_path", None)
+        if destPath:
+            # Atomic saves rename a temp file onto code.itom or program.json
+            self.watcher.notifyPath(os.fsdecode(destPath))
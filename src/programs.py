@@ -2,9 +2,64 @@ import sys
 import json
 import os
 from datetime import datetime
-from typing import Optional, List, Tuple, TypedDict, Any
+from typing import Optional, List, Tuple, TypedDict, Any, Callable, Iterable
 from ItomHeader import ItomHeader
+from programIndex import ProgramIndex, ProgramSummary
+from executionStore import ExecutionStore
+import hashlib
 import re
+import threading
+import uuid
+
+# orjson is optional; it is much faster on the large code version arrays in program.json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Retention of the execution history, unless the ProgramDirectory is given other limits.
+# "none" in either variable keeps executions regardless of that limit.
+EXECUTION_HISTORY_MAX_RECORDS = os.environ.get("EXECUTION_HISTORY_MAX_RECORDS", "100")
+EXECUTION_HISTORY_MAX_AGE_DAYS = os.environ.get("EXECUTION_HISTORY_MAX_AGE_DAYS", "30")
+
+
+def _parseLimit(value: Optional[str], parse: Callable[[str], Any]) -> Any:
+    if value is None or value.strip().lower() in ("", "none"):
+        return None
+    return parse(value)
+
+
+# Writes a file through a temporary file and a rename, so readers and crashes
+# never see a partially written file. The data reaches the disk before the rename,
+# and the rename itself is synced through the directory where the platform allows it.
+def writeFileAtomically(path: str, text: str) -> None:
+    tempPath = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tempPath, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tempPath, path)
+    except BaseException:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+        raise
+    _syncDirectory(os.path.dirname(os.path.abspath(path)))
+
+
+def _syncDirectory(directory: str) -> None:
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        # directories cannot be opened on Windows
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
 
 # ProgramInput is a class that represents the input of a program
 class ProgramInput(TypedDict):
@@ -63,6 +118,8 @@ class NamedProgram:
         self.outputs = outputs
         self.rawCodeVersions = rawCodeVersions
         self.codeVersions = codeVersions
+        # Kept so program.json stays readable by older versions; the
+        # execution history itself lives in the ExecutionStore
         self.executions = executions
         self.config = config
 
@@ -132,7 +189,7 @@ class NamedProgram:
                    dict["outputs"],
                    dict["rawCodeVersions"],
                    dict["codeVersions"],
-                   dict["executions"],
+                   dict.get("executions", [[] for _ in dict["codeVersions"]]),
                    dict["config"])
 
     # init from json
@@ -142,7 +199,7 @@ class NamedProgram:
 
     # save to json
     def toJson(self) -> str:
-        return json.dumps({
+        programDict = {
             "name": self.name,
             "created": self.created.isoformat(),
             "modified": self.modified.isoformat(),
@@ -154,7 +211,14 @@ class NamedProgram:
             "codeVersions": self.codeVersions,
             "executions": self.executions,
             "config": self.config
-        })
+        }
+        if orjson is not None:
+            try:
+                return orjson.dumps(programDict).decode("utf-8")
+            except TypeError:
+                # e.g. non-string keys in a header, which json handles
+                pass
+        return json.dumps(programDict)
 
     def getLatestCode(self) -> str:
         return self.codeVersions[-1]
@@ -162,12 +226,6 @@ class NamedProgram:
     def getLatestRawCode(self) -> str:
         return self.rawCodeVersions[-1]
 
-    def getExecutionHistory(self) -> List[Tuple[ProgramInput, ProgramOutput]]:
-        return self.executions[-1]
-
-    def getLatestExecution(self) -> Tuple[ProgramInput, ProgramOutput]:
-        return self.executions[-1][-1]
-
     def addCodeVersion(self, newRawCode: str, newCode: str) -> None:
         self.rawCodeVersions.append(newRawCode)
         self.codeVersions.append(newCode)
@@ -178,30 +236,34 @@ class NamedProgram:
 
 
 
-# ProgramDirectory is a class that stores all the programs in the system
+# ProgramDirectory is a class that stores all the programs in the system.
+# Programs are listed from a compact index (see ProgramIndex), and a program's
+# program.json is only loaded when the program is first requested.
+# Execution history is kept for maxExecutionsPerProgram runs and maxExecutionAgeDays per
+# program (see EXECUTION_HISTORY_MAX_RECORDS and EXECUTION_HISTORY_MAX_AGE_DAYS).
 class ProgramDirectory:
-    def __init__(self, localProgramDir: str):
+    def __init__(self, localProgramDir: str, maxExecutionsPerProgram: Optional[int] = None, maxExecutionAgeDays: Optional[float] = None):
+        # Programs that have been loaded from program.json so far
         self.programs = {}
         self.localProgramDir = localProgramDir
         self.programExecutor = None
-
-        # Each program has its own directory, so we need to list all the directories in the program directory
-        for file in os.listdir(localProgramDir):
-            if os.path.isdir(os.path.join(localProgramDir, file)):
-                # Find json file in the directory
-                jsonFile = os.path.join(localProgramDir, file, "program.json")
-                if os.path.exists(jsonFile):
-                    # Load the json file
-                    with open(jsonFile, "r") as f:
-                        program = NamedProgram.from_dict(json.load(f))
-                        if program.name in self.programs:
-                            raise ValueError(f"Program {program.name} already exists")
-                        self.programs[program.name] = program
+        self.lock = threading.RLock()
+        # Names of loaded programs with changes not yet written to program.json
+        self.dirty = set()
+        # Callbacks told which programs changed on disk, see addChangeListener
+        self.changeListeners = []
+        self.index = ProgramIndex(os.path.join(localProgramDir, ".index.sqlite"))
+        # Execution history is kept out of program.json, see ExecutionStore
+        if maxExecutionsPerProgram is None:
+            maxExecutionsPerProgram = _parseLimit(EXECUTION_HISTORY_MAX_RECORDS, int)
+        if maxExecutionAgeDays is None:
+            maxExecutionAgeDays = _parseLimit(EXECUTION_HISTORY_MAX_AGE_DAYS, float)
+        self.executionStore = ExecutionStore(localProgramDir, maxRecordsPerProgram=maxExecutionsPerProgram, maxAgeDays=maxExecutionAgeDays)
 
         self.__refresh__()
 
     def curryProgram(self, programName: str, extraInputs: dict, outputProgramName: str) -> None:
-        program = self.programs[programName]
+        program = self.getProgram(programName)
         # clone the program
         newProgram = program.clone()
         newProgram.name = outputProgramName
@@ -222,42 +284,173 @@ class ProgramDirectory:
         self.addNewNamedProgram(newProgram)
        
 
+    # Flags a loaded program whose in-memory state changed, so the next save() writes it
+    def markDirty(self, programName: str) -> None:
+        with self.lock:
+            if programName not in self.programs:
+                raise ValueError(f"Program {programName} is not loaded")
+            self.dirty.add(programName)
+
+    # Writes only the programs that changed since they were last saved
     def save(self) -> None:
-        for programName, program in self.programs.items():
-            programDir = os.path.join(self.localProgramDir, programName)
-            if not os.path.exists(programDir):
-                os.makedirs(programDir)
-
-            # Create the code file if it doesn't exist
-            codeFile = os.path.join(programDir, "code.itom")
-            if not os.path.exists(codeFile):
-                with open(codeFile, "w") as f:
-                    f.write(program.getLatestRawCode())
-
-            # Write out the program JSON file
-            with open(os.path.join(self.localProgramDir, programName, "program.json"), "w") as f:
-                f.write(program.toJson())
-
-    def __refresh__(self) -> None:
+        with self.lock:
+            for programName in sorted(self.dirty):
+                self.__saveProgram__(self.programs[programName])
+
+    def __saveProgram__(self, program: NamedProgram) -> None:
+        programDir = os.path.join(self.localProgramDir, program.name)
+        if not os.path.exists(programDir):
+            os.makedirs(programDir)
+
+        # Create the code file if it doesn't exist
+        codeFile = os.path.join(programDir, "code.itom")
+        if not os.path.exists(codeFile):
+            writeFileAtomically(codeFile, program.getLatestRawCode())
+
+        # Write out the program JSON file
+        jsonFile = os.path.join(programDir, "program.json")
+        writeFileAtomically(jsonFile, program.toJson())
+        self.index.update(program, ProgramIndex.statFile(jsonFile))
+        self.dirty.discard(program.name)
+
+    def __loadProgram__(self, programName: str) -> NamedProgram:
+        with open(os.path.join(self.localProgramDir, programName, "program.json"), "rb") as f:
+            text = f.read()
+        program = NamedProgram.from_dict(orjson.loads(text) if orjson is not None else json.loads(text))
+        self.programs[programName] = program
+        return program
+
+    # Registers a callback that is called with the names of programs that were added,
+    # changed or removed on disk, e.g. to drop caches keyed by program name
+    def addChangeListener(self, listener: Callable[[List[str]], None]) -> None:
+        with self.lock:
+            self.changeListeners.append(listener)
+
+    def removeChangeListener(self, listener: Callable[[List[str]], None]) -> None:
+        with self.lock:
+            self.changeListeners.remove(listener)
+
+    def __notifyChanged__(self, programNames: Iterable[str]) -> None:
+        programNames = sorted(programNames)
+        if len(programNames) == 0:
+            return
+        for listener in list(self.changeListeners):
+            try:
+                listener(programNames)
+            except Exception as e:
+                print(f"WARNING: program change listener failed: {e}")
+
+    # Rescans the whole program directory. Returns the names of the programs that changed.
+    def refresh(self) -> List[str]:
+        changed = self.__refresh__()
+        self.__notifyChanged__(changed)
+        return sorted(changed)
+
+    def __refresh__(self) -> set:
+        with self.lock:
+            indexedStats = self.index.getStats()
+            seen = set()
+            changed = set()
+
+            # Each program has its own directory; only stat the files and compare with the index
+            for entry in os.scandir(self.localProgramDir):
+                if not entry.is_dir():
+                    continue
+                programName = entry.name
+                jsonStat = ProgramIndex.statFile(os.path.join(entry.path, "program.json"))
+                if jsonStat is None:
+                    continue
+                seen.add(programName)
+
+                indexedJsonStat, indexedCodeStat = indexedStats.get(programName, (None, None))
+                if self.__refreshFiles__(programName, jsonStat, indexedJsonStat, indexedCodeStat):
+                    changed.add(programName)
+
+            # Forget programs whose directory is gone
+            for programName in indexedStats:
+                if programName not in seen:
+                    self.__forgetProgram__(programName)
+                    changed.add(programName)
+            return changed
+
+    # Rechecks only the named programs, e.g. the ones a file watcher saw change.
+    # Returns the names of the programs that changed.
+    def refreshPrograms(self, programNames: Iterable[str]) -> List[str]:
+        changed = set()
+        with self.lock:
+            for programName in set(programNames):
+                jsonStat = ProgramIndex.statFile(os.path.join(self.localProgramDir, programName, "program.json"))
+                indexedJsonStat, indexedCodeStat = self.index.getFileStats(programName)
+                if jsonStat is None:
+                    if indexedJsonStat is not None or programName in self.programs:
+                        self.__forgetProgram__(programName)
+                        changed.add(programName)
+                    continue
+                try:
+                    if self.__refreshFiles__(programName, jsonStat, indexedJsonStat, indexedCodeStat):
+                        changed.add(programName)
+                except Exception as e:
+                    # e.g. an editor saved a half-written header; the next change retries
+                    print(f"WARNING: could not refresh program {programName}: {e}")
+        self.__notifyChanged__(changed)
+        return sorted(changed)
+
+    def __refreshFiles__(self, programName: str, jsonStat: Tuple[int, int], indexedJsonStat: Optional[Tuple[int, int]], indexedCodeStat: Optional[Tuple[int, int]]) -> bool:
         changed = False
-        for programName, program in self.programs.items():
-            # Load the code file and update the program if it has changed
-            programDir = os.path.join(self.localProgramDir, programName)
-            with open(os.path.join(programDir, "code.itom"), "r") as f:
-                rawCodeText = f.read()
-                if rawCodeText != program.getLatestRawCode():
-                    remainingCode, description, dslId, inputs, outputs,config = NamedProgram.__processCodeHeader__(rawCodeText)
-                    program.addCodeVersion(rawCodeText, remainingCode)
-                    program.description = description
-                    program.dslId = dslId
-                    program.inputs = inputs
-                    program.outputs = outputs
-                    program.config = config
-                    changed = True
+        if jsonStat != indexedJsonStat:
+            # program.json is new or changed, so parse it and recheck its code file
+            program = self.__loadProgram__(programName)
+            self.index.update(program, jsonStat)
+            self.index.updateCodeStat(programName, None, None)
+            indexedCodeStat = None
+            changed = True
+        return self.__refreshCode__(programName, indexedCodeStat) or changed
+
+    def __forgetProgram__(self, programName: str) -> None:
+        self.index.remove(programName)
+        self.programs.pop(programName, None)
+        self.dirty.discard(programName)
+
+    # Rereads a program's code.itom if its size or mtime changed since it was indexed.
+    # Returns True if the code changed and a new code version was added.
+    def refreshProgram(self, programName: str) -> bool:
+        with self.lock:
+            _, indexedCodeStat = self.index.getFileStats(programName)
+            changed = self.__refreshCode__(programName, indexedCodeStat)
         if changed:
+            self.__notifyChanged__([programName])
+        return changed
+
+    def __refreshCode__(self, programName: str, indexedCodeStat: Optional[Tuple[int, int]]) -> bool:
+        codeFile = os.path.join(self.localProgramDir, programName, "code.itom")
+        codeStat = ProgramIndex.statFile(codeFile)
+        if codeStat is None or codeStat == indexedCodeStat:
+            return False
+
+        # Load the code file and update the program if it has changed
+        with open(codeFile, "r") as f:
+            rawCodeText = f.read()
+        program = self.getProgram(programName)
+        changed = False
+        if rawCodeText != program.getLatestRawCode():
+            remainingCode, description, dslId, inputs, outputs,config = NamedProgram.__processCodeHeader__(rawCodeText)
+            program.addCodeVersion(rawCodeText, remainingCode)
+            program.description = description
+            program.dslId = dslId
+            program.inputs = inputs
+            program.outputs = outputs
+            program.config = config
+            self.markDirty(programName)
             self.save()
+            changed = True
+        self.index.updateCodeStat(programName, codeStat, hashlib.sha256(rawCodeText.encode()).hexdigest())
+        return changed
 
     def addNewNamedProgram(self,program:NamedProgram) -> None:
+        with self.lock:
+            self.__addNewNamedProgram__(program)
+
+    def __addNewNamedProgram__(self,program:NamedProgram) -> None:
         # add the the program to the program directory
         self.programs[program.name] = program
         programName = program.name
@@ -271,25 +464,26 @@ class ProgramDirectory:
         # remove all the #@ lines 
         code = re.sub(r'^#@.*\n', '', code, flags=re.MULTILINE)
         newCode = str(program.getHeader()) + "\n" + code
-        with open(codeFile, "w") as f:
-            f.write(newCode)
+        writeFileAtomically(codeFile, newCode)
 
         # Write out the program JSON file
-        with open(os.path.join(self.localProgramDir, programName, "program.json"), "w") as f:
-            f.write(program.toJson())
+        self.markDirty(programName)
+        self.save()
 
     def addNewProgram(self, programName: str, metadataComment: str, rawCode: str, refresh: bool = False) -> None:
-        if programName not in self.programs:
+        if not self.hasProgram(programName):
             print(f"Adding new program {programName}")
             program = NamedProgram.from_code(programName, rawCode)
-            self.programs[program.name] = program
-            self.save()
+            with self.lock:
+                self.programs[program.name] = program
+                self.markDirty(program.name)
+                self.save()
         else:
             if not refresh:
                 raise ValueError(f"Program {programName} already exists")
             else:
                 # Copy the new program source file (code.itom)to the program directory and refresh
-                program = self.programs[programName]
+                program = self.getProgram(programName)
                 needToUpdate = False
                 if program.getLatestRawCode() != rawCode:
                     needToUpdate = True
@@ -298,21 +492,39 @@ class ProgramDirectory:
                     programDir = os.path.join(self.localProgramDir, programName)
                     if os.path.exists(programDir):
                         # Copy the new program source file (code.itom) to the program directory
-                        with open(os.path.join(programDir, "code.itom"), "w") as f:
-                            f.write(rawCode)
+                        writeFileAtomically(os.path.join(programDir, "code.itom"), rawCode)
 
                     print(f"Updating program {programName}")
-                    self.__refresh__()
+                    self.refreshProgram(programName)
 
 
 
+    def hasProgram(self, programName: str) -> bool:
+        return programName in self.programs or self.index.hasProgram(programName)
+
+    # Loads every program; prefer getProgramSummaries when only listing programs
     def getPrograms(self) -> List[NamedProgram]:
-        return list(self.programs.values())
+        return [self.getProgram(summary.name) for summary in self.index.getSummaries()]
+
+    def getProgramSummaries(self) -> List[ProgramSummary]:
+        return self.index.getSummaries()
 
     def getProgram(self, programName: str) -> NamedProgram:
-        if programName not in self.programs:
-            raise ValueError(f"Program {programName} not found")
-        return self.programs[programName]
+        if programName in self.programs:
+            return self.programs[programName]
+        with self.lock:
+            if programName in self.programs:
+                return self.programs[programName]
+            if not self.index.hasProgram(programName):
+                raise ValueError(f"Program {programName} not found")
+            return self.__loadProgram__(programName)
+
+    def getExecutionStore(self) -> ExecutionStore:
+        return self.executionStore
+
+    # Returns the most recent executions of a program, newest first
+    def getExecutionHistory(self, programName: str, limit: int = 50) -> List[dict]:
+        return self.executionStore.query(programName, limit=limit)
 
     def setProgramExecutor(self, programExecutor: "ProgramExecutor") -> None:
         self.programExecutor = programExecutor
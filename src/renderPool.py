@@ -0,0 +1,159 @@
+from concurrent.futures import Future
+from typing import Optional, Tuple
+import atexit
+import queue
+import threading
+
+
+# RenderRequest describes a single HTML to PNG conversion
+class RenderRequest:
+    def __init__(self, html: str, viewport: Optional[Tuple[int, int]] = None, deviceScaleFactor: float = 1, fullPage: bool = True, maxHeight: Optional[int] = None):
+        self.html = html
+        self.viewport = viewport
+        self.deviceScaleFactor = deviceScaleFactor
+        self.fullPage = fullPage
+        # Full page screenshots are cut off below this many CSS pixels
+        self.maxHeight = maxHeight
+
+    def contextKey(self) -> tuple:
+        # Pages can be reused for any request with the same context options
+        return (self.viewport, self.deviceScaleFactor)
+
+
+# RenderSlot is a warm browser context with a single page
+class RenderSlot:
+    def __init__(self, context, page):
+        self.context = context
+        self.page = page
+        self.uses = 0
+
+    def close(self) -> None:
+        try:
+            self.context.close()
+        except Exception:
+            pass
+
+
+# RenderPool is a process-wide service that converts HTML to PNG using warm headless
+# Chromium pages. Each worker thread owns its own Playwright instance and browser
+# (the sync Playwright API is bound to the thread that started it), and keeps a small
+# set of contexts keyed by viewport and device scale. Pages are recycled after
+# maxUsesPerPage renders, and the browser is relaunched if it crashes.
+class RenderPool:
+    def __init__(self, size: int = 2, maxUsesPerPage: int = 100, maxContextsPerWorker: int = 4):
+        self.size = size
+        self.maxUsesPerPage = maxUsesPerPage
+        self.maxContextsPerWorker = maxContextsPerWorker
+        self.requests = queue.Queue()
+        self.workers = []
+        self.lock = threading.Lock()
+
+    def render(self, html: str, viewport: Optional[Tuple[int, int]] = None, deviceScaleFactor: float = 1, fullPage: bool = True, maxHeight: Optional[int] = None) -> bytes:
+        self.__ensureWorkers__()
+        future = Future()
+        self.requests.put((RenderRequest(html, viewport, deviceScaleFactor, fullPage, maxHeight), future))
+        return future.result()
+
+    def shutdown(self) -> None:
+        with self.lock:
+            for _ in self.workers:
+                self.requests.put(None)
+            for worker in self.workers:
+                worker.join(timeout=10)
+            self.workers = []
+
+    def __ensureWorkers__(self) -> None:
+        with self.lock:
+            while len(self.workers) < self.size:
+                worker = threading.Thread(target=self.__workerLoop__, name=f"render-pool-{len(self.workers)}", daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def __workerLoop__(self) -> None:
+        playwright = None
+        browser = None
+        slots = {}
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+            request, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            slot = None
+            try:
+                if playwright is None:
+                    from playwright.sync_api import sync_playwright
+                    playwright = sync_playwright().start()
+                if browser is None or not browser.is_connected():
+                    slots = {}
+                    browser = playwright.chromium.launch()
+                slot = self.__getSlot__(browser, slots, request)
+                slot.page.set_content(request.html)
+                png_bytes = self.__screenshot__(slot.page, request)
+                slot.uses += 1
+                if slot.uses >= self.maxUsesPerPage:
+                    slots.pop(request.contextKey(), None)
+                    slot.close()
+                future.set_result(png_bytes)
+            except Exception as e:
+                # Throw away the slot, it may have crashed
+                if slot is not None:
+                    slots.pop(request.contextKey(), None)
+                    slot.close()
+                future.set_exception(e)
+
+        for slot in slots.values():
+            slot.close()
+        if browser is not None:
+            try:
+                browser.close()
+            except Exception:
+                pass
+        if playwright is not None:
+            playwright.stop()
+
+    def __screenshot__(self, page, request: RenderRequest) -> bytes:
+        if request.fullPage and request.maxHeight is not None:
+            width, height = page.evaluate("() => [document.documentElement.scrollWidth, document.documentElement.scrollHeight]")
+            if height > request.maxHeight:
+                clip = {"x": 0, "y": 0, "width": width, "height": request.maxHeight}
+                return page.screenshot(full_page=True, clip=clip, type="png")
+        return page.screenshot(full_page=request.fullPage, type="png")
+
+    def __getSlot__(self, browser, slots: dict, request: RenderRequest) -> RenderSlot:
+        key = request.contextKey()
+        if key in slots:
+            # Move to the end so that the least recently used slot is evicted first
+            slot = slots.pop(key)
+            slots[key] = slot
+            return slot
+
+        if len(slots) >= self.maxContextsPerWorker:
+            oldestKey = next(iter(slots))
+            slots.pop(oldestKey).close()
+
+        contextOptions = {"device_scale_factor": request.deviceScaleFactor}
+        if request.viewport is not None:
+            contextOptions["viewport"] = {"width": request.viewport[0], "height": request.viewport[1]}
+        context = browser.new_context(**contextOptions)
+        slot = RenderSlot(context, context.new_page())
+        slots[key] = slot
+        return slot
+
+
+renderPool = None
+renderPoolLock = threading.Lock()
+
+def getRenderPool() -> RenderPool:
+    global renderPool
+    with renderPoolLock:
+        if renderPool is None:
+            renderPool = RenderPool()
+            atexit.register(renderPool.shutdown)
+        return renderPool
+
+# Convenience wrapper used by the DSL processors
+def renderHtmlToPng(html: str, viewport: Optional[Tuple[int, int]] = None, deviceScaleFactor: float = 1, fullPage: bool = True, maxHeight: Optional[int] = None) -> bytes:
+    return getRenderPool().render(html, viewport=viewport, deviceScaleFactor=deviceScaleFactor, fullPage=fullPage, maxHeight=maxHeight)
@@ -0,0 +1,123 @@
+from programs import ProgramOutput
+from typing import Optional
+import hashlib
+import json
+import os
+import pickle
+import threading
+import uuid
+
+
+# ResultCache is a persistent, content-addressed store of ProgramOutputs.
+# Entries live as one pickle file per key in the cache directory; the key is
+# computed by the caller (see ProgramExecutor) from everything that can change
+# the output. Eviction is size-based LRU, using the file mtime as the recency
+# marker so that several processes can share the same directory.
+class ResultCache:
+    def __init__(self, cacheDir: str = ".result_cache", maxBytes: int = 512 * 1024 * 1024):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        # The total size is computed lazily on the first write
+        self.currentSize = None
+
+    @classmethod
+    def computeKey(cls, keyMaterial: dict) -> str:
+        # Canonicalize so that dict ordering and formatting do not change the key
+        canonical = json.dumps(keyMaterial, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def __entryPath__(self, key: str) -> str:
+        return os.path.join(self.cacheDir, f"{key}.pkl")
+
+    def get(self, key: str) -> Optional[ProgramOutput]:
+        path = self.__entryPath__(key)
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+        except Exception:
+            # Missing or unreadable entries are treated as a miss
+            return None
+
+        # Touch the entry so that it is the most recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return ProgramOutput(entry["endTimestamp"], entry["visualReturnType"], entry["viz"], entry["data"])
+
+    def put(self, key: str, output: ProgramOutput) -> None:
+        entry = {
+            "endTimestamp": output.endTimestamp(),
+            "visualReturnType": output.visualReturnType(),
+            "viz": output.viz(),
+            "data": output.data()
+        }
+        try:
+            payload = pickle.dumps(entry)
+        except Exception as e:
+            print(f"WARNING: could not cache result: {e}")
+            return
+
+        if len(payload) > self.maxBytes:
+            return
+
+        if not os.path.exists(self.cacheDir):
+            os.makedirs(self.cacheDir, exist_ok=True)
+
+        # Write to a temp file first so that readers never see a partial entry
+        path = self.__entryPath__(key)
+        tempPath = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tempPath, "wb") as f:
+            f.write(payload)
+        os.replace(tempPath, path)
+
+        with self.lock:
+            if self.currentSize is None:
+                self.currentSize = self.__scanSize__()
+            else:
+                self.currentSize += len(payload)
+            if self.currentSize > self.maxBytes:
+                self.__evict__()
+
+    def clear(self) -> None:
+        with self.lock:
+            if os.path.exists(self.cacheDir):
+                for entry in os.scandir(self.cacheDir):
+                    if entry.name.endswith(".pkl"):
+                        os.remove(entry.path)
+            self.currentSize = 0
+
+    def __scanSize__(self) -> int:
+        total = 0
+        for entry in os.scandir(self.cacheDir):
+            if entry.name.endswith(".pkl"):
+                try:
+                    total += entry.stat().st_size
+                except OSError:
+                    pass
+        return total
+
+    def __evict__(self) -> None:
+        # Remove least recently used entries until we are back under the limit
+        entries = []
+        for entry in os.scandir(self.cacheDir):
+            if entry.name.endswith(".pkl"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self.currentSize = total
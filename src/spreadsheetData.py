@@ -0,0 +1,155 @@
+from lruCache import LRUCache
+from spreadsheetFormula import columnToIndex, splitCellRef
+from typing import Any, List, Optional, Tuple
+import csv
+import os
+import re
+import numpy as np
+
+# pyarrow is optional; it reads CSV much faster and is needed for Parquet and Arrow files,
+# which it memory-maps so that numeric columns are used without being copied
+try:
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# @load <anchor> <path> [noheader]
+LOAD_DIRECTIVE_PATTERN = re.compile(r'@load\s+([A-Z]+\d+)\s+(.+?)(?:\s+(noheader))?$')
+
+PARQUET_EXTENSIONS = (".parquet", ".pq")
+ARROW_EXTENSIONS = (".arrow", ".feather", ".ipc")
+
+# Loaded tables by (path, mtime, size), bounded by the size of their arrays
+loadedTables = LRUCache(maxEntries=64, maxBytes=1024 * 1024 * 1024,
+                        sizeOf=lambda table: sum(column.nbytes for column in table.columns))
+
+
+# DataTable is a file loaded column by column. Numeric columns are float64 arrays with
+# NaN for missing values; any other column is an object array of strings (or None).
+class DataTable:
+    def __init__(self, names: List[str], columns: List[np.ndarray], sourceKey: tuple = ()):
+        self.names = names
+        self.columns = columns
+        self.rowCount = len(columns[0]) if len(columns) > 0 else 0
+        # Identifies the file contents the table was loaded from
+        self.sourceKey = sourceKey
+
+    @classmethod
+    def isNumeric(cls, column: np.ndarray) -> bool:
+        return column.dtype.kind == "f"
+
+
+# DataBlock places a DataTable on a sheet with its top left corner at an anchor cell.
+# Unless header is False, the column names take up the anchor row and data starts below it.
+class DataBlock:
+    def __init__(self, anchor: str, path: str, table: DataTable, header: bool = True):
+        column, row = splitCellRef(anchor)
+        self.anchor = anchor
+        self.path = path
+        self.table = table
+        self.header = header
+        self.firstColumn = columnToIndex(column)
+        self.lastColumn = self.firstColumn + len(table.columns) - 1
+        self.headerRow = row if header else None
+        self.firstRow = row + 1 if header else row
+        self.lastRow = self.firstRow + table.rowCount - 1
+
+    def key(self) -> tuple:
+        # Blocks with equal keys hold the same data, so a sheet need not be recalculated
+        return (self.anchor, self.header, self.table.sourceKey)
+
+    def contains(self, column: int, row: int) -> bool:
+        return self.firstColumn <= column <= self.lastColumn and \
+            (self.headerRow if self.header else self.firstRow) <= row <= self.lastRow
+
+    # The value of a cell in the block as the sheet sees it: a float, a string or None
+    def getValue(self, column: int, row: int) -> Any:
+        if not self.contains(column, row):
+            return None
+        index = column - self.firstColumn
+        if row == self.headerRow:
+            return self.table.names[index]
+        value = self.table.columns[index][row - self.firstRow]
+        if DataTable.isNumeric(self.table.columns[index]):
+            return None if np.isnan(value) else float(value)
+        return value
+
+
+# Parses a "@load <anchor> <path> [noheader]" line, or returns None if it is not one
+def parseLoadDirective(line: str) -> Optional[Tuple[str, str, bool]]:
+    match = LOAD_DIRECTIVE_PATTERN.match(line)
+    if match is None:
+        return None
+    return match.group(1), match.group(2).strip(), match.group(3) is None
+
+
+def loadDataBlock(anchor: str, path: str, header: bool = True) -> DataBlock:
+    return DataBlock(anchor, path, loadTable(path, header), header)
+
+
+# Loads a CSV, Parquet or Arrow file, reusing the last load while the file is unchanged
+def loadTable(path: str, header: bool = True) -> DataTable:
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size, header)
+    cached = loadedTables.get(key)
+    if cached is not None:
+        return cached
+
+    lowerPath = path.lower()
+    if lowerPath.endswith(PARQUET_EXTENSIONS):
+        names, columns = _fromArrow(_requirePyarrow(path).parquet.read_table(path, memory_map=True))
+    elif lowerPath.endswith(ARROW_EXTENSIONS):
+        names, columns = _fromArrow(_requirePyarrow(path).ipc.open_file(pyarrow.memory_map(path)).read_all())
+    elif pyarrow is not None:
+        readOptions = pyarrow.csv.ReadOptions(autogenerate_column_names=not header)
+        names, columns = _fromArrow(pyarrow.csv.read_csv(path, read_options=readOptions))
+    else:
+        names, columns = _readCsv(path, header)
+
+    table = DataTable(names, columns, key)
+    loadedTables.put(key, table)
+    return table
+
+
+def _requirePyarrow(path: str):
+    if pyarrow is None:
+        raise ImportError(f"pyarrow is required to load {path}")
+    return pyarrow
+
+
+def _fromArrow(table) -> Tuple[List[str], List[np.ndarray]]:
+    columns = []
+    for column in table.columns:
+        if pyarrow.types.is_integer(column.type) or pyarrow.types.is_floating(column.type) or pyarrow.types.is_boolean(column.type):
+            # float64 columns without nulls come straight from the (memory-mapped) buffers
+            if column.num_chunks == 1 and pyarrow.types.is_float64(column.type) and column.null_count == 0:
+                columns.append(column.chunk(0).to_numpy(zero_copy_only=True))
+            else:
+                columns.append(column.cast(pyarrow.float64()).to_numpy(zero_copy_only=False).astype(np.float64))
+        else:
+            columns.append(np.array([None if value is None else str(value) for value in column.to_pylist()], dtype=object))
+    return [str(name) for name in table.column_names], columns
+
+
+def _readCsv(path: str, header: bool) -> Tuple[List[str], List[np.ndarray]]:
+    with open(path, newline="") as f:
+        rows = list(csv.reader(f))
+    if header and len(rows) > 0:
+        names, rows = rows[0], rows[1:]
+    else:
+        names = []
+    width = max([len(names)] + [len(row) for row in rows])
+    names = names + [f"f{index}" for index in range(len(names), width)]
+
+    columns = []
+    for index in range(width):
+        texts = [row[index] if index < len(row) else "" for row in rows]
+        try:
+            columns.append(np.array([float(text) if text.strip() != "" else np.nan for text in texts], dtype=np.float64))
+        except ValueError:
+            columns.append(np.array([text if text != "" else None for text in texts], dtype=object))
+    return names, columns
@@ -1,18 +1,32 @@
 from dslProcessor import PreprocessedDSL
-from programs import ProgramOutput, ProgramDirectory, TracerNode
-from typing import List, Dict, Optional
+from programs import NamedProgram, ProgramOutput, ProgramDirectory, TracerNode
+from typing import List, Dict, Iterator, Mapping, Optional, Tuple
+import hashlib
+import json
+import threading
 import time
 import re
-from playwright.sync_api import sync_playwright
+from renderPool import renderHtmlToPng
+from lruCache import LRUCache
+from spreadsheetEngine import SpreadsheetEngine, SheetValues, columnToIndex, indexToColumn, splitCellRef
+from spreadsheetData import DataBlock, loadDataBlock, parseLoadDirective
 
 
 class SpreadsheetDSLProcessor(PreprocessedDSL):
     def __init__(self, programDirectory: ProgramDirectory):
         super().__init__(programDirectory)
+        self.engineCache = LRUCache(maxEntries=32)
+        self.engineCacheLock = threading.Lock()
     
     def getVisualReturnTypes(self) -> List[str]:
         return ["html", "png"]
     
+    def getIncludedProgramNames(self, program: NamedProgram) -> Optional[List[str]]:
+        # Files named by @load lines change without the itom changing, so such sheets are never result cached
+        if any(line.strip().startswith("@load") for line in program.codeVersions[-1].split("\n")):
+            return None
+        return super().getIncludedProgramNames(program)
+
     def getIncludableTypes(self) -> List[str]:
         return ["html"]
 
@@ -22,14 +36,16 @@ class SpreadsheetDSLProcessor(PreprocessedDSL):
         
         # Parse spreadsheet definition
         grid = self._parseSpreadsheet(processedCode, input)
+        data_blocks = self._loadDataBlocks(processedCode)
 
         # Calculate all formulas
-        calculated_grid = self._calculateFormulas(grid)
+        calculated_grid = self._calculateFormulas(grid, data_blocks)
         # Generate visual output
+        row_start, row_count = self._getRowWindow(config)
         if preferredVisualReturnType == "html":
-            visualOutput = self._generateHtmlTable(calculated_grid)
+            visualOutput = self._generateHtmlTable(calculated_grid, row_start, row_count)
         else:  # png
-            visualOutput = self._generatePngTable(calculated_grid)
+            visualOutput = self._generatePngTable(calculated_grid, row_start, row_count, config)
 
         # Extract output data
         outputData = {}
@@ -48,7 +64,7 @@ class SpreadsheetDSLProcessor(PreprocessedDSL):
         
         for line in code.strip().split('\n'):
             line = line.strip()
-            if not line or line.startswith('#'):
+            if not line or line.startswith('#') or line.startswith('@'):
                 continue
                 
             match = re.match(cell_pattern, line)
@@ -67,190 +83,97 @@ class SpreadsheetDSLProcessor(PreprocessedDSL):
         
         return grid
     
-    def _calculateFormulas(self, grid: Dict) -> Dict:
+    def _loadDataBlocks(self, code: str) -> List[DataBlock]:
+        """Load the files named by @load <anchor> <path> [noheader] lines"""
+        data_blocks = []
+        for line in code.strip().split('\n'):
+            directive = parseLoadDirective(line.strip())
+            if directive is not None:
+                anchor, path, header = directive
+                data_blocks.append(loadDataBlock(anchor, path, header))
+        return data_blocks
+
+    def _calculateFormulas(self, grid: Dict, data_blocks: Optional[List[DataBlock]] = None) -> Mapping:
         """Calculate all formulas in the grid"""
-        calculated = {}
-        
-        # First pass: handle non-formula values
-        for cell_ref, value in grid.items():
-            if not value.startswith('='):
-                try:
-                    calculated[cell_ref] = float(value)
-                except ValueError:
-                    calculated[cell_ref] = value
-        
-        # Second pass: handle formulas (simple implementation)
-        for cell_ref, value in grid.items():
-            if value.startswith('='):
-                formula = value[1:]  # Remove =
-                calculated[cell_ref] = self._evaluateFormula(formula, calculated)
-        
-        return calculated
-    
-    def _evaluateFormula(self, formula: str, calculated: Dict) -> float:
-        """Evaluate a formula"""
-        # Simple formula evaluation for basic functions
-        
-        # SUM function
-        if formula.startswith('SUM('):
-            range_match = re.match(r'SUM\(([A-Z]+\d+):([A-Z]+\d+)\)', formula)
-            if range_match:
-                start_cell = range_match.group(1)
-                end_cell = range_match.group(2)
-                return self._sumRange(start_cell, end_cell, calculated)
-        
-        # AVERAGE function
-        elif formula.startswith('AVERAGE('):
-            range_match = re.match(r'AVERAGE\(([A-Z]+\d+):([A-Z]+\d+)\)', formula)
-            if range_match:
-                start_cell = range_match.group(1)
-                end_cell = range_match.group(2)
-                return self._averageRange(start_cell, end_cell, calculated)
-        
-        # MAX function
-        elif formula.startswith('MAX('):
-            range_match = re.match(r'MAX\(([A-Z]+\d+):([A-Z]+\d+)\)', formula)
-            if range_match:
-                start_cell = range_match.group(1)
-                end_cell = range_match.group(2)
-                return self._maxRange(start_cell, end_cell, calculated)
-        
-        # MIN function
-        elif formula.startswith('MIN('):
-            range_match = re.match(r'MIN\(([A-Z]+\d+):([A-Z]+\d+)\)', formula)
-            if range_match:
-                start_cell = range_match.group(1)
-                end_cell = range_match.group(2)
-                return self._minRange(start_cell, end_cell, calculated)
-        
-        # Simple arithmetic with cell references
-        else:
-            # Replace cell references with values
-            for cell_ref, value in calculated.items():
-                if isinstance(value, (int, float)):
-                    formula = formula.replace(cell_ref, str(value))
-            
-            try:
-                return eval(formula)  # Simple evaluation
-            except:
-                return 0.0
-        
-        return 0.0
-    
-    def _sumRange(self, start_cell: str, end_cell: str, calculated: Dict) -> float:
-        """Sum values in a range"""
-        cells = self._getCellsInRange(start_cell, end_cell)
-        total = 0.0
-        for cell in cells:
-            if cell in calculated and isinstance(calculated[cell], (int, float)):
-                total += calculated[cell]
-        return total
-    
-    def _averageRange(self, start_cell: str, end_cell: str, calculated: Dict) -> float:
-        """Average values in a range"""
-        cells = self._getCellsInRange(start_cell, end_cell)
-        values = []
-        for cell in cells:
-            if cell in calculated and isinstance(calculated[cell], (int, float)):
-                values.append(calculated[cell])
-        return sum(values) / len(values) if values else 0.0
-    
-    def _maxRange(self, start_cell: str, end_cell: str, calculated: Dict) -> float:
-        """Max value in a range"""
-        cells = self._getCellsInRange(start_cell, end_cell)
-        values = []
-        for cell in cells:
-            if cell in calculated and isinstance(calculated[cell], (int, float)):
-                values.append(calculated[cell])
-        return max(values) if values else 0.0
+        engine, lock = self._getEngine(grid)
+        with lock:
+            engine.setDataBlocks(data_blocks if data_blocks is not None else [])
+            engine.load(grid)
+            return engine.getSheetValues()
+
+    def _getEngine(self, grid: Dict) -> Tuple[SpreadsheetEngine, threading.Lock]:
+        """Get the engine for a sheet, reusing the one from the last run of the same formulas"""
+        # Runs of the same sheet usually differ only in their input cells, so reusing the
+        # engine keeps the dependency graph and recomputes just what the inputs feed
+        signature = hashlib.sha256(json.dumps(sorted(
+            (cell_ref, value) for cell_ref, value in grid.items()
+            if isinstance(value, str) and value.startswith('=')
+        )).encode()).hexdigest()
+        with self.engineCacheLock:
+            cached = self.engineCache.get(signature)
+            if cached is None:
+                cached = (SpreadsheetEngine(), threading.Lock())
+                self.engineCache.put(signature, cached)
+        return cached
     
-    def _minRange(self, start_cell: str, end_cell: str, calculated: Dict) -> float:
-        """Min value in a range"""
-        cells = self._getCellsInRange(start_cell, end_cell)
-        values = []
-        for cell in cells:
-            if cell in calculated and isinstance(calculated[cell], (int, float)):
-                values.append(calculated[cell])
-        return min(values) if values else 0.0
-    
-    def _getCellsInRange(self, start_cell: str, end_cell: str) -> List[str]:
-        """Get all cells in a range like A1:A5"""
-        start_col = re.match(r'([A-Z]+)', start_cell).group(1)
-        start_row = int(re.match(r'[A-Z]+(\d+)', start_cell).group(1))
-        end_col = re.match(r'([A-Z]+)', end_cell).group(1)
-        end_row = int(re.match(r'[A-Z]+(\d+)', end_cell).group(1))
-        
-        cells = []
-        # Simple implementation for single column ranges
-        if start_col == end_col:
-            for row in range(start_row, end_row + 1):
-                cells.append(f"{start_col}{row}")
-        
-        return cells
-    
-    def _generateHtmlTable(self, grid: Dict) -> str:
-        """Generate HTML table from grid"""
-        if not grid:
-            return "<table><tr><td>Empty spreadsheet</td></tr></table>"
-        
-        # Find grid dimensions
+    def _getGridSize(self, grid: Mapping) -> Tuple[int, int]:
+        """Get the number of rows and columns used by the grid"""
+        if isinstance(grid, SheetValues):
+            return grid.getSize()
         max_row = 0
         max_col = 0
         for cell_ref in grid.keys():
-            col_match = re.match(r'([A-Z]+)', cell_ref)
-            row_match = re.match(r'[A-Z]+(\d+)', cell_ref)
-            if col_match and row_match:
-                col = col_match.group(1)
-                row = int(row_match.group(1))
-                max_row = max(max_row, row)
-                max_col = max(max_col, ord(col) - ord('A') + 1)
-        
-        html = "<table border='1' style='border-collapse: collapse;'>"
-        
-        # Header row
-        html += "<tr><th></th>"
-        for col_idx in range(max_col):
-            col_letter = chr(ord('A') + col_idx)
-            html += f"<th>{col_letter}</th>"
-        html += "</tr>"
-        
-        # Data rows
-        for row in range(1, max_row + 1):
-            html += f"<tr><th>{row}</th>"
-            for col_idx in range(max_col):
-                col_letter = chr(ord('A') + col_idx)
-                cell_ref = f"{col_letter}{row}"
-                value = grid.get(cell_ref, "")
-                html += f"<td>{value}</td>"
-            html += "</tr>"
-        
-        html += "</table>"
-        return html
-    
-    def _generatePngTable(self, grid: Dict) -> bytes:
-        """Generate PNG image from grid (simple text-based)"""
-        # For now, return HTML as PNG would require additional dependencies
-        html = self._generateHtmlTable(grid)
-
-        # Convert HTML to PNG
-        with sync_playwright() as p:
-            browser = p.chromium.launch()
-            page = browser.new_page()
-            page.set_content(html)
-            png_bytes = page.screenshot(full_page=True, type="png")
-            browser.close()
-            return png_bytes
-
-
-
-
-
+            try:
+                col, row = splitCellRef(cell_ref)
+            except ValueError:
+                continue
+            max_row = max(max_row, row)
+            max_col = max(max_col, columnToIndex(col) + 1)
+        return max_row, max_col
 
+    def _iterHtmlTable(self, grid: Dict, row_start: int = 1, row_count: Optional[int] = None) -> Iterator[str]:
+        """Generate an HTML table from the grid piece by piece, optionally only a window of rows"""
+        max_row, max_col = self._getGridSize(grid)
+        if max_row == 0:
+            yield "<table><tr><td>Empty spreadsheet</td></tr></table>"
+            return
 
+        row_start = max(1, row_start)
+        row_end = max_row if row_count is None else min(max_row, row_start + row_count - 1)
+        col_letters = [indexToColumn(col_idx) for col_idx in range(max_col)]
 
+        yield "<table border='1' style='border-collapse: collapse;'>"
+        if row_start > 1 or row_end < max_row:
+            yield f"<caption>Rows {row_start}-{row_end} of {max_row}</caption>"
 
+        # Header row
+        yield "<tr><th></th>" + "".join(f"<th>{col_letter}</th>" for col_letter in col_letters) + "</tr>"
 
+        # Data rows
+        for row in range(row_start, row_end + 1):
+            cells = "".join(f"<td>{grid.get(f'{col_letter}{row}', '')}</td>" for col_letter in col_letters)
+            yield f"<tr><th>{row}</th>{cells}</tr>"
 
+        yield "</table>"
 
+    def _getRowWindow(self, config: dict) -> Tuple[int, Optional[int]]:
+        """Get the (first row, number of rows) to render from the config"""
+        row_start = int(config.get("rowStart", 1)) if config is not None else 1
+        row_count = config.get("rowCount") if config is not None else None
+        return row_start, int(row_count) if row_count is not None else None
 
+    def _generateHtmlTable(self, grid: Dict, row_start: int = 1, row_count: Optional[int] = None) -> str:
+        """Generate HTML table from grid"""
+        return "".join(self._iterHtmlTable(grid, row_start, row_count))
+    
+    def _generatePngTable(self, grid: Dict, row_start: int = 1, row_count: Optional[int] = None, config: Optional[dict] = None) -> bytes:
+        """Generate PNG image from grid"""
+        config = config if config is not None else {}
+        # A screenshot of a huge table is slow and can exceed what Chromium will render,
+        # so only the first pngMaxRows rows (or the requested window) are drawn
+        if row_count is None:
+            row_count = int(config.get("pngMaxRows", 500))
+        html = self._generateHtmlTable(grid, row_start, row_count)
 
+        # Convert HTML to PNG
+        return renderHtmlToPng(html, maxHeight=int(config.get("pngMaxHeight", 16384)))
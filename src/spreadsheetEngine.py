@@ -0,0 +1,369 @@
+from collections import defaultdict, deque
+from collections.abc import Mapping
+from typing import Any, Dict, Iterable, Iterator, List, Set, Tuple
+from spreadsheetFormula import CellRange, compileFormula, columnToIndex, indexToColumn, splitCellRef, cellsInRange, isNumber
+import numpy as np
+
+CYCLE_ERROR = "#CYCLE!"
+
+
+# ColumnStore keeps the numeric value of every cell in a column-major float64 array,
+# with NaN for empty and text cells, so range functions are NumPy reductions over a slice
+class ColumnStore:
+    def __init__(self, rows: int = 64, columns: int = 8):
+        self.data = np.full((rows, columns), np.nan, order="F")
+
+    def set(self, column: int, row: int, value: Any) -> None:
+        if row < 1:
+            return
+        if not isNumber(value):
+            if row <= self.data.shape[0] and column < self.data.shape[1]:
+                self.data[row - 1, column] = np.nan
+            return
+        self.__ensure__(row, column + 1)
+        self.data[row - 1, column] = value
+
+    # Bulk version of set for parallel lists of column indexes, rows and values
+    def setMany(self, columns: List[int], rows: List[int], values: List[Any]) -> None:
+        if len(values) == 0:
+            return
+        columns = np.asarray(columns, dtype=np.intp)
+        rows = np.asarray(rows, dtype=np.intp)
+        numbers = np.array([value if isNumber(value) else np.nan for value in values], dtype=np.float64)
+        valid = rows >= 1
+        columns, rows, numbers = columns[valid], rows[valid], numbers[valid]
+        if len(numbers) == 0:
+            return
+        self.__ensure__(int(rows.max()), int(columns.max()) + 1)
+        self.data[rows - 1, columns] = numbers
+
+    # Writes a whole column of values starting at a row, e.g. a column loaded from a file
+    def setColumn(self, column: int, firstRow: int, values: np.ndarray) -> None:
+        if len(values) == 0:
+            return
+        self.__ensure__(firstRow + len(values) - 1, column + 1)
+        self.data[firstRow - 1:firstRow - 1 + len(values), column] = values
+
+    # Empties a rectangle of cells
+    def clear(self, firstColumn: int, lastColumn: int, firstRow: int, lastRow: int) -> None:
+        self.data[max(firstRow - 1, 0):lastRow, firstColumn:lastColumn + 1] = np.nan
+
+    def __ensure__(self, rows: int, columns: int) -> None:
+        currentRows, currentColumns = self.data.shape
+        if rows <= currentRows and columns <= currentColumns:
+            return
+        # Grow geometrically so filling a sheet cell by cell stays linear
+        newRows = max(rows, currentRows * 2 if rows > currentRows else currentRows)
+        newColumns = max(columns, currentColumns * 2 if columns > currentColumns else currentColumns)
+        data = np.full((newRows, newColumns), np.nan, order="F")
+        data[:currentRows, :currentColumns] = self.data
+        self.data = data
+
+    # The values of a range as a 2-D array. Parts of the range beyond the stored cells
+    # are empty; they are cut off unless pad is set, in which case they are NaN.
+    def block(self, cellRange: CellRange, pad: bool = False) -> np.ndarray:
+        block = self.data[max(cellRange.firstRow - 1, 0):cellRange.lastRow, cellRange.firstColumn:cellRange.lastColumn + 1]
+        if pad and block.shape != cellRange.shape():
+            rows, columns = cellRange.shape()
+            block = np.pad(block, ((0, rows - block.shape[0]), (0, columns - block.shape[1])), constant_values=np.nan)
+        return block
+
+
+# SpreadsheetEngine holds the cells of one sheet and keeps their values up to date.
+# Formulas are parsed once and linked into a dependency graph; a change to some cells
+# recomputes only those cells and their transitive dependents, in topological order.
+# Cells on (or downstream of) a reference cycle evaluate to CYCLE_ERROR.
+class SpreadsheetEngine:
+    def __init__(self):
+        self.rawValues = {}
+        self.formulas = {}
+        self.values = {}
+        # Numeric values again, by position, for range functions
+        self.columns = ColumnStore()
+        # cell -> (column index, row), parsed once per cell
+        self.positions = {}
+        # cell -> formula cells that reference it directly
+        self.dependents = defaultdict(set)
+        # column index -> [(range, formula cell)] for formulas with a range over that column
+        self.rangeDependents = defaultdict(list)
+        self.cycles = set()
+        # DataBlocks loaded from files; their cells live only in the column store
+        self.dataBlocks = []
+
+    # Applies new raw values (constants or "=formula" strings) and recalculates what they affect.
+    # Cells missing from the mapping are left alone. Returns the recomputed cells in evaluation order.
+    def update(self, rawValues: Dict[str, Any]) -> List[str]:
+        changed = set()
+        for cellRef, rawValue in rawValues.items():
+            if cellRef in self.rawValues and self.rawValues[cellRef] == rawValue:
+                continue
+            self.__setRaw__(cellRef, rawValue)
+            changed.add(cellRef)
+        return self.recalculate(changed)
+
+    # Replaces the whole sheet, dropping cells that are not in rawValues
+    def load(self, rawValues: Dict[str, Any]) -> List[str]:
+        removed = [cellRef for cellRef in self.rawValues if cellRef not in rawValues]
+        for cellRef in removed:
+            self.__unlinkFormula__(cellRef)
+            del self.rawValues[cellRef]
+            self.__setValue__(cellRef, None)
+        recomputed = self.update(rawValues)
+        # Dependents of removed cells may have changed too
+        if len(removed) > 0:
+            recomputed += [cellRef for cellRef in self.recalculate(removed) if cellRef not in recomputed]
+        return recomputed
+
+    # Places data loaded from files (see spreadsheetData) on the sheet. Their numeric columns
+    # go straight into the column store, without a value or raw value per cell.
+    # Returns the recomputed cells, which is nothing if the blocks are unchanged.
+    def setDataBlocks(self, dataBlocks: List["DataBlock"]) -> List[str]:
+        if [block.key() for block in dataBlocks] == [block.key() for block in self.dataBlocks]:
+            return []
+        for block in self.dataBlocks:
+            self.columns.clear(block.firstColumn, block.lastColumn, block.firstRow, block.lastRow)
+        self.dataBlocks = list(dataBlocks)
+        for block in self.dataBlocks:
+            for index, column in enumerate(block.table.columns):
+                if column.dtype.kind == "f":
+                    self.columns.setColumn(block.firstColumn + index, block.firstRow, column)
+        # Cells defined in the sheet take precedence over loaded data
+        for cellRef in self.rawValues:
+            column, row = self.__position__(cellRef)
+            self.columns.set(column, row, self.values.get(cellRef))
+        # Single cell references into the blocks read their values from the blocks
+        for cellRef in list(self.dependents):
+            if cellRef not in self.rawValues:
+                self.__setValue__(cellRef, self.getBlockValue(cellRef))
+        return self.recalculate(self.formulas.keys())
+
+    def getBlockValue(self, cellRef: str) -> Any:
+        column, row = self.__position__(cellRef)
+        for block in self.dataBlocks:
+            if block.contains(column, row):
+                return block.getValue(column, row)
+        return None
+
+    # Rows and columns used by the sheet, including loaded data
+    def getSize(self) -> Tuple[int, int]:
+        maxRow = 0
+        maxColumn = 0
+        for cellRef in self.values:
+            column, row = self.__position__(cellRef)
+            maxRow = max(maxRow, row)
+            maxColumn = max(maxColumn, column + 1)
+        for block in self.dataBlocks:
+            maxRow = max(maxRow, block.lastRow)
+            maxColumn = max(maxColumn, block.lastColumn + 1)
+        return maxRow, maxColumn
+
+    # A snapshot of the values of the sheet, including loaded data
+    def getSheetValues(self) -> "SheetValues":
+        return SheetValues(dict(self.values), list(self.dataBlocks), self.getSize())
+
+    def setCell(self, cellRef: str, rawValue: Any) -> List[str]:
+        return self.update({cellRef: rawValue})
+
+    def getValue(self, cellRef: str, default: Any = None) -> Any:
+        return self.values.get(cellRef, default)
+
+    def getValues(self) -> Dict[str, Any]:
+        return dict(self.values)
+
+    def getCycles(self) -> Set[str]:
+        return set(self.cycles)
+
+    def getDependents(self, cellRef: str) -> Set[str]:
+        dependents = set(self.dependents.get(cellRef, ()))
+        column, row = self.__position__(cellRef)
+        for cellRange, formulaCell in self.rangeDependents.get(column, ()):
+            if cellRange.firstRow <= row <= cellRange.lastRow:
+                dependents.add(formulaCell)
+        return dependents
+
+    def __position__(self, cellRef: str) -> Tuple[int, int]:
+        position = self.positions.get(cellRef)
+        if position is None:
+            column, row = splitCellRef(cellRef)
+            position = self.positions[cellRef] = (columnToIndex(column), row)
+        return position
+
+    def __setValue__(self, cellRef: str, value: Any) -> None:
+        if value is None:
+            self.values.pop(cellRef, None)
+        else:
+            self.values[cellRef] = value
+        column, row = self.__position__(cellRef)
+        self.columns.set(column, row, value)
+
+    def __setRaw__(self, cellRef: str, rawValue: Any) -> None:
+        self.__unlinkFormula__(cellRef)
+        self.rawValues[cellRef] = rawValue
+        if isinstance(rawValue, str) and rawValue.startswith('='):
+            formula = compileFormula(rawValue[1:])
+            self.formulas[cellRef] = formula
+            for reference in formula.references:
+                self.dependents[reference].add(cellRef)
+                if reference not in self.rawValues and len(self.dataBlocks) > 0:
+                    self.__setValue__(reference, self.getBlockValue(reference))
+            for cellRange in formula.getRanges():
+                for column in range(cellRange.firstColumn, cellRange.lastColumn + 1):
+                    self.rangeDependents[column].append((cellRange, cellRef))
+
+    def __unlinkFormula__(self, cellRef: str) -> None:
+        formula = self.formulas.pop(cellRef, None)
+        if formula is None:
+            return
+        for reference in formula.references:
+            self.dependents[reference].discard(cellRef)
+        for cellRange in formula.getRanges():
+            for column in range(cellRange.firstColumn, cellRange.lastColumn + 1):
+                self.rangeDependents[column] = [entry for entry in self.rangeDependents[column] if entry[1] != cellRef]
+
+    @classmethod
+    def constantValue(cls, rawValue: Any) -> Any:
+        if isinstance(rawValue, str):
+            try:
+                return float(rawValue)
+            except ValueError:
+                return rawValue
+        if isinstance(rawValue, (int, float)) and not isinstance(rawValue, bool):
+            return float(rawValue)
+        return rawValue
+
+    # Recomputes the given cells and everything downstream of them
+    def recalculate(self, changedCells: Iterable[str]) -> List[str]:
+        changedCells = set(changedCells)
+        if len(changedCells) == 0:
+            return []
+
+        # Collect the dirty subgraph; on a full load that is simply every cell
+        if changedCells.issuperset(self.rawValues):
+            affected = changedCells
+        else:
+            affected = set()
+            queue = deque(changedCells)
+            while queue:
+                cellRef = queue.popleft()
+                if cellRef in affected:
+                    continue
+                affected.add(cellRef)
+                queue.extend(self.getDependents(cellRef) - affected)
+
+        # Constants depend on nothing, so they go first, stored in one batch
+        recomputed = []
+        formulaCells = set()
+        positions = []
+        constants = []
+        for cellRef in affected:
+            if cellRef in self.formulas:
+                formulaCells.add(cellRef)
+            elif cellRef in self.rawValues:
+                value = self.constantValue(self.rawValues[cellRef])
+                self.values[cellRef] = value
+                positions.append(self.__position__(cellRef))
+                constants.append(value)
+                recomputed.append(cellRef)
+            else:
+                self.__evaluateCell__(cellRef)
+                recomputed.append(cellRef)
+        if len(positions) > 0:
+            columns, rows = zip(*positions)
+            self.columns.setMany(columns, rows, constants)
+
+        # Kahn's algorithm over the dirty formulas. A formula that reads a cell left on a
+        # cycle outside the dirty set never becomes ready, just as in a full pass.
+        self.cycles -= affected
+        cyclesOutside = set(self.cycles)
+        inDegree = dict.fromkeys(formulaCells, 0)
+        edges = {}
+        for cellRef in formulaCells:
+            edges[cellRef] = [dependent for dependent in self.getDependents(cellRef) if dependent in formulaCells]
+            for dependent in edges[cellRef]:
+                inDegree[dependent] += 1
+            if len(cyclesOutside) > 0 and self.__readsAny__(cellRef, cyclesOutside):
+                inDegree[cellRef] += 1
+        ready = deque(sorted(cellRef for cellRef, degree in inDegree.items() if degree == 0))
+
+        while ready:
+            cellRef = ready.popleft()
+            self.__evaluateCell__(cellRef)
+            recomputed.append(cellRef)
+            for dependent in edges[cellRef]:
+                inDegree[dependent] -= 1
+                if inDegree[dependent] == 0:
+                    ready.append(dependent)
+
+        # Whatever is left waits on itself through a cycle
+        for cellRef in sorted(formulaCells):
+            if inDegree[cellRef] > 0:
+                self.__setValue__(cellRef, CYCLE_ERROR)
+                self.cycles.add(cellRef)
+                recomputed.append(cellRef)
+        return recomputed
+
+    # Whether the formula in cellRef references any of the cells, directly or through a range
+    def __readsAny__(self, cellRef: str, cells: Set[str]) -> bool:
+        formula = self.formulas[cellRef]
+        if any(reference in cells for reference in formula.references):
+            return True
+        for cellRange in formula.getRanges():
+            for other in cells:
+                column, row = self.__position__(other)
+                if cellRange.firstColumn <= column <= cellRange.lastColumn and cellRange.firstRow <= row <= cellRange.lastRow:
+                    return True
+        return False
+
+    def __evaluateCell__(self, cellRef: str) -> None:
+        if cellRef not in self.rawValues:
+            # A referenced cell that was never defined (or was removed), unless it holds loaded data
+            self.__setValue__(cellRef, self.getBlockValue(cellRef) if len(self.dataBlocks) > 0 else None)
+            return
+        formula = self.formulas.get(cellRef)
+        if formula is None:
+            self.__setValue__(cellRef, self.constantValue(self.rawValues[cellRef]))
+        else:
+            self.__setValue__(cellRef, formula.evaluate(self.values, self.columns))
+
+
+# SheetValues is a read-only view of the values of a sheet. Cells of loaded data are
+# looked up in their blocks on access, so large files are never turned into a dict.
+class SheetValues(Mapping):
+    def __init__(self, values: Dict[str, Any], dataBlocks: List["DataBlock"], size: Tuple[int, int]):
+        self.values = values
+        self.dataBlocks = dataBlocks
+        self.size = size
+
+    def __getitem__(self, cellRef: str) -> Any:
+        if cellRef in self.values:
+            return self.values[cellRef]
+        if len(self.dataBlocks) > 0:
+            try:
+                column, row = splitCellRef(cellRef)
+            except ValueError:
+                raise KeyError(cellRef)
+            column = columnToIndex(column)
+            for block in self.dataBlocks:
+                if block.contains(column, row):
+                    value = block.getValue(column, row)
+                    if value is not None:
+                        return value
+                    break
+        raise KeyError(cellRef)
+
+    def __iter__(self) -> Iterator[str]:
+        # Visits every loaded cell, so prefer getSize and lookups for large data
+        yield from self.values
+        for block in self.dataBlocks:
+            firstRow = block.headerRow if block.header else block.firstRow
+            for row in range(firstRow, block.lastRow + 1):
+                for column in range(block.firstColumn, block.lastColumn + 1):
+                    cellRef = f"{indexToColumn(column)}{row}"
+                    if cellRef not in self.values and block.getValue(column, row) is not None:
+                        yield cellRef
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def getSize(self) -> Tuple[int, int]:
+        return self.size
@@ -0,0 +1,420 @@
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import math
+import numpy as np
+import re
+
+
+def columnToIndex(column: str) -> int:
+    # A -> 0, Z -> 25, AA -> 26
+    index = 0
+    for letter in column:
+        index = index * 26 + (ord(letter) - ord('A') + 1)
+    return index - 1
+
+
+def indexToColumn(index: int) -> str:
+    column = ""
+    index += 1
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        column = chr(ord('A') + remainder) + column
+    return column
+
+
+def splitCellRef(cellRef: str) -> Tuple[str, int]:
+    column = cellRef.rstrip("0123456789")
+    if not (column.isalpha() and column.isupper() and column.isascii()) or len(column) == len(cellRef):
+        raise ValueError(f"Invalid cell reference: {cellRef}")
+    return column, int(cellRef[len(column):])
+
+
+def cellsInRange(startCell: str, endCell: str) -> List[str]:
+    # All cells of the rectangle spanned by two corners, row by row
+    startColumn, startRow = splitCellRef(startCell)
+    endColumn, endRow = splitCellRef(endCell)
+    firstColumn, lastColumn = sorted((columnToIndex(startColumn), columnToIndex(endColumn)))
+    firstRow, lastRow = sorted((startRow, endRow))
+    return [f"{indexToColumn(column)}{row}"
+            for row in range(firstRow, lastRow + 1)
+            for column in range(firstColumn, lastColumn + 1)]
+
+
+def isNumber(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+# CellRange is a rectangular block of cells, stored as column indexes and row numbers
+class CellRange:
+    def __init__(self, startCell: str, endCell: str):
+        startColumn, startRow = splitCellRef(startCell)
+        endColumn, endRow = splitCellRef(endCell)
+        self.firstColumn, self.lastColumn = sorted((columnToIndex(startColumn), columnToIndex(endColumn)))
+        self.firstRow, self.lastRow = sorted((startRow, endRow))
+        self.startCell = startCell
+        self.endCell = endCell
+
+    def contains(self, cellRef: str) -> bool:
+        column, row = splitCellRef(cellRef)
+        return self.firstColumn <= columnToIndex(column) <= self.lastColumn and self.firstRow <= row <= self.lastRow
+
+    def cells(self) -> List[str]:
+        return cellsInRange(self.startCell, self.endCell)
+
+    def shape(self) -> Tuple[int, int]:
+        return (self.lastRow - self.firstRow + 1, self.lastColumn - self.firstColumn + 1)
+
+
+def _count(block: np.ndarray) -> int:
+    return int(np.count_nonzero(~np.isnan(block)))
+
+
+def _whenAny(reduce):
+    # Empty ranges (no numeric cells) evaluate to 0.0 rather than NaN or an error
+    return lambda block: float(reduce(block)) if _count(block) > 0 else 0.0
+
+
+def _whenSeveral(reduce):
+    # Sample statistics need at least two values
+    return lambda block: float(reduce(block)) if _count(block) > 1 else 0.0
+
+
+# Functions over all the values of their arguments, e.g. SUM(A1:D100) or MAX(A1:A5, 0).
+# Each reduces a float array in which empty and text cells are NaN.
+RANGE_FUNCTIONS = {
+    "SUM": lambda block: float(np.nansum(block)),
+    "AVERAGE": _whenAny(np.nanmean),
+    "MAX": _whenAny(np.nanmax),
+    "MIN": _whenAny(np.nanmin),
+    "COUNT": lambda block: float(_count(block)),
+    "MEDIAN": _whenAny(np.nanmedian),
+    "PRODUCT": _whenAny(np.nanprod),
+    "STDEV": _whenSeveral(lambda block: np.nanstd(block, ddof=1)),
+    "STDEVP": _whenAny(np.nanstd),
+    "VAR": _whenSeveral(lambda block: np.nanvar(block, ddof=1)),
+    "VARP": _whenAny(np.nanvar),
+}
+
+
+def sumProduct(blocks: List[np.ndarray]) -> float:
+    # Empty and text cells count as 0; ranges must all have the same shape
+    if any(block.shape != blocks[0].shape for block in blocks):
+        return 0.0
+    product = np.ones(blocks[0].shape)
+    for block in blocks:
+        product *= np.nan_to_num(block, nan=0.0)
+    return float(product.sum())
+
+
+def _number(value: Any) -> float:
+    # Arithmetic only works on numbers; the formula as a whole then evaluates to 0.0
+    if isinstance(value, (int, float)):
+        return value
+    raise TypeError(f"Not a number: {value!r}")
+
+
+def _asArray(value: Any) -> np.ndarray:
+    if isinstance(value, np.ndarray):
+        return value.ravel()
+    return np.array([value if isNumber(value) else np.nan], dtype=np.float64)
+
+
+def _rangeFunction(reduce: Callable[[np.ndarray], float]) -> Callable[[List[Any]], float]:
+    def call(arguments: List[Any]) -> float:
+        if len(arguments) == 1 and isinstance(arguments[0], np.ndarray):
+            return reduce(arguments[0])
+        return reduce(np.concatenate([_asArray(argument) for argument in arguments]))
+    return call
+
+
+def _round(value: Any, digits: Any = 0) -> float:
+    # Spreadsheet rounding: halves go away from zero
+    factor = 10 ** int(_number(digits))
+    value = _number(value) * factor
+    return math.copysign(math.floor(abs(value) + 0.5), value) / factor
+
+
+# Functions whose arguments are all evaluated first. Names are case-insensitive.
+FUNCTIONS = dict([(name, _rangeFunction(reduce)) for name, reduce in RANGE_FUNCTIONS.items()] + [
+    ("SUMPRODUCT", sumProduct),
+    ("ABS", lambda arguments: abs(_number(*arguments))),
+    ("ROUND", lambda arguments: _round(*arguments)),
+    ("INT", lambda arguments: float(math.floor(_number(*arguments)))),
+    ("SQRT", lambda arguments: math.sqrt(_number(*arguments))),
+    ("EXP", lambda arguments: math.exp(_number(*arguments))),
+    ("LN", lambda arguments: math.log(_number(*arguments))),
+    ("LOG10", lambda arguments: math.log10(_number(*arguments))),
+    ("POWER", lambda arguments: _number(arguments[0]) ** _number(arguments[1])),
+    ("MOD", lambda arguments: _number(arguments[0]) % _number(arguments[1])),
+    ("AND", lambda arguments: all(arguments)),
+    ("OR", lambda arguments: any(arguments)),
+    ("NOT", lambda arguments: not arguments[0]),
+])
+
+# Functions that take whole (padded) ranges rather than their values
+PADDED_RANGE_FUNCTIONS = {"SUMPRODUCT"}
+
+# Cell references and ranges outside string literals (a name followed by "(" is a function)
+REFERENCE_PATTERN = re.compile(r'("(?:[^"]|"")*")|\b([A-Z]+\d+:[A-Z]+\d+)\b|\b([A-Z]+\d+)\b(?!\s*\()')
+
+TOKEN_PATTERN = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<slot>@[cr]\d+)
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<string>"(?:[^"]|"")*")
+  | (?P<name>[A-Za-z_][A-Za-z0-9_.]*)
+  | (?P<operator>\*\*|<=|>=|<>|==|!=|[-+*/^%&(),=<>])
+''', re.VERBOSE)
+
+COMPARISONS = {
+    "=": lambda a, b: a == b,
+    "==": lambda a, b: a == b,
+    "<>": lambda a, b: a != b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    ">": lambda a, b: a > b,
+    "<=": lambda a, b: a <= b,
+    ">=": lambda a, b: a >= b,
+}
+
+ARITHMETIC = {
+    "+": lambda a, b: _number(a) + _number(b),
+    "-": lambda a, b: _number(a) - _number(b),
+    "*": lambda a, b: _number(a) * _number(b),
+    "/": lambda a, b: _number(a) / _number(b),
+    "%": lambda a, b: _number(a) % _number(b),
+    "^": lambda a, b: _number(a) ** _number(b),
+    "**": lambda a, b: _number(a) ** _number(b),
+}
+
+# A compiled node: called with the cell values by name, the ColumnStore of the sheet and
+# the slots of the formula (the cell names and CellRanges its template refers to)
+Evaluator = Callable[[Dict[str, Any], Any, tuple], Any]
+
+
+# Splits a formula into a template and the references it makes, e.g.
+# "A1*2+SUM(B1:B5)" -> ("@c0*2+SUM(@r1)", ["A1", "B1:B5"]). Formulas copied down a
+# column share one template, so they are parsed once between them.
+def splitReferences(formula: str) -> Tuple[str, List[str]]:
+    references = []
+
+    def toSlot(match: re.Match) -> str:
+        if match.group(1) is not None:
+            return match.group(1)
+        references.append(match.group(2) or match.group(3))
+        return f"@{'r' if match.group(2) else 'c'}{len(references) - 1}"
+
+    return REFERENCE_PATTERN.sub(toSlot, formula), references
+
+
+def tokenize(formula: str) -> List[Tuple[str, str]]:
+    tokens = []
+    position = 0
+    while position < len(formula):
+        match = TOKEN_PATTERN.match(formula, position)
+        if match is None:
+            raise SyntaxError(f"Unexpected character {formula[position]!r} at {position} in formula {formula!r}")
+        position = match.end()
+        if match.lastgroup != "space":
+            tokens.append((match.lastgroup, match.group()))
+    return tokens
+
+
+# FormulaParser is a recursive-descent parser that turns a formula template (see
+# splitReferences) into a tree of closures that read cells through slots.
+# Precedence, lowest first: comparison, & (concatenation), + -, * / %, unary + -, ^ **.
+class FormulaParser:
+    def __init__(self, formula: str):
+        self.formula = formula
+        self.tokens = tokenize(formula)
+        self.position = 0
+
+    def parse(self) -> Evaluator:
+        evaluator = self.__comparison__()
+        if self.position != len(self.tokens):
+            raise SyntaxError(f"Unexpected {self.tokens[self.position][1]!r} in formula {self.formula!r}")
+        return evaluator
+
+    def __peek__(self) -> Optional[Tuple[str, str]]:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def __accept__(self, *operators: str) -> Optional[str]:
+        token = self.__peek__()
+        if token is not None and token[0] == "operator" and token[1] in operators:
+            self.position += 1
+            return token[1]
+        return None
+
+    def __expect__(self, operator: str) -> None:
+        if self.__accept__(operator) is None:
+            raise SyntaxError(f"Expected {operator!r} in formula {self.formula!r}")
+
+    def __comparison__(self) -> Evaluator:
+        left = self.__concatenation__()
+        operator = self.__accept__(*COMPARISONS)
+        if operator is None:
+            return left
+        right = self.__concatenation__()
+        compare = COMPARISONS[operator]
+        return lambda values, columns, slots: compare(left(values, columns, slots), right(values, columns, slots))
+
+    def __concatenation__(self) -> Evaluator:
+        left = self.__additive__()
+        while self.__accept__("&"):
+            right = self.__additive__()
+            left = (lambda left, right: lambda values, columns, slots: f"{_text(left(values, columns, slots))}{_text(right(values, columns, slots))}")(left, right)
+        return left
+
+    def __binary__(self, operators: Tuple[str, ...], operand: Callable[[], Evaluator]) -> Evaluator:
+        left = operand()
+        while True:
+            operator = self.__accept__(*operators)
+            if operator is None:
+                return left
+            right = operand()
+            left = (lambda left, right, apply: lambda values, columns, slots: apply(left(values, columns, slots), right(values, columns, slots)))(left, right, ARITHMETIC[operator])
+
+    def __additive__(self) -> Evaluator:
+        return self.__binary__(("+", "-"), self.__term__)
+
+    def __term__(self) -> Evaluator:
+        return self.__binary__(("*", "/", "%"), self.__unary__)
+
+    def __unary__(self) -> Evaluator:
+        operator = self.__accept__("-", "+")
+        if operator is None:
+            return self.__power__()
+        operand = self.__unary__()
+        if operator == "-":
+            return lambda values, columns, slots: -_number(operand(values, columns, slots))
+        return lambda values, columns, slots: +_number(operand(values, columns, slots))
+
+    def __power__(self) -> Evaluator:
+        base = self.__primary__()
+        operator = self.__accept__("^", "**")
+        if operator is None:
+            return base
+        # Right associative, and binds tighter than a unary minus on its left
+        exponent = self.__unary__()
+        apply = ARITHMETIC[operator]
+        return lambda values, columns, slots: apply(base(values, columns, slots), exponent(values, columns, slots))
+
+    def __primary__(self) -> Evaluator:
+        token = self.__peek__()
+        if token is None:
+            raise SyntaxError(f"Unexpected end of formula {self.formula!r}")
+        kind, text = token
+        self.position += 1
+
+        if kind == "number":
+            value = float(text)
+            return lambda values, columns, slots: value
+        elif kind == "string":
+            value = text[1:-1].replace('""', '"')
+            return lambda values, columns, slots: value
+        elif kind == "slot":
+            if text[1] == "r":
+                raise SyntaxError(f"Ranges can only be used as function arguments in formula {self.formula!r}")
+            index = int(text[2:])
+            return lambda values, columns, slots: values.get(slots[index])
+        elif kind == "name":
+            if self.__accept__("("):
+                return self.__function__(text.upper())
+            if text.upper() in ("TRUE", "FALSE"):
+                value = text.upper() == "TRUE"
+                return lambda values, columns, slots: value
+            raise SyntaxError(f"Unknown name {text!r} in formula {self.formula!r}")
+        elif text == "(":
+            inner = self.__comparison__()
+            self.__expect__(")")
+            return inner
+        raise SyntaxError(f"Unexpected {text!r} in formula {self.formula!r}")
+
+    def __function__(self, name: str) -> Evaluator:
+        arguments = []
+        if self.__accept__(")") is None:
+            while True:
+                arguments.append(self.__argument__(pad=name in PADDED_RANGE_FUNCTIONS))
+                if self.__accept__(")") is not None:
+                    break
+                self.__expect__(",")
+
+        if name == "IF":
+            # Only the chosen branch is evaluated
+            if len(arguments) not in (2, 3):
+                raise SyntaxError(f"IF takes 2 or 3 arguments in formula {self.formula!r}")
+            condition, whenTrue = arguments[0], arguments[1]
+            whenFalse = arguments[2] if len(arguments) == 3 else (lambda values, columns, slots: False)
+            return lambda values, columns, slots: whenTrue(values, columns, slots) if condition(values, columns, slots) else whenFalse(values, columns, slots)
+
+        function = FUNCTIONS.get(name)
+        if function is None:
+            raise SyntaxError(f"Unknown function {name} in formula {self.formula!r}")
+        return lambda values, columns, slots: function([argument(values, columns, slots) for argument in arguments])
+
+    def __argument__(self, pad: bool) -> Evaluator:
+        token = self.__peek__()
+        if token is not None and token[0] == "slot" and token[1][1] == "r":
+            self.position += 1
+            index = int(token[1][2:])
+            return lambda values, columns, slots: columns.block(slots[index], pad=pad)
+        return self.__comparison__()
+
+
+def _text(value: Any) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return "" if value is None else str(value)
+
+
+@lru_cache(maxsize=4096)
+def compileTemplate(template: str) -> Tuple[Optional[Evaluator], Optional[str]]:
+    # Returns (evaluator, None), or (None, error) for a formula that does not parse
+    try:
+        return FormulaParser(template).parse(), None
+    except SyntaxError as e:
+        return None, str(e)
+
+
+# CompiledFormula is a formula compiled once into closures, along with the cells and
+# ranges it reads. Compiled formulas hold no sheet state and are shared between sheets.
+class CompiledFormula:
+    def __init__(self, formula: str):
+        self.formula = formula
+        self.references = frozenset()
+        self.ranges = []
+        self.slots = ()
+        template, references = splitReferences(formula)
+        self.evaluator, self.error = compileTemplate(template)
+        if self.evaluator is None:
+            return
+        try:
+            self.slots = tuple(CellRange(*reference.split(":")) if ":" in reference else reference for reference in references)
+        except ValueError as e:
+            self.evaluator, self.error = None, str(e)
+            return
+        self.references = frozenset(slot for slot in self.slots if isinstance(slot, str))
+        self.ranges = [slot for slot in self.slots if isinstance(slot, CellRange)]
+
+    def getRanges(self) -> List[CellRange]:
+        return self.ranges
+
+    def evaluate(self, values: Dict[str, Any], columns: Any) -> Any:
+        # Formulas that do not parse, or fail (e.g. divide by zero, text in arithmetic),
+        # evaluate to 0.0 as they always have
+        if self.evaluator is None:
+            return 0.0
+        try:
+            result = self.evaluator(values, columns, self.slots)
+        except Exception:
+            return 0.0
+        if isinstance(result, np.generic):
+            result = result.item()
+        if isinstance(result, int) and not isinstance(result, bool):
+            result = float(result)
+        return result
+
+
+@lru_cache(maxsize=65536)
+def compileFormula(formula: str) -> CompiledFormula:
+    return CompiledFormula(formula)
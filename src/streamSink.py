@@ -0,0 +1,38 @@
+from typing import Any, Iterator, Optional, Tuple
+import contextvars
+import queue
+
+# The sink that partial output of the current render goes to, if anyone is listening.
+# Thread pools that run parts of a render must copy the context (see prefetchIncludes).
+currentStreamSink = contextvars.ContextVar("currentStreamSink", default=None)
+# The name of the program being executed, which labels the chunks it writes to the sink
+currentStreamSource = contextvars.ContextVar("currentStreamSource", default=None)
+
+
+# StreamSink collects the events of one streaming render: chunks of text as they are
+# produced, then a single done or error event. Chunks may be written from any thread.
+class StreamSink:
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def write(self, source: str, text: str) -> None:
+        self.queue.put(("chunk", {"source": source, "text": text}))
+
+    def finish(self, data: Any) -> None:
+        self.queue.put(("done", data))
+
+    def fail(self, message: str) -> None:
+        self.queue.put(("error", {"message": message}))
+
+    # Yields (event, data) until the render is done or failed. While nothing happens,
+    # (None, None) is yielded every keepAlive seconds so the caller can ping the client.
+    def events(self, keepAlive: Optional[float] = 15) -> Iterator[Tuple[Optional[str], Any]]:
+        while True:
+            try:
+                event, data = self.queue.get(timeout=keepAlive)
+            except queue.Empty:
+                yield None, None
+                continue
+            yield event, data
+            if event in ("done", "error"):
+                return
@@ -0,0 +1,443 @@
+from typing import Any, Dict, List, Optional, Tuple
+import copy
+import math
+import numpy as np
+
+# Vega-Lite's default number of bins on x and y
+DEFAULT_MAX_BINS = 10
+# Vega's bin transform nudges values up by this much before flooring
+BIN_EPSILON = 1e-14
+
+AGGREGATE_OPS = {"count", "valid", "missing", "sum", "mean", "average", "min", "max", "median",
+                 "distinct", "variance", "variancep", "stdev", "stdevp"}
+
+
+# Raised when a spec uses a transform or encoding that is not evaluated here;
+# whatever is left is handed to Vega unchanged
+class UnsupportedSpec(Exception):
+    pass
+
+
+# Table is a dataset held column by column. Numeric columns are float64 arrays with NaN
+# for missing values; any other column is an object array.
+class Table:
+    def __init__(self, columns: Dict[str, np.ndarray], rowCount: int):
+        self.columns = columns
+        self.rowCount = rowCount
+
+    @classmethod
+    def fromRows(cls, rows: List[dict]) -> "Table":
+        names = []
+        seen = set()
+        for row in rows:
+            if not isinstance(row, dict):
+                raise UnsupportedSpec("data values must be objects")
+            for name in row:
+                if name not in seen:
+                    seen.add(name)
+                    names.append(name)
+        columns = {}
+        for name in names:
+            values = [row.get(name) for row in rows]
+            columns[name] = _toColumn(values)
+        return cls(columns, len(rows))
+
+    def column(self, field: str) -> np.ndarray:
+        _checkField(field)
+        if field in self.columns:
+            return self.columns[field]
+        return np.full(self.rowCount, np.nan)
+
+    def take(self, mask: np.ndarray) -> "Table":
+        return Table(dict((name, column[mask]) for name, column in self.columns.items()), int(np.count_nonzero(mask)))
+
+    def toRows(self) -> List[dict]:
+        names = list(self.columns)
+        lists = [_toList(self.columns[name]) for name in names]
+        return [dict(zip(names, values)) for values in zip(*lists)]
+
+
+# Evaluates the filter, bin and aggregate transforms of a single view Vega-Lite spec with
+# inline data.values, along with aggregates and bins in its encoding, and returns an
+# equivalent spec whose data is just the rows the chart draws. Transforms from the first
+# one that is not supported onwards are left in the spec. Returns None if nothing could
+# be evaluated.
+def preaggregateSpec(spec: dict) -> Optional[dict]:
+    data = spec.get("data")
+    if not isinstance(data, dict) or not isinstance(data.get("values"), list) or "format" in data:
+        return None
+    if any(key in spec for key in ("layer", "concat", "hconcat", "vconcat", "facet", "repeat", "spec")):
+        return None
+
+    try:
+        table = Table.fromRows(data["values"])
+    except UnsupportedSpec:
+        return None
+
+    transforms = list(spec.get("transform", []))
+    applied = 0
+    for transform in transforms:
+        try:
+            table = _applyTransform(table, transform)
+        except UnsupportedSpec:
+            break
+        applied += 1
+    remaining = transforms[applied:]
+
+    encoding = spec.get("encoding")
+    newEncoding = None
+    if len(remaining) == 0 and isinstance(encoding, dict):
+        try:
+            table, newEncoding = _applyEncoding(table, encoding)
+        except UnsupportedSpec:
+            newEncoding = None
+
+    if applied == 0 and newEncoding is None:
+        return None
+
+    reduced = dict(spec)
+    reduced["data"] = dict(data, values=table.toRows())
+    if len(remaining) > 0:
+        reduced["transform"] = remaining
+    else:
+        reduced.pop("transform", None)
+    if newEncoding is not None:
+        reduced["encoding"] = newEncoding
+    return reduced
+
+
+def _checkField(field: Any) -> None:
+    # Nested and escaped field names are left to Vega
+    if not isinstance(field, str) or "." in field or "[" in field or "\\" in field:
+        raise UnsupportedSpec(f"unsupported field {field!r}")
+
+
+def _isNumber(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _toColumn(values: List[Any]) -> np.ndarray:
+    if all(value is None or _isNumber(value) for value in values):
+        return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+
+def _toList(column: np.ndarray) -> List[Any]:
+    if column.dtype.kind == "f":
+        # JSON has no NaN or infinity
+        return [value if math.isfinite(value) else None for value in column.tolist()]
+    return column.tolist()
+
+
+def _isNumeric(column: np.ndarray) -> bool:
+    return column.dtype.kind == "f"
+
+
+def _applyTransform(table: Table, transform: dict) -> Table:
+    if not isinstance(transform, dict):
+        raise UnsupportedSpec("transform must be an object")
+    if "filter" in transform and len(transform) == 1:
+        return table.take(_predicate(table, transform["filter"]))
+    if "bin" in transform:
+        return _binTransform(table, transform)
+    if "aggregate" in transform:
+        if set(transform) - {"aggregate", "groupby"}:
+            raise UnsupportedSpec("unsupported aggregate options")
+        aggregates = []
+        for aggregate in transform["aggregate"]:
+            op = aggregate.get("op")
+            field = aggregate.get("field")
+            name = aggregate.get("as", op if field is None else f"{op}_{field}")
+            aggregates.append((op, field, name))
+        return _aggregate(table, transform.get("groupby", []), aggregates)
+    raise UnsupportedSpec(f"unsupported transform {sorted(transform)}")
+
+
+# Vega-Lite field predicates, optionally combined with and, or and not
+def _predicate(table: Table, predicate: Any) -> np.ndarray:
+    if not isinstance(predicate, dict):
+        # Expression strings need the Vega expression language
+        raise UnsupportedSpec("unsupported filter")
+    if "and" in predicate:
+        return np.logical_and.reduce([_predicate(table, part) for part in predicate["and"]] + [np.ones(table.rowCount, dtype=bool)])
+    if "or" in predicate:
+        return np.logical_or.reduce([_predicate(table, part) for part in predicate["or"]] + [np.zeros(table.rowCount, dtype=bool)])
+    if "not" in predicate:
+        return ~_predicate(table, predicate["not"])
+    if "field" not in predicate or "timeUnit" in predicate:
+        raise UnsupportedSpec("unsupported filter")
+
+    column = table.column(predicate["field"])
+    if _isNumeric(column):
+        valid = ~np.isnan(column)
+    else:
+        valid = np.array([value is not None for value in column], dtype=bool)
+
+    if "valid" in predicate:
+        return valid if predicate["valid"] else ~valid
+    if "equal" in predicate:
+        return _equals(column, predicate["equal"])
+    if "oneOf" in predicate:
+        return np.logical_or.reduce([_equals(column, value) for value in predicate["oneOf"]] + [np.zeros(table.rowCount, dtype=bool)])
+
+    # Order comparisons only on numbers; strings and dates compare differently in Vega
+    if not _isNumeric(column):
+        raise UnsupportedSpec("unsupported filter")
+    with np.errstate(invalid="ignore"):
+        if "range" in predicate:
+            low, high = predicate["range"]
+            mask = valid.copy()
+            if low is not None:
+                mask &= column >= _number(low)
+            if high is not None:
+                mask &= column <= _number(high)
+            return mask
+        for op, compare in (("lt", np.less), ("lte", np.less_equal), ("gt", np.greater), ("gte", np.greater_equal)):
+            if op in predicate:
+                return valid & compare(column, _number(predicate[op]))
+    raise UnsupportedSpec("unsupported filter")
+
+
+def _number(value: Any) -> float:
+    if not _isNumber(value):
+        raise UnsupportedSpec("unsupported filter value")
+    return float(value)
+
+
+def _equals(column: np.ndarray, value: Any) -> np.ndarray:
+    if _isNumeric(column):
+        if not _isNumber(value):
+            return np.zeros(len(column), dtype=bool)
+        return column == value
+    return np.array([item == value and type(item) is type(value) for item in column], dtype=bool)
+
+
+# Vega's bin extent and step for a maximum number of bins
+def _binParameters(column: np.ndarray, bin: Any) -> Tuple[float, float, float]:
+    params = bin if isinstance(bin, dict) else {}
+    if set(params) - {"maxbins", "step", "extent", "nice"}:
+        raise UnsupportedSpec("unsupported bin parameters")
+    if "extent" in params:
+        low, high = params["extent"]
+    else:
+        finite = column[np.isfinite(column)]
+        if len(finite) == 0:
+            raise UnsupportedSpec("nothing to bin")
+        low, high = float(finite.min()), float(finite.max())
+
+    maxbins = params.get("maxbins", DEFAULT_MAX_BINS)
+    span = (high - low) or abs(low) or 1
+    if "step" in params:
+        step = params["step"]
+    else:
+        level = math.ceil(math.log(maxbins) / math.log(10))
+        step = max(0, 10 ** (round(math.log(span) / math.log(10)) - level))
+        while math.ceil(span / step) > maxbins:
+            step *= 10
+        for divisor in (5, 2):
+            candidate = step / divisor
+            if span / candidate <= maxbins:
+                step = candidate
+
+    logStep = math.log(step)
+    precision = 0 if logStep >= 0 else int(-logStep / math.log(10)) + 1
+    eps = 10 ** (-precision - 1)
+    if params.get("nice", True):
+        value = math.floor(low / step + eps) * step
+        low = value - step if low < value else value
+        high = math.ceil(high / step) * step
+    return low, (low + step if high == low else high), step
+
+
+def _binColumn(column: np.ndarray, start: float, stop: float, step: float) -> np.ndarray:
+    with np.errstate(invalid="ignore"):
+        clipped = np.clip(column, start, stop - step)
+        binned = start + step * np.floor(BIN_EPSILON + (clipped - start) / step)
+        binned = np.where(column < start, -np.inf, np.where(column > stop, np.inf, binned))
+    return binned
+
+
+def _binTransform(table: Table, transform: dict) -> Table:
+    if set(transform) - {"bin", "field", "as"}:
+        raise UnsupportedSpec("unsupported bin options")
+    names = transform.get("as")
+    if isinstance(names, str):
+        names = [names, f"{names}_end"]
+    if not isinstance(names, list) or len(names) != 2:
+        raise UnsupportedSpec("unsupported bin output")
+    table, _ = _addBinColumns(table, transform.get("field"), transform["bin"], names)
+    return table
+
+
+# Adds the start and end of the bin of every row, returning the table and the bin step
+def _addBinColumns(table: Table, field: str, bin: Any, names: List[str]) -> Tuple[Table, float]:
+    column = table.column(field)
+    if not _isNumeric(column) or bin is False:
+        raise UnsupportedSpec("unsupported bin")
+    start, stop, step = _binParameters(column, bin)
+    binned = _binColumn(column, start, stop, step)
+    columns = dict(table.columns)
+    columns[names[0]] = binned
+    columns[names[1]] = binned + step
+    return Table(columns, table.rowCount), step
+
+
+# Integer codes for the distinct values of a column, in order of first appearance
+def _factorize(column: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    if _isNumeric(column):
+        uniques, first, codes = np.unique(column, return_index=True, return_inverse=True)
+        order = np.argsort(first, kind="stable")
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        return rank[codes.reshape(-1)], uniques[order]
+    lookup = {}
+    codes = np.empty(len(column), dtype=np.int64)
+    for index, value in enumerate(column):
+        key = (type(value), value)
+        code = lookup.get(key)
+        if code is None:
+            code = lookup[key] = len(lookup)
+        codes[index] = code
+    uniques = np.empty(len(lookup), dtype=object)
+    uniques[:] = [value for _, value in lookup]
+    return codes, uniques
+
+
+def _aggregate(table: Table, groupby: List[str], aggregates: List[Tuple[str, Optional[str], str]]) -> Table:
+    for op, field, name in aggregates:
+        if op not in AGGREGATE_OPS or (field is None and op != "count"):
+            raise UnsupportedSpec(f"unsupported aggregate {op!r}")
+
+    # One code per group, numbered in order of first appearance like Vega does
+    if len(groupby) == 0:
+        groups = np.zeros(table.rowCount, dtype=np.int64)
+        groupCount = 1 if table.rowCount > 0 else 0
+        keyColumns = {}
+    else:
+        factorized = [_factorize(table.column(field)) for field in groupby]
+        combined = np.zeros(table.rowCount, dtype=np.int64)
+        for codes, uniques in factorized:
+            combined = combined * len(uniques) + codes
+        _, first, inverse = np.unique(combined, return_index=True, return_inverse=True)
+        order = np.argsort(first, kind="stable")
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        groups = rank[inverse.reshape(-1)]
+        groupCount = len(order)
+        firstRows = first[order]
+        keyColumns = dict((field, uniques[codes[firstRows]]) for field, (codes, uniques) in zip(groupby, factorized))
+
+    columns = dict(keyColumns)
+    for op, field, name in aggregates:
+        columns[name] = _aggregateColumn(op, None if field is None else table.column(field), groups, groupCount)
+    return Table(columns, groupCount)
+
+
+def _aggregateColumn(op: str, column: Optional[np.ndarray], groups: np.ndarray, groupCount: int) -> np.ndarray:
+    count = np.bincount(groups, minlength=groupCount).astype(np.float64)
+    if op == "count":
+        return count
+    if op == "distinct":
+        codes, uniques = _factorize(column)
+        pairs = np.unique(groups * max(len(uniques), 1) + codes)
+        return np.bincount(pairs // max(len(uniques), 1), minlength=groupCount).astype(np.float64)
+    if not _isNumeric(column):
+        if op in ("valid", "missing"):
+            valid = np.bincount(groups, weights=np.array([value is not None for value in column], dtype=np.float64), minlength=groupCount)
+            return valid if op == "valid" else count - valid
+        raise UnsupportedSpec(f"{op} of a non-numeric field")
+
+    isValid = ~np.isnan(column)
+    valid = np.bincount(groups, weights=isValid.astype(np.float64), minlength=groupCount)
+    if op == "valid":
+        return valid
+    if op == "missing":
+        return count - valid
+    values = np.where(isValid, column, 0.0)
+    total = np.bincount(groups, weights=values, minlength=groupCount)
+    if op == "sum":
+        return total
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(valid > 0, total / valid, np.nan)
+        if op in ("mean", "average"):
+            return mean
+        if op in ("variance", "variancep", "stdev", "stdevp"):
+            deviations = np.where(isValid, column - mean[groups], 0.0)
+            squares = np.bincount(groups, weights=deviations * deviations, minlength=groupCount)
+            sample = op in ("variance", "stdev")
+            divisor = valid - 1 if sample else valid
+            variance = np.where(divisor > 0, squares / divisor, np.nan)
+            return np.sqrt(variance) if op.startswith("stdev") else variance
+
+    # min, max and median from the values sorted within each group (NaN sorts last)
+    order = np.lexsort((column, groups))
+    sortedValues = column[order]
+    starts = np.concatenate(([0], np.cumsum(count)[:-1])).astype(np.int64)
+    validCounts = valid.astype(np.int64)
+    result = np.full(groupCount, np.nan)
+    present = validCounts > 0
+    if op == "min":
+        result[present] = sortedValues[starts[present]]
+    elif op == "max":
+        result[present] = sortedValues[starts[present] + validCounts[present] - 1]
+    else:
+        low = starts + (validCounts - 1) // 2
+        high = starts + validCounts // 2
+        result[present] = (sortedValues[low[present]] + sortedValues[high[present]]) / 2
+    return result
+
+
+# Evaluates aggregates and bins in the encoding, grouping by every other field, and
+# rewrites the encoding to draw the precomputed fields
+def _applyEncoding(table: Table, encoding: dict) -> Tuple[Table, Optional[dict]]:
+    aggregates = []
+    groupby = []
+    binned = []
+    for channel, definition in encoding.items():
+        if isinstance(definition, list):
+            raise UnsupportedSpec("unsupported encoding list")
+        if not isinstance(definition, dict):
+            continue
+        if "timeUnit" in definition or isinstance(definition.get("sort"), dict) or "condition" in definition:
+            raise UnsupportedSpec("unsupported encoding")
+        if "aggregate" in definition:
+            op = definition["aggregate"]
+            if not isinstance(op, str):
+                raise UnsupportedSpec("unsupported aggregate")
+            field = definition.get("field")
+            name = "__count" if op == "count" else f"{op}_{field}"
+            aggregates.append((channel, op, field, name))
+        elif "field" in definition:
+            bin = definition.get("bin")
+            if bin is not None and bin is not False:
+                if not isinstance(bin, (bool, dict)) or (isinstance(bin, dict) and bin.get("binned")):
+                    raise UnsupportedSpec("unsupported bin")
+                if channel not in ("x", "y") or f"{channel}2" in encoding:
+                    raise UnsupportedSpec("unsupported bin channel")
+                binned.append((channel, definition))
+            elif definition["field"] not in groupby:
+                groupby.append(definition["field"])
+    if len(aggregates) == 0:
+        raise UnsupportedSpec("nothing to aggregate")
+
+    newEncoding = copy.deepcopy(encoding)
+    for channel, definition in binned:
+        field = definition["field"]
+        maxbins = definition["bin"].get("maxbins", DEFAULT_MAX_BINS) if isinstance(definition["bin"], dict) else DEFAULT_MAX_BINS
+        name = f"bin_maxbins_{maxbins}_{field}"
+        table, step = _addBinColumns(table, field, definition["bin"], [name, f"{name}_end"])
+        groupby += [name, f"{name}_end"]
+        newDefinition = dict(definition, field=name, bin={"binned": True, "step": step})
+        newDefinition.setdefault("title", f"{field} (binned)")
+        newEncoding[channel] = newDefinition
+        newEncoding[f"{channel}2"] = {"field": f"{name}_end"}
+
+    table = _aggregate(table, groupby, [(op, field, name) for _, op, field, name in aggregates])
+    for channel, op, field, name in aggregates:
+        newDefinition = dict(encoding[channel], field=name)
+        del newDefinition["aggregate"]
+        newDefinition.setdefault("title", "Count of Records" if op == "count" else f"{op[0].upper()}{op[1:]} of {field}")
+        newEncoding[channel] = newDefinition
+    return table, newEncoding
@@ -0,0 +1,71 @@
+import os
+import time
+
+from executionStore import ExecutionStore
+from programs import ProgramOutput
+
+
+def _record(store, programName, viz, started=None, cached=False):
+    started = time.time() if started is None else started
+    return store.record(programName, 0, {"inputs": {"viz": viz}}, ProgramOutput(started, "html", viz, {}), started, started + 1, cached=cached)
+
+
+def _blobCount(storeDir):
+    return sum(len(files) for _, _, files in os.walk(os.path.join(storeDir, ".blobs")))
+
+
+def test_outputs_round_trip(tmp_path):
+    store = ExecutionStore(str(tmp_path))
+    executionId = _record(store, "p", "<p>hi</p>", cached=True)
+
+    record = store.getRecord(executionId)
+    assert record["inputs"] == {"viz": "<p>hi</p>"}
+    assert record["succeeded"] and record["cached"]
+    assert store.loadOutput(executionId).viz() == "<p>hi</p>"
+
+
+def test_identical_outputs_share_one_blob(tmp_path):
+    store = ExecutionStore(str(tmp_path))
+    _record(store, "p", "same")
+    _record(store, "q", "same")
+
+    assert _blobCount(str(tmp_path)) == 1
+
+
+def test_records_beyond_the_count_limit_are_pruned(tmp_path):
+    store = ExecutionStore(str(tmp_path), maxRecordsPerProgram=3, pruneEvery=1)
+    for index in range(6):
+        _record(store, "p", f"output {index}")
+    _record(store, "other", "kept")
+
+    records = store.query("p")
+    assert [store.loadOutput(record["id"]).viz() for record in records] == ["output 5", "output 4", "output 3"]
+    assert len(store.query("other")) == 1
+    # blobs of the pruned records are removed with them
+    assert _blobCount(str(tmp_path)) == 4
+
+
+def test_pruning_is_batched(tmp_path):
+    store = ExecutionStore(str(tmp_path), maxRecordsPerProgram=2, pruneEvery=3)
+    for index in range(5):
+        _record(store, "p", f"output {index}")
+    assert len(store.query("p")) == 4
+
+    _record(store, "p", "output 5")
+    assert len(store.query("p")) == 2
+
+
+def test_records_older_than_the_age_limit_are_pruned(tmp_path):
+    store = ExecutionStore(str(tmp_path), maxAgeDays=1, pruneEvery=1)
+    _record(store, "p", "old", started=time.time() - 2 * 24 * 3600)
+    _record(store, "p", "new")
+
+    assert [record["inputs"]["viz"] for record in store.query("p")] == ["new"]
+
+
+def test_submitted_executions_are_visible_to_reads(tmp_path):
+    store = ExecutionStore(str(tmp_path))
+    for index in range(10):
+        store.submit("p", 0, {"inputs": {"index": index}}, ProgramOutput(0, "md", str(index), {}), time.time(), time.time())
+
+    assert sorted(record["inputs"]["index"] for record in store.query("p")) == list(range(10))
@@ -0,0 +1,66 @@
+import time
+
+from llmCache import LLMCache
+
+
+def _messages(text):
+    return [{"role": "user", "content": text}]
+
+
+def test_get_returns_what_was_put(tmp_path):
+    cache = LLMCache(str(tmp_path / "cache.sqlite"))
+    cache.put("model", _messages("hi"), {"temperature": 0.0}, "hello")
+
+    assert cache.get("model", _messages("hi"), {"temperature": 0.0}) == "hello"
+    assert cache.get("model", _messages("hi"), {"temperature": 1.0}) is None
+    assert cache.get("other", _messages("hi"), {"temperature": 0.0}) is None
+
+
+def test_key_ignores_parameter_order():
+    assert LLMCache.computeKey("m", _messages("x"), {"a": 1, "b": 2}) == LLMCache.computeKey("m", _messages("x"), {"b": 2, "a": 1})
+    assert LLMCache.computeKey("m", _messages("x"), None) == LLMCache.computeKey("m", _messages("x"), {})
+
+
+def test_expired_entries_are_misses(tmp_path):
+    cache = LLMCache(str(tmp_path / "cache.sqlite"), ttlSeconds=60)
+    cache.put("model", _messages("hi"), {}, "hello")
+    cache.connection.execute("UPDATE responses SET created = ?", (time.time() - 120,))
+
+    assert cache.get("model", _messages("hi"), {}) is None
+
+
+def test_least_recently_used_entries_are_evicted_past_max_bytes(tmp_path):
+    cache = LLMCache(str(tmp_path / "cache.sqlite"), maxBytes=1000)
+    for index in range(10):
+        cache.put("model", _messages(str(index)), {}, "x" * 100)
+    # a hit makes the oldest entry the most recently used one
+    assert cache.get("model", _messages("0"), {}) is not None
+
+    cache.put("model", _messages("new"), {}, "x" * 100)
+
+    stats = cache.stats()
+    assert stats["bytes"] <= 1000
+    assert cache.get("model", _messages("0"), {}) is not None
+    assert cache.get("model", _messages("1"), {}) is None
+    assert cache.get("model", _messages("new"), {}) is not None
+
+
+def test_total_size_follows_replaced_entries(tmp_path):
+    cache = LLMCache(str(tmp_path / "cache.sqlite"))
+    cache.put("model", _messages("hi"), {}, "x" * 100)
+    cache.put("model", _messages("hi"), {}, "x" * 40)
+
+    assert cache.totalBytes == 40
+    assert cache.stats() == {"hits": 0, "misses": 0, "entries": 1, "bytes": 40}
+
+
+def test_counters_are_shared_through_the_file(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = LLMCache(path)
+    cache.put("model", _messages("hi"), {}, "hello")
+    cache.get("model", _messages("hi"), {})
+    cache.get("model", _messages("bye"), {})
+    cache.flush()
+
+    stats = LLMCache(path).stats()
+    assert (stats["hits"], stats["misses"]) == (1, 1)
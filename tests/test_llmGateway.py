@@ -0,0 +1,120 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from clientProvider import ClientProvider
+from llmGateway import LLMGateway
+
+
+# Stands in for AsyncOpenAI: answers every chat completion after a short delay and
+# records how many requests it got and how many ran at once
+class FakeClient:
+    def __init__(self, delay=0.05, failures=0):
+        self.delay = delay
+        self.failures = failures
+        self.calls = 0
+        self.active = 0
+        self.peak = 0
+        self.options = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def with_options(self, **options):
+        self.options.append(options)
+        return self
+
+    async def create(self, model, messages, stream=False, **params):
+        self.calls += 1
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+            if self.failures > 0:
+                self.failures -= 1
+                raise RuntimeError("service unavailable")
+        finally:
+            self.active -= 1
+        content = f"reply to {messages[-1]['content']}"
+        if stream:
+            return self.stream(content)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    async def stream(self, content):
+        for word in content.split(" "):
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word + " "))])
+
+
+@pytest.fixture
+def client():
+    return FakeClient()
+
+
+@pytest.fixture
+def gateway(client):
+    gateway = LLMGateway(maxConcurrency=2, clientFactory=lambda: client)
+    yield gateway
+    gateway.shutdown()
+
+
+def _inParallel(count, function):
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def run(index):
+        barrier.wait()
+        try:
+            results[index] = function(index)
+        except Exception as e:
+            results[index] = e
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def _messages(text):
+    return [{"role": "user", "content": text}]
+
+
+def test_identical_requests_in_flight_are_sent_once(gateway, client):
+    results = _inParallel(10, lambda index: gateway.chat("model", _messages("hi"), useCache=False))
+
+    assert results == ["reply to hi"] * 10
+    assert client.calls == 1
+
+
+def test_requests_are_limited_to_max_concurrency(gateway, client):
+    results = _inParallel(6, lambda index: gateway.chat("model", _messages(str(index)), useCache=False))
+
+    assert results == [f"reply to {index}" for index in range(6)]
+    assert client.calls == 6
+    assert client.peak == 2
+
+
+def test_failure_reaches_every_waiter_and_is_not_remembered(gateway, client):
+    client.failures = 1
+    results = _inParallel(4, lambda index: gateway.chat("model", _messages("hi"), useCache=False))
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert gateway.chat("model", _messages("hi"), useCache=False) == "reply to hi"
+    assert client.calls == 2
+
+
+def test_streamed_chunks_reach_on_chunk(gateway, client):
+    chunks = []
+    content = gateway.chat("model", _messages("hi there"), useCache=False, onChunk=chunks.append)
+
+    assert content == "reply to hi there "
+    assert "".join(chunks) == content
+    assert len(chunks) == 4
+
+
+def test_requests_use_the_timeout_and_retries_of_their_processor(gateway, client):
+    gateway.chat("model", _messages("hi"), useCache=False, processor="placeholder", config={"requestRetries": 5})
+
+    settings = ClientProvider.getSettings("placeholder")
+    assert client.options == [{"timeout": settings["timeout"], "max_retries": 5}]
@@ -0,0 +1,48 @@
+from marpService import slideNotes, splitSlides
+
+
+DECK = """---
+marp: true
+---
+
+<!-- paginate: true -->
+# First
+
+<!-- Say hello -->
+
+---
+
+<!--
+_class: lead
+_backgroundColor: black
+-->
+# Second
+
+```html
+<!-- not a note -->
+---
+```
+
+<!-- first note -->
+<!-- second note -->
+
+---
+
+# Third
+"""
+
+
+def test_slides_are_split_at_rulers_outside_code_blocks():
+    frontMatter, slideSources = splitSlides(DECK)
+
+    assert frontMatter == "---\nmarp: true\n---\n\n"
+    assert len(slideSources) == 3
+    assert "<!-- not a note -->\n---\n```" in slideSources[1]
+
+
+def test_notes_are_the_comments_that_are_not_directives():
+    assert slideNotes(DECK) == ["Say hello", "first note\n\nsecond note", ""]
+
+
+def test_decks_split_at_headings_are_left_to_marp():
+    assert slideNotes("<!-- headingDivider: 2 -->\n## One\n## Two") is None
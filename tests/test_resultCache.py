@@ -0,0 +1,143 @@
+import time
+
+import pytest
+
+from dslProcessor import DSLProcessor
+from programExecutor import ProgramExecutor
+from programs import ProgramDirectory, ProgramInput, ProgramOutput
+from resultCache import ResultCache
+
+
+RANDOM_ITOM = """#@ dsl: python
+#@ config:
+#@    mainfunc: 'roll'
+{header}#@ outputs: value
+
+def roll():
+    import random
+    value = random.random()
+    return {{"value": value}}
+"""
+
+
+@pytest.fixture
+def executor(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / ".programs").mkdir()
+    programDirectory = ProgramDirectory(str(tmp_path / ".programs"))
+    return ProgramExecutor(programDirectory, ResultCache(str(tmp_path / ".result_cache")))
+
+
+def _run(executor, programName, inputs=None, config=None):
+    program = executor.programDirectory.getProgram(programName)
+    return executor.executeProgram(programName, ProgramInput(startTimestamp=0, inputs=inputs or {}), "md",
+                                   config=config if config is not None else program.config)
+
+
+def _cachedRuns(executor, programName):
+    return [record["cached"] for record in executor.programDirectory.getExecutionHistory(programName)]
+
+
+def test_nondeterministic_python_itom_is_executed_every_time(executor):
+    executor.programDirectory.addNewProgram("roll", "", RANDOM_ITOM.format(header=""))
+
+    first = _run(executor, "roll")
+    second = _run(executor, "roll")
+
+    assert first.succeeded() and second.succeeded()
+    assert first.viz() != second.viz()
+    assert _cachedRuns(executor, "roll") == [False, False]
+
+
+def test_python_itom_can_opt_in_to_the_result_cache(executor):
+    executor.programDirectory.addNewProgram("roll", "", RANDOM_ITOM.format(header="#@    resultCache: true\n"))
+
+    first = _run(executor, "roll")
+    second = _run(executor, "roll")
+
+    assert first.viz() == second.viz()
+    assert _cachedRuns(executor, "roll") == [True, False]
+
+
+class CountingProcessor(DSLProcessor):
+    def __init__(self, programDirectory):
+        super().__init__()
+        self.runs = 0
+
+    def getVisualReturnTypes(self):
+        return ["md"]
+
+    def process(self, code, input, outputNames, preferredVisualReturnType, config, tracer=None):
+        self.runs += 1
+        return ProgramOutput(time.time(), "md", f"{code.strip()} {input}", {})
+
+
+class UncacheableProcessor(CountingProcessor):
+    def getIncludedProgramNames(self, program):
+        return None
+
+
+@pytest.fixture
+def counting(executor):
+    executor.dslRegistry.register("counting", CountingProcessor)
+    executor.dslRegistry.register("uncacheable", UncacheableProcessor)
+    return executor.getDSLProcessor("counting")
+
+
+def test_identical_execution_is_a_hit(executor, counting):
+    executor.programDirectory.addNewProgram("count", "", "#@ dsl: counting\nhello")
+
+    first = _run(executor, "count", {"a": 1})
+    second = _run(executor, "count", {"a": 1})
+    third = _run(executor, "count", {"a": 2})
+
+    assert counting.runs == 2
+    assert first.viz() == second.viz() != third.viz()
+    assert _cachedRuns(executor, "count") == [False, True, False]
+
+
+def test_changed_include_is_a_miss(executor, tmp_path):
+    programDirectory = executor.programDirectory
+    programDirectory.addNewProgram("child", "", '#@ dsl: basic\n{{return("result", 1)}}')
+    programDirectory.addNewProgram("parent", "", '#@ dsl: basic\n{% set r = include("child") %}value {{r.data.result}}')
+
+    before = _run(executor, "parent")
+    _run(executor, "parent")
+    (tmp_path / ".programs" / "child" / "code.itom").write_text('#@ dsl: basic\n{{return("result", 2)}}')
+    assert programDirectory.refreshProgram("child")
+    after = _run(executor, "parent")
+
+    assert "value 1" in before.viz()
+    assert "value 2" in after.viz()
+    assert _cachedRuns(executor, "parent") == [False, True, False]
+
+
+def test_result_cache_false_in_header_bypasses_the_cache(executor, counting):
+    executor.programDirectory.addNewProgram("count", "", "#@ dsl: counting\n#@ config:\n#@   resultCache: false\nhello")
+
+    # the header alone disables the cache, whatever config is passed in
+    _run(executor, "count", config={})
+    _run(executor, "count", config={})
+
+    assert counting.runs == 2
+
+
+def test_result_cache_false_in_config_bypasses_the_cache(executor, counting):
+    executor.programDirectory.addNewProgram("count", "", "#@ dsl: counting\nhello")
+
+    _run(executor, "count", config={"resultCache": False})
+    _run(executor, "count", config={"resultCache": False})
+
+    assert counting.runs == 2
+
+
+def test_uncacheable_include_makes_the_parent_uncacheable(executor, counting):
+    programDirectory = executor.programDirectory
+    programDirectory.addNewProgram("child", "", "#@ dsl: uncacheable\nhello")
+    programDirectory.addNewProgram("parent", "", '#@ dsl: basic\n{% set r = include("child") %}{{r.visual}}')
+    parent = programDirectory.getProgram("parent")
+
+    assert executor.getResultCacheKey(parent, ProgramInput(startTimestamp=0, inputs={}), "md", parent.config) is None
+    _run(executor, "parent")
+    _run(executor, "parent")
+    assert _cachedRuns(executor, "parent") == [False, False]
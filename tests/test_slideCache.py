@@ -0,0 +1,35 @@
+import os
+import time
+
+import pytest
+
+pytest.importorskip("pydub")
+
+import SlideVideoDSLProcessor
+from SlideVideoDSLProcessor import SlideVideoDSLProcessor as Processor
+
+
+def _storeSlide(processor, key, size, age):
+    path = processor.slideCachePath(key)
+    os.makedirs(path)
+    with open(f"{path}/segment.mp4", "wb") as file:
+        file.write(bytes(size))
+    used = time.time() - age
+    os.utime(path, (used, used))
+    return path
+
+
+def test_least_recently_used_slides_are_evicted(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    processor = Processor.__new__(Processor)
+    oldest = _storeSlide(processor, "aa" + "0" * 62, 100, 300)
+    inUse = _storeSlide(processor, "bb" + "0" * 62, 100, 200)
+    recent = _storeSlide(processor, "cc" + "0" * 62, 100, 100)
+    staging = _storeSlide(processor, "dd" + "0" * 62 + ".1234.tmp", 10, SlideVideoDSLProcessor.STALE_STAGING_SECONDS + 1)
+
+    processor.evictSlideCache(150, {"bb" + "0" * 62})
+
+    assert not os.path.exists(oldest)
+    assert os.path.exists(inUse)
+    assert not os.path.exists(recent)
+    assert not os.path.exists(staging)
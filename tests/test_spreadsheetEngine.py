@@ -0,0 +1,36 @@
+from spreadsheetEngine import CYCLE_ERROR, SpreadsheetEngine
+
+
+def _sheet(a1):
+    return {
+        "A1": a1, "A2": "2", "B1": "3", "B2": "4",
+        "C1": "=C2+1", "C2": "=C3+1", "C3": "=C1+1",
+        "D7": "=COUNT(A1:C3)",
+    }
+
+
+def test_update_downstream_of_cycle_matches_fresh_load():
+    engine = SpreadsheetEngine()
+    engine.load(_sheet("1"))
+    assert engine.getValue("D7") == CYCLE_ERROR
+
+    engine.update({"A1": "2"})
+
+    fresh = SpreadsheetEngine()
+    fresh.load(_sheet("2"))
+    assert engine.getValues() == fresh.getValues()
+    assert engine.getCycles() == fresh.getCycles()
+    assert engine.getValue("D7") == CYCLE_ERROR
+
+
+def test_breaking_cycle_recomputes_downstream():
+    engine = SpreadsheetEngine()
+    engine.load(_sheet("1"))
+
+    engine.update({"C3": "5"})
+
+    fresh = SpreadsheetEngine()
+    fresh.load(dict(_sheet("1"), C3="5"))
+    assert engine.getValues() == fresh.getValues()
+    assert engine.getCycles() == set()
+    assert engine.getValue("D7") == 7.0
@@ -0,0 +1,82 @@
+import statistics
+
+from vegaPreaggregation import preaggregateSpec
+
+
+ROWS = [{"category": "abc"[index % 3], "value": float(index), "flag": index % 2 == 0} for index in range(300)]
+
+
+def _spec(**parts):
+    spec = {"mark": "bar", "data": {"values": ROWS}}
+    spec.update(parts)
+    return spec
+
+
+def _byCategory(rows, field):
+    return {row["category"]: row[field] for row in rows}
+
+
+def test_encoding_aggregates_are_computed_per_group():
+    reduced = preaggregateSpec(_spec(encoding={
+        "x": {"field": "category", "type": "nominal"},
+        "y": {"aggregate": "mean", "field": "value", "type": "quantitative"},
+    }))
+
+    rows = reduced["data"]["values"]
+    assert len(rows) == 3
+    expected = {category: statistics.mean(row["value"] for row in ROWS if row["category"] == category) for category in "abc"}
+    assert _byCategory(rows, "mean_value") == expected
+    assert reduced["encoding"]["y"]["field"] == "mean_value"
+    assert "aggregate" not in reduced["encoding"]["y"]
+
+
+def test_filter_and_aggregate_transforms_are_applied():
+    reduced = preaggregateSpec(_spec(
+        transform=[
+            {"filter": {"field": "flag", "equal": True}},
+            {"aggregate": [{"op": "count", "as": "n"}, {"op": "median", "field": "value", "as": "median"}], "groupby": ["category"]},
+        ],
+        encoding={"x": {"field": "category", "type": "nominal"}, "y": {"field": "n", "type": "quantitative"}},
+    ))
+
+    assert "transform" not in reduced
+    kept = [row for row in ROWS if row["flag"]]
+    rows = reduced["data"]["values"]
+    assert _byCategory(rows, "n") == {category: sum(1 for row in kept if row["category"] == category) for category in "abc"}
+    assert _byCategory(rows, "median") == {category: statistics.median(row["value"] for row in kept if row["category"] == category) for category in "abc"}
+
+
+def test_binned_counts_cover_every_row():
+    reduced = preaggregateSpec(_spec(encoding={
+        "x": {"field": "value", "bin": True, "type": "quantitative"},
+        "y": {"aggregate": "count", "type": "quantitative"},
+    }))
+
+    rows = reduced["data"]["values"]
+    assert sum(row["__count"] for row in rows) == len(ROWS)
+    assert reduced["encoding"]["x"]["bin"]["binned"] is True
+    assert "x2" in reduced["encoding"]
+    step = reduced["encoding"]["x"]["bin"]["step"]
+    for row in rows:
+        start = row[reduced["encoding"]["x"]["field"]]
+        assert row[reduced["encoding"]["x2"]["field"]] == start + step
+
+
+def test_unsupported_transforms_are_left_to_vega():
+    reduced = preaggregateSpec(_spec(
+        transform=[
+            {"filter": {"field": "value", "lt": 100}},
+            {"calculate": "datum.value * 2", "as": "double"},
+        ],
+        encoding={"x": {"field": "double", "type": "quantitative"}},
+    ))
+
+    assert len(reduced["data"]["values"]) == 100
+    assert reduced["transform"] == [{"calculate": "datum.value * 2", "as": "double"}]
+
+
+def test_specs_without_anything_to_aggregate_are_unchanged():
+    assert preaggregateSpec(_spec(encoding={"x": {"field": "value", "type": "quantitative"}})) is None
+    assert preaggregateSpec(_spec(encoding={"x": {"field": "value", "timeUnit": "year", "aggregate": "count"}})) is None
+    assert preaggregateSpec({"layer": [], "data": {"values": ROWS}}) is None
+    assert preaggregateSpec({"mark": "bar", "data": {"url": "data.csv"}}) is None